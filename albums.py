@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import math
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class Album:
+    """Собираемая группа медиа"""
+
+    __slots__ = (
+        'media_group_id', 'chat_id', 'user_id', 'user_tg_id', 'context', 'media', 'caption',
+        'seen', 'last_update', 'deadline', 'armed_tick'
+    )
+
+    def __init__(self, media_group_id: str, chat_id: int, user_id: int, user_tg_id: int, context, now: float):
+        self.media_group_id = media_group_id
+        self.chat_id = chat_id
+        self.user_id = user_id
+        # Ключ user_data автора (его Telegram ID)
+        self.user_tg_id = user_tg_id
+        self.context = context
+        self.media = []
+        self.caption = ''
+        # file_unique_id уже добавленных элементов
+        self.seen = set()
+        self.last_update = now
+        self.deadline = now
+        self.armed_tick = None
+
+
+class AlbumAssembler:
+    """Сборщик альбомов.
+
+    Telegram присылает элементы альбома отдельными сообщениями. Сборщик
+    копит их и передает готовый альбом в on_ready, когда новые элементы
+    перестают приходить. Все ожидающие альбомы обслуживаются одним таймером
+    (колесом таймеров), а период ожидания подстраивается под наблюдаемые
+    интервалы между элементами.
+    """
+
+    # Telegram допускает не более 10 элементов в альбоме
+    MAX_ITEMS = 10
+    # Во сколько раз период ожидания больше среднего интервала между элементами
+    QUIET_FACTOR = 3
+    # Вес нового наблюдения в скользящем среднем интервалов
+    EWMA_ALPHA = 0.2
+
+    def __init__(self, on_ready, min_delay: float = 0.3, max_delay: float = 1.5,
+                 ttl: float = 60, tick: float = 0.05, wheel_size: int = 64):
+        self.on_ready = on_ready
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.ttl = ttl
+        self._tick = tick
+        self._slots = [[] for _ in range(wheel_size)]
+        self._albums = {}
+        # Недавно обработанные альбомы: опоздавшие элементы отбрасываются
+        self._done = OrderedDict()
+        self._gap = max_delay / self.QUIET_FACTOR
+        self._origin = None
+        self._current = 0
+        self._wheel = None
+        self._tasks = set()
+
+    @property
+    def pending(self) -> int:
+        """Количество собираемых альбомов"""
+        return len(self._albums)
+
+    @property
+    def quiet_period(self) -> float:
+        """Текущий период ожидания новых элементов"""
+        return min(max(self._gap * self.QUIET_FACTOR, self.min_delay), self.max_delay)
+
+    def add(self, media_group_id: str, chat_id: int, user_id: int, user_tg_id: int, context,
+            unique_id: str, media, caption: str = None):
+        """Добавляет элемент альбома.
+
+        caption — подпись альбома, сохраняется из первого элемента, где она есть.
+        """
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        self._evict(now)
+
+        if media_group_id in self._done:
+            logger.warning("Элемент альбома %s пришел после его обработки", media_group_id)
+            return
+
+        album = self._albums.get(media_group_id)
+        if album is None:
+            album = self._albums[media_group_id] = Album(media_group_id, chat_id, user_id, user_tg_id, context, now)
+        else:
+            gap = now - album.last_update
+            self._gap += self.EWMA_ALPHA * (min(gap, self.max_delay) - self._gap)
+            album.last_update = now
+
+        if unique_id not in album.seen:
+            album.seen.add(unique_id)
+            album.media.append(media)
+
+        if caption and not album.caption:
+            album.caption = caption
+
+        if len(album.media) >= self.MAX_ITEMS:
+            # Альбом заполнен, ждать больше нечего
+            self._fire(album)
+            return
+
+        album.deadline = now + self.quiet_period
+        self._arm(album, loop)
+
+    def _arm(self, album: Album, loop):
+        if self._wheel is None or self._wheel.done():
+            self._origin = loop.time()
+            self._current = 0
+            self._wheel = asyncio.create_task(self._run(), name="album_assembler")
+        tick = max(math.ceil((album.deadline - self._origin) / self._tick), self._current + 1)
+        # Предыдущая запись альбома в колесе станет устаревшей
+        album.armed_tick = tick
+        self._slots[tick % len(self._slots)].append((tick, album))
+
+    def _fire(self, album: Album):
+        """Передает альбом на обработку"""
+        del self._albums[album.media_group_id]
+        album.armed_tick = None
+        self._done[album.media_group_id] = album.last_update + self.ttl
+        task = asyncio.create_task(self._process(album))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, album: Album):
+        try:
+            await self.on_ready(album)
+        except Exception:
+            logger.exception("Ошибка при обработке альбома %s", album.media_group_id)
+
+    def _evict(self, now: float):
+        """Забывает обработанные альбомы, срок хранения которых истек"""
+        while self._done:
+            media_group_id, expires = next(iter(self._done.items()))
+            if expires > now:
+                break
+            del self._done[media_group_id]
+
+    async def _run(self):
+        """Колесо таймеров: один цикл на все ожидающие альбомы"""
+        loop = asyncio.get_running_loop()
+        while self._albums:
+            next_time = self._origin + (self._current + 1) * self._tick
+            await asyncio.sleep(max(next_time - loop.time(), 0))
+            now = loop.time()
+            while self._origin + (self._current + 1) * self._tick <= now:
+                self._current += 1
+                slot = self._slots[self._current % len(self._slots)]
+                later = []
+                for tick, album in slot:
+                    if tick > self._current:
+                        # Запись на следующий оборот колеса
+                        later.append((tick, album))
+                    elif album.armed_tick == tick:
+                        self._fire(album)
+                slot[:] = later
+        for slot in self._slots:
+            slot.clear()
+        self._evict(loop.time())
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import time
+
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+
+def submission_items(message_data: dict) -> int:
+    """Количество файлов в отправке: элементы альбома или одно сообщение"""
+    if message_data.get('type') == 'media_group':
+        return len(message_data['media'])
+    return 1
+
+
+class SubmissionLog:
+    """Журнал отправок в канал с отложенной записью.
+
+    record() только добавляет строку в буфер; буфер записывается одной
+    транзакцией в потоке базы, когда набирается batch_size строк или через
+    flush_interval секунд после первой записи. Вместе со строками журнала
+    в той же транзакции обновляются счетчики по дням, типам и пользователям,
+    поэтому сводки читаются по ключу, без просмотра журнала.
+    """
+
+    def __init__(self, db: Database, batch_size: int = 500, flush_interval: float = 2):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # (created_at, user_id, type, items, status), ожидающие записи
+        self._buffer = []
+        self._flush_task = None
+        self._write_lock = asyncio.Lock()
+
+    @property
+    def pending(self) -> int:
+        """Количество записей, ожидающих сохранения"""
+        return len(self._buffer)
+
+    def record(self, user_id: int, message_data: dict, status: str):
+        """Добавляет событие отправки: confirmed, moderation, published, failed или duplicate"""
+        self._buffer.append(
+            (int(time.time()), user_id, message_data['type'], submission_items(message_data), status)
+        )
+        if len(self._buffer) >= self.batch_size:
+            self._schedule(0)
+        elif self._flush_task is None:
+            self._schedule(self.flush_interval)
+
+    def _schedule(self, delay: float):
+        if self._flush_task is not None:
+            if delay:
+                return
+            self._flush_task.cancel()
+        self._flush_task = asyncio.create_task(self._flush_later(delay))
+
+    async def _flush_later(self, delay: float):
+        await asyncio.sleep(delay)
+        self._flush_task = None
+        await self._write()
+
+    async def _write(self):
+        """Записывает буфер одной транзакцией"""
+        async with self._write_lock:
+            if not self._buffer:
+                return
+            batch, self._buffer = self._buffer, []
+            try:
+                await self.db.add_submissions(batch)
+            except Exception:
+                logger.exception("Не удалось записать журнал отправок (%d строк)", len(batch))
+                # Вернем строки в начало буфера, чтобы записать их со следующей пачкой
+                self._buffer[:0] = batch
+                if self._flush_task is None:
+                    self._schedule(self.flush_interval)
+
+    async def flush(self):
+        """Записывает буфер немедленно (перед чтением сводок и при остановке)"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self._write()
+
+    async def totals(self, scope: str, key: str = None) -> dict:
+        """Счетчики {(ключ, статус): количество}.
+
+        scope — day (ключ ГГГГ-ММ-ДД), type, user (внутренний ID) или
+        user_day ("ID:ГГГГ-ММ-ДД"); без key возвращаются все ключи scope.
+        """
+        await self.flush()
+        return await self.db.get_submission_totals(scope, key)
@@ -0,0 +1,155 @@
+import heapq
+from datetime import datetime, timedelta
+
+from telegram.ext import ContextTypes, JobQueue
+
+from state import StateBackend
+
+
+class BanRegistry:
+    """Реестр банов в памяти.
+
+    Загружается из базы один раз при запуске, проверки выполняются по словарю
+    без обращения к базе. Истечение банов обрабатывается по расписанию через
+    JobQueue: ближайшие сроки хранятся в куче, а задача запускается к моменту
+    окончания самого раннего бана.
+
+    Если баны выдают и другие экземпляры бота, реестр раз в refresh_interval
+    секунд перечитывается из общего хранилища.
+    """
+
+    JOB_NAME = "ban_expiry"
+    REFRESH_JOB_NAME = "ban_refresh"
+
+    def __init__(self, state: StateBackend):
+        self.state = state
+        # user_id -> (время_окончания или None для вечного бана, причина)
+        self._bans = {}
+        # Куча (время_окончания, user_id); устаревшие записи пропускаются при извлечении
+        self._heap = []
+        self._job_queue = None
+        self._job = None
+        self._job_when = None
+        # Счетчик изменений реестра: перечитывание, во время которого бан
+        # выдали или сняли, не применяется (его данные могли устареть)
+        self._version = 0
+
+    async def load(self, job_queue: JobQueue, refresh_interval: float = None):
+        """Загружает активные баны из базы и планирует их снятие"""
+        self._job_queue = job_queue
+        await self._reload()
+        if refresh_interval:
+            job_queue.run_repeating(
+                self._refresh, interval=refresh_interval, first=refresh_interval, name=self.REFRESH_JOB_NAME
+            )
+
+    async def _reload(self):
+        version = self._version
+        now = datetime.now()
+        bans = {}
+        heap = []
+        expired = []
+        for user_id, ban_until, reason in await self.state.load_bans():
+            ban_until_dt = datetime.fromtimestamp(ban_until) if ban_until is not None else None
+            if ban_until_dt is not None and ban_until_dt <= now:
+                expired.append(user_id)
+                continue
+            bans[user_id] = (ban_until_dt, reason)
+            if ban_until_dt is not None:
+                heap.append((ban_until_dt, user_id))
+        heapq.heapify(heap)
+        if version != self._version:
+            return
+        self._bans, self._heap = bans, heap
+
+        # Баны, истекшие пока бот был выключен
+        if expired:
+            await self.state.remove_bans(expired)
+        self._schedule()
+
+    async def _refresh(self, context: ContextTypes.DEFAULT_TYPE):
+        """Подхватывает баны, выданные и снятые другими экземплярами"""
+        await self._reload()
+
+    def is_banned(self, user_id: int) -> tuple:
+        """Проверяет, забанен ли пользователь. Возвращает (забанен_ли, время_окончания, причина)"""
+        ban = self._bans.get(user_id)
+        if ban is None:
+            return False, None, None
+        ban_until, reason = ban
+        # Задача могла еще не сработать в пределах точности планировщика
+        if ban_until is not None and datetime.now() > ban_until:
+            return False, None, None
+        return True, ban_until, reason
+
+    async def add(self, user_id: int, hours: float, reason: str = None):
+        """Добавляет бан пользователю"""
+        await self.add_many([(user_id, hours, reason)])
+
+    async def add_many(self, entries: list):
+        """Добавляет баны одной транзакцией: [(user_id, часы или inf для вечного бана, причина)]"""
+        now = datetime.now()
+        rows = [
+            (user_id, None if hours == float('inf') else now + timedelta(hours=hours), reason)
+            for user_id, hours, reason in entries
+        ]
+        await self.state.add_bans(rows)
+        self._version += 1
+        for user_id, ban_until, reason in rows:
+            self._bans[user_id] = (ban_until, reason)
+            if ban_until is not None:
+                heapq.heappush(self._heap, (ban_until, user_id))
+        self._schedule()
+
+    async def remove(self, user_id: int):
+        """Снимает бан с пользователя"""
+        await self.remove_many([user_id])
+
+    async def remove_many(self, user_ids: list):
+        """Снимает баны с нескольких пользователей одной транзакцией"""
+        await self.state.remove_bans(user_ids)
+        self._version += 1
+        # Записи в куче станут устаревшими и будут пропущены
+        for user_id in user_ids:
+            self._bans.pop(user_id, None)
+
+    def _schedule(self):
+        """Перепланирует задачу на время ближайшего окончания бана"""
+        # Отбрасываем записи, не соответствующие текущему состоянию
+        while self._heap and self._bans.get(self._heap[0][1], (None,))[0] != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+        if self._job_queue is None:
+            return
+
+        next_run = self._heap[0][0] if self._heap else None
+        if self._job is not None:
+            # Уже запланированная задача сработает не позже нужного
+            if next_run is not None and self._job_when <= next_run:
+                return
+            self._job.schedule_removal()
+            self._job = None
+
+        if next_run is not None:
+            self._job_when = next_run
+            self._job = self._job_queue.run_once(
+                self._expire,
+                when=max((next_run - datetime.now()).total_seconds(), 0),
+                name=self.JOB_NAME
+            )
+
+    async def _expire(self, context: ContextTypes.DEFAULT_TYPE):
+        """Снимает все истекшие баны"""
+        self._job = None
+        now = datetime.now()
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            ban_until, user_id = heapq.heappop(self._heap)
+            ban = self._bans.get(user_id)
+            if ban is not None and ban[0] == ban_until:
+                del self._bans[user_id]
+                expired.append(user_id)
+
+        if expired:
+            await self.state.remove_bans(expired)
+        self._schedule()
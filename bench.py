@@ -0,0 +1,305 @@
+"""Нагрузочный тест бота на локальной имитации Bot API.
+
+Бот запускается целиком (те же обработчики, база, очереди), но вместо
+api.telegram.org обращается к FakeBotAPI на 127.0.0.1, поэтому тест не
+требует сети и токена. Каждый виртуальный пользователь проходит сценарий
+/start -> «Отправить сообщение» -> текст или альбом -> «Отправить»,
+а тест измеряет задержку каждого шага и сценария целиком.
+
+Лимиты Telegram на публикацию по умолчанию сняты, чтобы измерять сам бот;
+задайте CHANNEL_RATE_PER_MINUTE и GLOBAL_RATE_PER_SECOND, чтобы проверить
+поведение очереди публикаций под реальными лимитами.
+
+Пример: python bench.py --users 200 --album-share 0.3 --latency 0.02 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+from fake_api import FakeBotAPI
+
+STEPS = ("start", "open", "submit", "confirm", "total")
+ALBUM_SIZE = 3
+# ID пользователей бота начинаются отсюда, чтобы не совпасть с ADMIN_ID
+FIRST_USER_ID = 100000
+
+
+class Stats:
+    """Результаты прогона"""
+
+    def __init__(self):
+        self.latency = defaultdict(list)
+        self.completed = 0
+        self.failed = Counter()
+        self.updates = 0
+        self.db_calls = 0
+        self.db_busy = 0.0
+
+
+def percentile(values: list, q: int) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+def chat_predicate(chat_id: int, check):
+    chat_id = str(chat_id)
+    return lambda method, params: str(params.get("chat_id")) == chat_id and check(method, params)
+
+
+def has_button(data: str):
+    return lambda method, params: data in str(params.get("reply_markup") or "")
+
+
+def text_contains(method_name: str, *fragments: str):
+    return lambda method, params: method == method_name and any(f in params.get("text", "") for f in fragments)
+
+
+class StepFailed(Exception):
+    """Бот не ответил на шаге сценария вовремя"""
+
+    def __init__(self, step: str):
+        super().__init__(step)
+        self.step = step
+
+
+class VirtualUser:
+    """Пользователь, который отправляет сообщения в канал через бота"""
+
+    def __init__(self, api: FakeBotAPI, stats: Stats, user_id: int, timeout: float):
+        self.api = api
+        self.stats = stats
+        self.user_id = user_id
+        self.timeout = timeout
+        self.user = {"id": user_id, "is_bot": False, "first_name": f"User {user_id}", "username": f"user{user_id}"}
+
+    def _message(self, **fields) -> dict:
+        message = {
+            "message_id": self.api.next_message_id(),
+            "date": int(time.time()),
+            "chat": {"id": self.user_id, "type": "private"},
+            "from": self.user,
+        }
+        message.update(fields)
+        return message
+
+    def _callback(self, data: str, message_id: int) -> dict:
+        return {
+            "id": str(self.api.next_message_id()),
+            "from": self.user,
+            "chat_instance": str(self.user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": self.user_id, "type": "private"},
+                "text": "",
+            },
+        }
+
+    async def _step(self, name: str, updates: list, check):
+        """Отправляет боту обновления и ждет его ответа; возвращает результат ответа"""
+        reply = self.api.expect(chat_predicate(self.user_id, check))
+        started = time.perf_counter()
+        for kind, payload in updates:
+            self.api.push(kind, payload)
+        self.stats.updates += len(updates)
+        try:
+            _, _, result = await asyncio.wait_for(reply, self.timeout)
+        except asyncio.TimeoutError:
+            raise StepFailed(name)
+        self.stats.latency[name].append(time.perf_counter() - started)
+        return result
+
+    async def run(self, album: bool):
+        started = time.perf_counter()
+        try:
+            menu = await self._step(
+                "start",
+                [("message", self._message(
+                    text="/start",
+                    entities=[{"type": "bot_command", "offset": 0, "length": 6}]
+                ))],
+                has_button("send_message")
+            )
+            await self._step(
+                "open",
+                [("callback_query", self._callback("send_message", menu["message_id"]))],
+                text_contains("editMessageText", "Введите ваше сообщение")
+            )
+            if album:
+                group_id = f"album-{self.user_id}-{self.api.next_message_id()}"
+                updates = []
+                for index in range(ALBUM_SIZE):
+                    file_id = f"photo-{self.user_id}-{index}"
+                    photo = {"file_id": file_id, "file_unique_id": "u" + file_id, "width": 1, "height": 1}
+                    fields = {"photo": [photo], "media_group_id": group_id}
+                    if index == 0:
+                        fields["caption"] = f"Альбом пользователя {self.user_id}"
+                    updates.append(("message", self._message(**fields)))
+            else:
+                updates = [("message", self._message(text=f"Сообщение пользователя {self.user_id}"))]
+            prompt = await self._step("submit", updates, has_button("confirm_send"))
+            await self._step(
+                "confirm",
+                [("callback_query", self._callback("confirm_send", prompt["message_id"]))],
+                text_contains("editMessageText", "успешно отправлено", "Ошибка")
+            )
+        except StepFailed as e:
+            self.stats.failed[e.step] += 1
+            return
+        self.stats.latency["total"].append(time.perf_counter() - started)
+        self.stats.completed += 1
+
+
+def measure_db(db, stats: Stats):
+    """Считает время, которое запросы проводят в потоке базы данных"""
+    run = db._run
+
+    def timed(func):
+        def wrapper(*args):
+            started = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                stats.db_busy += time.perf_counter() - started
+                stats.db_calls += 1
+        return wrapper
+
+    db._run = lambda func, *args: run(timed(func), *args)
+
+
+async def run_bench(args) -> dict:
+    api = FakeBotAPI(latency=args.latency, error_rate=args.error_rate, retry_after=args.retry_after)
+    await api.start()
+
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    os.environ.update({
+        "BOT_TOKEN": "123456:bench",
+        "ADMIN_ID": "1",
+        "CHANNEL_ID": "-1001",
+        "DB_NAME": os.path.join(workdir, "users.db"),
+        "BOT_API_URL": api.base_url,
+        "CONCURRENT_UPDATES": str(args.concurrency),
+    })
+    os.environ.setdefault("CHANNEL_RATE_PER_MINUTE", "1000000")
+    os.environ.setdefault("GLOBAL_RATE_PER_SECOND", "1000000")
+    # При нескольких раундах пользователи повторяют свои сообщения
+    os.environ.setdefault("DEDUP_WINDOW_HOURS", "0")
+    import bot
+
+    stats = Stats()
+    measure_db(bot.db, stats)
+    application = bot.build_application()
+
+    await application.initialize()
+    await application.post_init(application)
+    await application.updater.start_polling(poll_interval=0, timeout=10, allowed_updates=bot.ALLOWED_UPDATES)
+    await application.start()
+
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    try:
+        async def user_flow(index: int):
+            if args.ramp:
+                await asyncio.sleep(args.ramp * index / args.users)
+            user = VirtualUser(api, stats, FIRST_USER_ID + index, args.timeout)
+            for _ in range(args.rounds):
+                await user.run(album=rng.random() < args.album_share)
+
+        await asyncio.gather(*(user_flow(index) for index in range(args.users)))
+        elapsed = time.perf_counter() - started
+    finally:
+        await application.updater.stop()
+        await application.stop()
+        await application.post_stop(application)
+        await application.shutdown()
+        await application.post_shutdown(application)
+        await api.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    methods = Counter(method for _, method, _ in api.calls)
+    return {
+        "users": args.users,
+        "rounds": args.rounds,
+        "completed": stats.completed,
+        "failed": dict(stats.failed),
+        "elapsed": elapsed,
+        "updates": stats.updates,
+        "updates_per_second": stats.updates / elapsed if elapsed else 0.0,
+        "latency": {
+            step: {
+                "p50": percentile(stats.latency[step], 50),
+                "p95": percentile(stats.latency[step], 95),
+                "p99": percentile(stats.latency[step], 99),
+                "max": max(stats.latency[step], default=0.0),
+            }
+            for step in STEPS
+        },
+        "db_calls": stats.db_calls,
+        "db_busy": stats.db_busy,
+        "api_calls": dict(methods),
+        "throttled": api.throttled,
+    }
+
+
+def print_report(result: dict):
+    print(f"Пользователей: {result['users']} x {result['rounds']}, "
+          f"успешно: {result['completed']}, ошибок: {sum(result['failed'].values())} {result['failed'] or ''}")
+    print(f"Время: {result['elapsed']:.2f} с, обновлений: {result['updates']} "
+          f"({result['updates_per_second']:.1f} в секунду)")
+    print()
+    print(f"{'шаг':<10}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for step, values in result["latency"].items():
+        print(f"{step:<10}" + "".join(f"{values[key] * 1000:>10.1f}" for key in ("p50", "p95", "p99", "max")))
+    print()
+    db_share = result["db_busy"] / result["elapsed"] * 100 if result["elapsed"] else 0.0
+    per_call = result["db_busy"] / result["db_calls"] * 1000 if result["db_calls"] else 0.0
+    print(f"База данных: {result['db_calls']} запросов, {result['db_busy']:.3f} с "
+          f"({db_share:.1f}% времени, {per_call:.3f} мс на запрос)")
+    calls = ", ".join(f"{method}={count}" for method, count in sorted(result["api_calls"].items()))
+    print(f"Вызовы API: {calls}; ответов 429: {result['throttled']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на локальной имитации Bot API")
+    parser.add_argument("--users", type=int, default=100, help="число виртуальных пользователей")
+    parser.add_argument("--rounds", type=int, default=1, help="сколько сообщений отправляет каждый пользователь")
+    parser.add_argument("--album-share", type=float, default=0.3, help="доля сообщений-альбомов (0..1)")
+    parser.add_argument("--ramp", type=float, default=0.0, help="за сколько секунд подключаются все пользователи")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа Bot API в секундах")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 429 (0..1)")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429")
+    parser.add_argument("--concurrency", type=int, default=32, help="CONCURRENT_UPDATES бота")
+    parser.add_argument("--timeout", type=float, default=30.0, help="сколько ждать ответа бота на шаге")
+    parser.add_argument("--seed", type=int, default=0, help="зерно выбора альбомов")
+    parser.add_argument("--json", metavar="FILE", help="сохранить результаты в JSON")
+    parser.add_argument("--verbose", action="store_true", help="выводить ошибки обработчиков бота")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    if not args.verbose:
+        # Сбои шагов и так попадают в отчет, трассировки только мешают его читать
+        logging.getLogger("telegram.ext").setLevel(logging.CRITICAL)
+    result = asyncio.run(run_bench(args))
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    return 0 if not result["failed"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,13 @@
 import os
+import io
+import csv
+import gzip
 import asyncio
-import sqlite3
-from datetime import datetime, timedelta
+import secrets
+import tempfile
+import time
+from collections import OrderedDict
+from datetime import datetime
 from telegram import (
     Update, 
     InlineKeyboardButton, 
@@ -19,149 +25,293 @@ from telegram.ext import (
     filters
 )
 
+from albums import Album, AlbumAssembler
+from audit import SubmissionLog
+from bans import BanRegistry
+from broadcast import Broadcaster
+from database import Database
+from dedup import DedupIndex, media_key, text_key
+from dispatch import UserOrderedUpdateProcessor
+from flood import FloodControl, parse_limits
+from identity import IdentityCache
+from metrics import Registry, instrument_handlers
+from middleware import Pipeline, command_name
+from moderation import ModerationQueue
+from persistence import StatePersistence
+from publisher import CircuitBreaker, PublishCancelled, PublishQueue, PublishUncertain, PublishUnavailable, TokenBucket
+from state import KVState
+from webhook import ShardRouter, WebhookServer, serve_webhook
+
 # Конфигурация из переменных окружения
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_ID = int(os.getenv('ADMIN_ID'))
 CHANNEL_ID = os.getenv('CHANNEL_ID')
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+
+# Лимиты Telegram: около 20 сообщений в минуту в один канал и 30 в секунду на бота
+CHANNEL_RATE_PER_MINUTE = float(os.getenv('CHANNEL_RATE_PER_MINUTE', '20'))
+GLOBAL_RATE_PER_SECOND = float(os.getenv('GLOBAL_RATE_PER_SECOND', '30'))
+
+# Сетевые ошибки, при которых запрос не ушел в Telegram, повторяются до
+# PUBLISH_NETWORK_RETRIES раз с задержкой от PUBLISH_BACKOFF секунд, растущей вдвое
+# (не больше PUBLISH_MAX_BACKOFF). Если запрос мог дойти, публикация не повторяется:
+# пост мог выйти, и автор узнает, что итог неизвестен.
+PUBLISH_NETWORK_RETRIES = int(os.getenv('PUBLISH_NETWORK_RETRIES', '4'))
+PUBLISH_BACKOFF = float(os.getenv('PUBLISH_BACKOFF', '1'))
+PUBLISH_MAX_BACKOFF = float(os.getenv('PUBLISH_MAX_BACKOFF', '30'))
+# После PUBLISH_BREAKER_THRESHOLD неудач подряд публикации приостанавливаются
+# на PUBLISH_BREAKER_RESET секунд
+PUBLISH_BREAKER_THRESHOLD = int(os.getenv('PUBLISH_BREAKER_THRESHOLD', '5'))
+PUBLISH_BREAKER_RESET = float(os.getenv('PUBLISH_BREAKER_RESET', '60'))
+
+# Как часто (в секундах) изменения состояния пользователей записываются в базу
+PERSISTENCE_INTERVAL = float(os.getenv('PERSISTENCE_INTERVAL', '5'))
+
+# Сколько сообщений рассылки отправляется одновременно
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '10'))
+
+# Сколько ID можно заблокировать или разблокировать одной командой или файлом
+BULK_BAN_LIMIT = int(os.getenv('BULK_BAN_LIMIT', '10000'))
+# Наибольший размер CSV-файла для массовой блокировки
+BAN_IMPORT_MAX_SIZE = int(os.getenv('BAN_IMPORT_MAX_SIZE', str(1024 * 1024)))
+
+# Количество блокировок на одной странице /banlist
+BANLIST_PAGE_SIZE = int(os.getenv('BANLIST_PAGE_SIZE', '20'))
+
+# Размер выгрузки /takedb, после которого временный файл переносится из памяти на диск
+EXPORT_SPOOL_SIZE = int(os.getenv('EXPORT_SPOOL_SIZE', str(1024 * 1024)))
+
+# Модерация: подтвержденные сообщения ждут одобрения администратора и выходят
+# в канал по расписанию — не больше PUBLISH_SLOT_SIZE каждые PUBLISH_SLOT_INTERVAL секунд
+MODERATION = os.getenv('MODERATION', '0') == '1'
+PUBLISH_SLOT_INTERVAL = float(os.getenv('PUBLISH_SLOT_INTERVAL', '600'))
+PUBLISH_SLOT_SIZE = int(os.getenv('PUBLISH_SLOT_SIZE', '1'))
+QUEUE_PAGE_SIZE = int(os.getenv('QUEUE_PAGE_SIZE', '10'))
+
+# Ограничение частоты действий пользователя: "действие=событий/секунд".
+# message — сообщения боту (альбом считается одним), button — нажатия кнопок,
+# submission — подтвержденные отправки в канал
+FLOOD_LIMITS = parse_limits(os.getenv('FLOOD_LIMITS', 'message=20/60,button=5/3,submission=10/3600'))
+# Лишние действия молча отбрасываются, каждая серия отказов засчитывается как нарушение;
+# после стольких нарушений за окно следующее ведет к бану на FLOOD_BAN_HOURS
+FLOOD_STRIKES = parse_limits(f"strikes={os.getenv('FLOOD_STRIKES', '3/600')}")['strikes']
+FLOOD_BAN_HOURS = float(os.getenv('FLOOD_BAN_HOURS', '24'))
+
+# Быстрый предпросмотр: кнопки подтверждения прикрепляются к самому предпросмотру
+FAST_PREVIEW = os.getenv('FAST_PREVIEW', '1') != '0'
+
+# Повторы: сообщение отклоняется до предпросмотра, если тот же текст или файл
+# публиковался в канале за последние DEDUP_WINDOW_HOURS часов (0 — не проверять)
+DEDUP_WINDOW_HOURS = float(os.getenv('DEDUP_WINDOW_HOURS', '72'))
+DEDUP_MEMORY_SIZE = int(os.getenv('DEDUP_MEMORY_SIZE', '100000'))
+
+# Журнал отправок пишется пачками: по AUDIT_BATCH_SIZE строк или раз в AUDIT_FLUSH_INTERVAL секунд
+AUDIT_BATCH_SIZE = int(os.getenv('AUDIT_BATCH_SIZE', '500'))
+AUDIT_FLUSH_INTERVAL = float(os.getenv('AUDIT_FLUSH_INTERVAL', '2'))
+
+# Сколько обновлений разных пользователей обрабатывается одновременно
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '32'))
+
+# Перегрузка: если ждут очереди больше UPDATE_BACKLOG_LIMIT обновлений или самое
+# старое ждет дольше UPDATE_BACKLOG_MAX_AGE секунд, новые сообщения пользователей
+# не обрабатываются, а автору предлагается повторить позже (не чаще раза
+# в SHED_REPLY_INTERVAL секунд). Команды администратора и кнопки не сбрасываются.
+UPDATE_BACKLOG_LIMIT = int(os.getenv('UPDATE_BACKLOG_LIMIT', '500'))
+UPDATE_BACKLOG_MAX_AGE = float(os.getenv('UPDATE_BACKLOG_MAX_AGE', '30'))
+SHED_REPLY_INTERVAL = float(os.getenv('SHED_REPLY_INTERVAL', '60'))
+
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Публичный адрес webhook; если не задан, сервер слушает без регистрации в Telegram
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', os.getenv('PORT', '8443')))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+
+# Общее состояние (пользователи, баны, незавершенные отправки, повторы):
+# sqlite — в файле DB_NAME, kv — в хранилище с протоколом Redis по адресу KV_URL,
+# общем для нескольких экземпляров бота
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'sqlite')
+KV_URL = os.getenv('KV_URL', 'redis://127.0.0.1:6379/0')
+KV_PREFIX = os.getenv('KV_PREFIX', 'bot:')
+SHARED_STATE = STATE_BACKEND == 'kv'
+# Как часто перечитывать баны, выданные другими экземплярами (секунды)
+BAN_REFRESH_INTERVAL = float(os.getenv('BAN_REFRESH_INTERVAL', '30'))
+
+# Несколько экземпляров в режиме webhook: SHARD_PEERS — адреса webhook всех
+# экземпляров через запятую (одинаковые у всех), SHARD_INDEX — номер этого.
+# Обновления пользователя обрабатывает экземпляр с номером ID % их числа
+SHARD_PEERS = [url.strip() for url in os.getenv('SHARD_PEERS', '').split(',') if url.strip()]
+SHARD_INDEX = int(os.getenv('SHARD_INDEX', '0'))
+
+# Порт для /metrics в режиме polling (0 — не запускать); в режиме webhook
+# метрики отдает сервер webhook
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+# Обработчики бота используют только сообщения и нажатия на кнопки
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+# Адрес Bot API; задается для локального сервера Bot API или нагрузочного теста
+BOT_API_URL = os.getenv('BOT_API_URL')
+
+# Метрики бота: /metrics в формате Prometheus и сводка /stats
+metrics = Registry()
+updates_total = metrics.counter("bot_updates_total", "Полученные обновления")
+handler_latency = metrics.histogram("bot_handler_seconds", "Время работы обработчиков", ("handler",))
+handler_errors = metrics.counter("bot_handler_errors_total", "Исключения в обработчиках", ("handler",))
+db_query_time = metrics.histogram("bot_db_query_seconds", "Время запросов к базе данных", ("query",))
+submissions = metrics.counter("bot_submissions_total", "Подтвержденные сообщения по типам", ("type",))
+ban_actions = metrics.counter("bot_ban_actions_total", "Блокировки и разблокировки", ("action",))
+rejected_updates = metrics.counter(
+    "bot_rejected_updates_total", "Обновления, отсеянные до обработчиков", ("middleware",)
+)
+shed_updates = metrics.counter(
+    "bot_shed_updates_total", "Обновления, сброшенные при перегрузке", ("priority",)
+)
+duplicates_rejected = metrics.counter("bot_duplicates_total", "Сообщения, отклоненные как повторы")
+publish_results = metrics.counter("bot_publish_total", "Итоги публикаций в канал", ("result",))
+publish_latency = metrics.histogram(
+    "bot_publish_seconds", "Время от подтверждения до публикации в канале",
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+)
+# Значения для горячего пути создаются заранее
+published_ok = publish_results.labels("ok")
+published_error = publish_results.labels("error")
+published_unavailable = publish_results.labels("unavailable")
+published_uncertain = publish_results.labels("uncertain")
+publish_retries = metrics.counter("bot_publish_retries_total", "Повторы публикаций", ("reason",))
+metrics_server = None
 
 # База данных
-DB_NAME = "users.db"
-
-# Глобальный словарь для хранения групп медиа
-media_groups = {}
-
-def init_db():
-    """Инициализация базы данных"""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            tg_id INTEGER UNIQUE,
-            username TEXT
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS bans (
-            user_id INTEGER PRIMARY KEY,
-            ban_until TIMESTAMP,
-            reason TEXT,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    conn.commit()
-    conn.close()
+DB_NAME = os.getenv('DB_NAME', 'users.db')
+db = Database(DB_NAME, query_time=db_query_time)
+state = KVState(KV_URL, KV_PREFIX) if SHARED_STATE else db
 
-def get_or_create_user(tg_id: int, username: str = None) -> int:
-    """Получить или создать пользователя в базе данных"""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
-    # Проверяем существование пользователя
-    cursor.execute("SELECT id FROM users WHERE tg_id = ?", (tg_id,))
-    result = cursor.fetchone()
-    
-    if result:
-        user_id = result[0]
-    else:
-        # Создаем нового пользователя
-        username_display = username if username else "None"
-        cursor.execute(
-            "INSERT INTO users (tg_id, username) VALUES (?, ?)",
-            (tg_id, username_display)
-        )
-        user_id = cursor.lastrowid
-        conn.commit()
-    
-    conn.close()
-    return user_id
-
-def get_all_users():
-    """Получить всех пользователей из базы данных"""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users")
-    users = cursor.fetchall()
-    conn.close()
-    return users
-
-def is_user_banned(user_id: int) -> tuple:
-    """Проверяет, забанен ли пользователь. Возвращает (забанен_ли, время_окончания, причина)"""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT ban_until, reason FROM bans WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    
-    if not result:
-        return False, None, None
-    
-    ban_until, reason = result
-    
-    # Если бан вечный (ban_until is None)
-    if ban_until is None:
-        return True, None, reason
-    
-    # Проверяем, не истек ли срок бана
-    ban_until_dt = datetime.fromisoformat(ban_until)
-    if datetime.now() > ban_until_dt:
-        # Удаляем истекший бан
-        remove_ban(user_id)
-        return False, None, None
-    
-    return True, ban_until_dt, reason
+# Состояние пользователей (незавершенные отправки) переживает перезапуск
+persistence = StatePersistence(state, PERSISTENCE_INTERVAL)
 
-def add_ban(user_id: int, hours: float, reason: str = None):
-    """Добавляет бан пользователю"""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
-    if hours == float('inf'):  # Вечный бан
-        ban_until = None
+# Реестр банов в памяти
+bans = BanRegistry(state)
+
+# Ограничение частоты действий пользователей
+flood = FloodControl(FLOOD_LIMITS, FLOOD_STRIKES)
+
+# Недавно опубликованное содержимое для отсева повторов
+dedup = DedupIndex(state, DEDUP_WINDOW_HOURS * 3600, DEDUP_MEMORY_SIZE, shared=SHARED_STATE)
+
+# Кэш соответствия tg_id -> ID пользователя в боте
+identity = IdentityCache(state, USER_CACHE_SIZE)
+
+# Общий лимит исходящих сообщений бота и очередь публикаций в канал
+global_limiter = TokenBucket(GLOBAL_RATE_PER_SECOND, GLOBAL_RATE_PER_SECOND)
+publisher = PublishQueue(
+    channel_limiter=TokenBucket(CHANNEL_RATE_PER_MINUTE / 60, CHANNEL_RATE_PER_MINUTE),
+    global_limiter=global_limiter,
+    network_retries=PUBLISH_NETWORK_RETRIES,
+    backoff=PUBLISH_BACKOFF,
+    max_backoff=PUBLISH_MAX_BACKOFF,
+    breaker=CircuitBreaker(PUBLISH_BREAKER_THRESHOLD, PUBLISH_BREAKER_RESET),
+    db=db,
+    retries=publish_retries
+)
+
+# Рассылка сообщений всем пользователям под тем же общим лимитом
+broadcaster = Broadcaster(db, global_limiter, BROADCAST_CONCURRENCY)
+
+# Очередь модерации и публикации по слотам
+moderation = ModerationQueue(
+    db,
+    publish=lambda message_data, key: submit_publication(message_data, key),
+    limiter=global_limiter,
+    slot_interval=PUBLISH_SLOT_INTERVAL,
+    slot_size=PUBLISH_SLOT_SIZE
+)
+
+# Журнал отправок со сводками по дням, типам и пользователям
+audit = SubmissionLog(db, AUDIT_BATCH_SIZE, AUDIT_FLUSH_INTERVAL)
+
+# Сборщик групп медиа (альбомов)
+albums = AlbumAssembler(lambda album: process_media_group(album))
+
+async def get_bot_user_id(update: Update) -> int:
+    """Возвращает ID пользователя в боте, создавая его при необходимости"""
+    user = update.effective_user
+    return await identity.resolve(user.id, user.username)
+
+# Проверки до обработчиков: обновление, не прошедшее любую из них, дальше не идет
+pipeline = Pipeline(rejected_updates)
+
+# Команды и кнопки только для администратора; у остальных они молча отбрасываются
+ADMIN_COMMANDS = {'takedb', 'ban', 'unban', 'banlist', 'broadcast', 'queue', 'approve', 'reject', 'stats'}
+ADMIN_CALLBACK_PREFIXES = ('banlist:', 'queue:')
+# Команды, доступные заблокированным пользователям
+BANNED_COMMANDS = {'start', 'baninfo'}
+
+def is_admin(update: Update) -> bool:
+    return update.effective_user is not None and update.effective_user.id == ADMIN_ID
+
+@pipeline.add
+async def count_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Учитывает все полученные обновления, включая отсеянные"""
+    updates_total.inc()
+    return True
+
+@pipeline.add
+async def admin_only(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Не пропускает к командам администратора остальных пользователей"""
+    if is_admin(update):
+        return True
+    if update.callback_query:
+        return not (update.callback_query.data or '').startswith(ADMIN_CALLBACK_PREFIXES)
+    return command_name(update) not in ADMIN_COMMANDS
+
+@pipeline.add
+async def flood_guard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Отсекает слишком частые действия пользователя"""
+    user = update.effective_user
+    if user is None or is_admin(update):
+        return True
+    
+    media_group_id = None
+    if update.callback_query:
+        actions = ('button', 'submission') if update.callback_query.data == "confirm_send" else ('button',)
+    elif update.message:
+        actions = ('message',)
+        media_group_id = update.message.media_group_id
     else:
-        ban_until = datetime.now() + timedelta(hours=hours)
-    
-    cursor.execute(
-        "INSERT OR REPLACE INTO bans (user_id, ban_until, reason) VALUES (?, ?, ?)",
-        (user_id, ban_until.isoformat() if ban_until else None, reason)
-    )
-    conn.commit()
-    conn.close()
-
-def remove_ban(user_id: int):
-    """Снимает бан с пользователя"""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM bans WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
-
-def get_ban_list():
-    """Получает список всех активных банов"""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT b.user_id, b.ban_until, b.reason, u.tg_id, u.username 
-        FROM bans b 
-        JOIN users u ON b.user_id = u.id
-    ''')
-    bans = cursor.fetchall()
-    conn.close()
-    
-    # Фильтруем истекшие баны
-    active_bans = []
-    for ban in bans:
-        user_id, ban_until, reason, tg_id, username = ban
-        if ban_until is None:  # Вечный бан
-            active_bans.append(ban)
-        else:
-            ban_until_dt = datetime.fromisoformat(ban_until)
-            if datetime.now() <= ban_until_dt:
-                active_bans.append(ban)
-            else:
-                remove_ban(user_id)
-    
-    return active_bans
+        return True
+    
+    verdict = flood.check(user.id, actions, media_group_id)
+    if verdict == FloodControl.OK:
+        return True
+    
+    # Отказ не стоит ни одного запроса к API: ни предупреждений, ни сообщения
+    # о бане флудер не получает, причину бана он может узнать через /baninfo
+    if verdict == FloodControl.BAN:
+        user_id = await get_bot_user_id(update)
+        await bans.add(user_id, FLOOD_BAN_HOURS, "Флуд")
+        ban_actions.labels("flood").inc()
+    return False
+
+@pipeline.add
+async def ban_gate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Заблокированным пользователям доступны только /start и /baninfo"""
+    if update.effective_user is None or is_admin(update):
+        return True
+    # Только поиск: пользователь создается в /start и обработчиках, а не на входе.
+    # Без записи о пользователе нет и бана
+    user_id = await identity.lookup(update.effective_user.id)
+    if user_id is None or not bans.is_banned(user_id)[0]:
+        return True
+    return command_name(update) in BANNED_COMMANDS
+
+@pipeline.add
+async def load_user_state(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Подгружает сохраненное состояние пользователя; для отсеянных обновлений оно не читается"""
+    if update.effective_user:
+        await persistence.load_user(update.effective_user.id, context.user_data)
+    return True
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
@@ -169,10 +319,16 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message
     
     # Получаем или создаем пользователя в базе
-    user_id = get_or_create_user(user.id, user.username)
+    user_id = await get_bot_user_id(update)
+    
+    # Пользователь снова пишет боту, значит, он его не блокирует
+    await db.unblock_user(user.id)
     
-    # Сохраняем user_id в контексте для дальнейшего использования
-    context.user_data['bot_user_id'] = user_id
+    if bans.is_banned(user_id)[0]:
+        await message.reply_text(
+            "Вы заблокированы и не можете отправить сообщения. Для получения справки напишите /baninfo."
+        )
+        return
     
     # Создаем клавиатуру с кнопкой "Отправить сообщение"
     keyboard = [
@@ -191,16 +347,6 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     
     if query.data == "send_message":
-        # Проверяем, не забанен ли пользователь
-        user_id = context.user_data.get('bot_user_id')
-        if user_id:
-            banned, ban_until, reason = is_user_banned(user_id)
-            if banned:
-                await query.edit_message_text(
-                    "Вы заблокированы и не можете отправить сообщения. Для получения справки напишите /baninfo."
-                )
-                return
-        
         # Пользователь нажал "Отправить сообщение"
         keyboard = [
             [InlineKeyboardButton("Отмена", callback_data="cancel_send")]
@@ -225,103 +371,40 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data.pop('waiting_for_message', None)
         
     elif query.data == "confirm_send":
-        # Проверяем, не забанен ли пользователь
-        user_id = context.user_data.get('bot_user_id')
-        if user_id:
-            banned, ban_until, reason = is_user_banned(user_id)
-            if banned:
-                await query.edit_message_text(
-                    "Вы заблокированы и не можете отправить сообщения. Для получения справки напишите /baninfo."
-                )
-                context.user_data.pop('message_to_send', None)
-                context.user_data.pop('waiting_for_message', None)
-                return
-        
-        # Пользователь подтвердил отправку
+        # Пользователь подтвердил отправку (заблокированных отсеивает ban_gate)
+        user_id = await get_bot_user_id(update)
         message_data = context.user_data.get('message_to_send')
-        if message_data:
-            try:
-                # Отправляем сообщение в канал
-                if message_data['type'] == 'text':
-                    await context.bot.send_message(
-                        chat_id=CHANNEL_ID,
-                        text=message_data['text']
-                    )
-                elif message_data['type'] == 'single_photo':
-                    await context.bot.send_photo(
-                        chat_id=CHANNEL_ID,
-                        photo=message_data['file_id'],
-                        caption=message_data['text']
-                    )
-                elif message_data['type'] == 'single_video':
-                    await context.bot.send_video(
-                        chat_id=CHANNEL_ID,
-                        video=message_data['file_id'],
-                        caption=message_data['text']
-                    )
-                elif message_data['type'] == 'single_document':
-                    await context.bot.send_document(
-                        chat_id=CHANNEL_ID,
-                        document=message_data['file_id'],
-                        caption=message_data['text']
-                    )
-                elif message_data['type'] == 'voice':
-                    # Для голосового сначала отправляем голосовое
-                    voice_message = await context.bot.send_voice(
-                        chat_id=CHANNEL_ID,
-                        voice=message_data['file_id']
-                    )
-                    # Затем отправляем подпись в ответ на голосовое сообщение в канале
-                    if message_data['text']:
-                        await context.bot.send_message(
-                            chat_id=CHANNEL_ID,
-                            text=message_data['text'],
-                            reply_to_message_id=voice_message.message_id
-                        )
-                elif message_data['type'] == 'video_note':
-                    # Для видеосообщения сначала отправляем видеосообщение
-                    video_note_message = await context.bot.send_video_note(
-                        chat_id=CHANNEL_ID,
-                        video_note=message_data['file_id']
-                    )
-                    # Затем отправляем подпись в ответ на видеосообщение в канале
-                    if message_data['text']:
-                        await context.bot.send_message(
-                            chat_id=CHANNEL_ID,
-                            text=message_data['text'],
-                            reply_to_message_id=video_note_message.message_id
-                        )
-                elif message_data['type'] == 'media_group':
-                    # Отправляем группу медиа с подписью к первому элементу
-                    media_with_caption = message_data['media'].copy()
-                    if message_data['text']:
-                        # Создаем копию первого медиа с подписью
-                        first_media = media_with_caption[0]
-                        if isinstance(first_media, InputMediaPhoto):
-                            media_with_caption[0] = InputMediaPhoto(
-                                media=first_media.media,
-                                caption=message_data['text']
-                            )
-                        elif isinstance(first_media, InputMediaVideo):
-                            media_with_caption[0] = InputMediaVideo(
-                                media=first_media.media,
-                                caption=message_data['text']
-                            )
-                        elif isinstance(first_media, InputMediaDocument):
-                            media_with_caption[0] = InputMediaDocument(
-                                media=first_media.media,
-                                caption=message_data['text']
-                            )
-                    
-                    await context.bot.send_media_group(
-                        chat_id=CHANNEL_ID,
-                        media=media_with_caption
-                    )
-                
-                await query.edit_message_text("Сообщение успешно отправлено в канал!")
-                
-            except Exception as e:
-                await query.edit_message_text(f"Ошибка при отправке: {str(e)}")
+        if message_data and is_legacy_draft(message_data):
+            await edit_status(query, "Предпросмотр устарел. Отправьте сообщение заново.")
+        elif message_data and MODERATION:
+            # Сообщение ждет решения администратора и слота публикации
+            message_data['user_id'] = user_id
+            audit.record(user_id, message_data, 'moderation')
+            item_id = await moderation.submit(
+                update.effective_user.id, user_id, message_data,
+                query.message.chat_id, query.message.message_id,
+                status_is_caption=query.message.text is None
+            )
+            submissions.labels(message_data['type']).inc()
+            await edit_status(query, f"Сообщение №{item_id} отправлено на модерацию. Здесь появится итог.")
+        elif message_data:
+            # Ключ предпросмотра: повторное нажатие не опубликует сообщение второй раз
+            key = f"{query.message.chat_id}:{query.message.message_id}"
+            if publisher.in_progress(key):
+                return
+            # Ставим сообщение в очередь публикации с учетом лимитов Telegram
+            message_data['user_id'] = user_id
+            # Повтор после ошибки — та же отправка, в журнале и счетчиках она учитывается один раз
+            if await db.get_publication_status(key) is None:
+                audit.record(user_id, message_data, 'confirmed')
+                submissions.labels(message_data['type']).inc()
+            position = publisher.pending + 1
+            future = submit_publication(message_data, key)
+            await edit_status(query, f"Сообщение поставлено в очередь на публикацию (позиция: {position}).")
+            track_publish_report(report_publish_result(context, query, message_data, future))
+            # Черновик остается до успешной публикации, чтобы после ошибки можно было повторить
+            context.user_data.pop('waiting_for_message', None)
+            return
         
         # Очищаем данные
         context.user_data.pop('message_to_send', None)
@@ -337,29 +420,204 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data.pop('message_to_send', None)
         context.user_data.pop('waiting_for_message', None)
 
-async def send_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Отправляет сообщение с подтверждением"""
+# Классы InputMedia для элементов альбома
+INPUT_MEDIA = {
+    'photo': InputMediaPhoto,
+    'video': InputMediaVideo,
+    'document': InputMediaDocument
+}
+
+# Голосовые и видеосообщения не могут нести подпись в предпросмотре, поэтому
+# подпись идет отдельным ответом, а кнопки — отдельным сообщением
+SEPARATE_CONFIRMATION_TYPES = ('voice', 'video_note')
+
+def album_media(media: list, caption: str) -> list:
+    """InputMedia для send_media_group из пар (тип, file_id); подпись — у первого элемента"""
+    return [
+        INPUT_MEDIA[kind](media=file_id, caption=caption if index == 0 and caption else None)
+        for index, (kind, file_id) in enumerate(media)
+    ]
+
+async def deliver_message(bot, chat_id, message_data: dict, reply_markup=None):
+    """Отправляет сообщение пользователя в чат: в канал или автору как предпросмотр.
+    
+    Одиночные медиа не отправляются заново, а копируются из чата автора
+    с новой подписью. Возвращает ID сообщения с кнопками reply_markup
+    или None, если к сообщению такого типа кнопки не прикрепляются.
+    """
+    text = message_data['text']
+    if message_data['type'] == 'text':
+        message = await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+        return message.message_id
+    
+    if message_data['type'] == 'media_group':
+        # copyMessages не умеет менять подпись, поэтому альбом собирается из file_id
+        await bot.send_media_group(chat_id=chat_id, media=album_media(message_data['media'], text))
+        return None
+    
+    if message_data['type'] in SEPARATE_CONFIRMATION_TYPES:
+        # Сначала копируем голосовое или видеосообщение (пустая подпись убирает исходную)
+        copied = await bot.copy_message(
+            chat_id=chat_id,
+            from_chat_id=message_data['chat_id'],
+            message_id=message_data['message_id'],
+            caption='' if message_data['type'] == 'voice' else None
+        )
+        # Затем отправляем подпись в ответ на него
+        if text.strip():
+            await bot.send_message(
+                chat_id=chat_id,
+                text=text,
+                reply_to_message_id=copied.message_id
+            )
+        return None
+    
+    copied = await bot.copy_message(
+        chat_id=chat_id,
+        from_chat_id=message_data['chat_id'],
+        message_id=message_data['message_id'],
+        caption=text,
+        reply_markup=reply_markup
+    )
+    return copied.message_id
+
+async def publish_message(bot, message_data: dict):
+    """Отправляет сообщение в канал"""
+    await deliver_message(bot, CHANNEL_ID, message_data)
+
+async def publication_done(message_data: dict, error: Exception = None):
+    """Записывает итог публикации в журнал и запоминает опубликованное для отсева повторов"""
+    if error is not None:
+        audit.record(message_data.get('user_id'), message_data, 'failed')
+        return
+    audit.record(message_data.get('user_id'), message_data, 'published')
+    await dedup.add(message_data.get('dedup') or [])
+
+def submit_publication(message_data: dict, key: str) -> asyncio.Future:
+    """Ставит сообщение в очередь публикаций с ключом идемпотентности key"""
+    return publisher.submit(
+        lambda bot: publish_message(bot, message_data),
+        cost=publish_cost(message_data),
+        key=key,
+        done=lambda error: publication_done(message_data, error)
+    )
+
+def is_legacy_draft(message_data: dict) -> bool:
+    """Неподтвержденное сообщение, сохраненное до перехода на копирование (с file_id и InputMedia)"""
+    if 'file_id' in message_data:
+        return True
+    return message_data['type'] == 'media_group' and not isinstance(message_data['media'][0], tuple)
+
+def publish_cost(message_data: dict) -> int:
+    """Количество сообщений, которое займет публикация в канале"""
+    if message_data['type'] == 'media_group':
+        return len(message_data['media'])
+    if message_data['type'] in ('voice', 'video_note') and message_data['text']:
+        return 2
+    return 1
+
+# Задачи, сообщающие авторам итог публикации; при остановке их дожидаются
+publish_reports = set()
+
+def track_publish_report(coroutine):
+    task = asyncio.ensure_future(coroutine)
+    publish_reports.add(task)
+    task.add_done_callback(publish_reports.discard)
+
+async def report_publish_result(context: ContextTypes.DEFAULT_TYPE, query, message_data: dict, future: asyncio.Future):
+    """Сообщает пользователю итог публикации из очереди"""
+    started = time.perf_counter()
+    try:
+        await future
+    except PublishUnavailable:
+        published_unavailable.inc()
+        await edit_status(
+            query, "Канал сейчас недоступен, сообщение не опубликовано. Нажмите «Отправить» позже.",
+            confirmation_markup()
+        )
+    except PublishCancelled:
+        await edit_status(
+            query, "Бот перезапускается, сообщение не опубликовано. Нажмите «Отправить» через минуту.",
+            confirmation_markup()
+        )
+    except PublishUncertain:
+        published_uncertain.inc()
+        # Пост мог выйти, поэтому кнопки повтора не показываем, а черновик больше не нужен
+        if context.user_data.get('message_to_send') is message_data:
+            context.user_data.pop('message_to_send')
+            context.application.mark_data_for_update_persistence(user_ids=query.from_user.id)
+        await edit_status(
+            query, "Не удалось узнать, вышло ли сообщение: Telegram не ответил. Повторно оно не отправлялось — "
+            "проверьте канал и, если сообщения там нет, отправьте его заново."
+        )
+    except Exception as e:
+        published_error.inc()
+        await edit_status(
+            query, f"Ошибка при отправке: {str(e)}\nМожно попробовать еще раз.", confirmation_markup()
+        )
+    else:
+        published_ok.inc()
+        publish_latency.observe(time.perf_counter() - started)
+        # Черновик удаляется, только если пользователь не начал новый
+        if context.user_data.get('message_to_send') is message_data:
+            context.user_data.pop('message_to_send')
+            context.application.mark_data_for_update_persistence(user_ids=query.from_user.id)
+        await edit_status(query, "Сообщение успешно отправлено в канал!")
+
+async def edit_status(query, text: str, reply_markup: InlineKeyboardMarkup = None):
+    """Показывает статус отправки вместо сообщения с кнопками подтверждения"""
+    # При быстром предпросмотре кнопки могут быть под медиа, у которого есть только подпись
+    if query.message is not None and query.message.text is None:
+        await query.edit_message_caption(caption=text, reply_markup=reply_markup)
+    else:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+
+def confirmation_markup() -> InlineKeyboardMarkup:
+    """Кнопки подтверждения отправки"""
     keyboard = [
         [
             InlineKeyboardButton("Отправить", callback_data="confirm_send"),
             InlineKeyboardButton("Отмена", callback_data="cancel_confirm")
         ]
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    confirmation_message = await context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text="Подтвердите отправку",
-        reply_markup=reply_markup
+    return InlineKeyboardMarkup(keyboard)
+
+def remember_confirmation(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int):
+    """Сохраняет ID сообщения с подтверждением (без таймера)"""
+    context.user_data['confirmation_message_id'] = message_id
+    context.user_data['confirmation_chat_id'] = chat_id
+
+async def send_preview(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_data: dict):
+    """Отправляет пользователю предпросмотр сообщения вместе с подтверждением"""
+    attach = (
+        FAST_PREVIEW
+        and message_data['type'] != 'media_group'
+        and message_data['type'] not in SEPARATE_CONFIRMATION_TYPES
     )
-    
-    # Сохраняем ID сообщения с подтверждением (без таймера)
-    context.user_data['confirmation_message_id'] = confirmation_message.message_id
-    context.user_data['confirmation_chat_id'] = confirmation_message.chat_id
+    message_id = await deliver_message(
+        context.bot, chat_id, message_data,
+        reply_markup=confirmation_markup() if attach else None
+    )
+    if attach:
+        remember_confirmation(context, chat_id, message_id)
+    else:
+        await send_confirmation_from_context(context, chat_id)
+
+async def reject_duplicate(context: ContextTypes.DEFAULT_TYPE, chat_id: int, keys: list) -> bool:
+    """Отвечает автору и возвращает True, если такое содержимое недавно публиковалось"""
+    if not await dedup.seen(keys):
+        return False
+    duplicates_rejected.inc()
+    context.user_data.pop('message_to_send', None)
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text="Это уже публиковалось в канале недавно. Отправьте другое сообщение."
+    )
+    return True
 
 async def handle_single_media(update: Update, context: ContextTypes.DEFAULT_TYPE, message_data: dict):
     """Обработка одиночного медиа"""
-    user_id = context.user_data.get('bot_user_id')
+    user_id = await get_bot_user_id(update)
     footer_text = f"\n\n@Pod1699 | Сообщение отправлено пользователем [ID: {user_id}]"
     
     caption = update.message.caption if update.message.caption else ""
@@ -369,238 +627,98 @@ async def handle_single_media(update: Update, context: ContextTypes.DEFAULT_TYPE
         'text': final_text
     })
     
-    # Отправляем предпросмотр пользователю
-    if message_data['type'] == 'single_photo':
-        await update.message.reply_photo(
-            photo=message_data['file_id'],
-            caption=final_text
-        )
-    elif message_data['type'] == 'single_video':
-        await update.message.reply_video(
-            video=message_data['file_id'],
-            caption=final_text
-        )
-    elif message_data['type'] == 'single_document':
-        await update.message.reply_document(
-            document=message_data['file_id'],
-            caption=final_text
-        )
-    elif message_data['type'] == 'voice':
-        # Для голосового отправляем сначала голосовое
-        voice_message = await update.message.reply_voice(
-            voice=message_data['file_id']
-        )
-        # Затем отправляем подпись в ответ на голосовое сообщение
-        if final_text.strip():
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=final_text,
-                reply_to_message_id=voice_message.message_id
-            )
-    elif message_data['type'] == 'video_note':
-        # Для видеосообщения отправляем сначала видеосообщение
-        video_note_message = await update.message.reply_video_note(
-            video_note=message_data['file_id']
-        )
-        # Затем отправляем подпись в ответ на видеосообщение
-        if final_text.strip():
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=final_text,
-                reply_to_message_id=video_note_message.message_id
-            )
+    await send_preview(context, update.effective_chat.id, message_data)
 
-async def process_media_group(media_group_id: str, context: ContextTypes.DEFAULT_TYPE):
+async def process_media_group(album: Album):
     """Обрабатывает собранную группу медиа"""
-    if media_group_id not in media_groups:
+    try:
+        await prepare_album_draft(album)
+    finally:
+        # Альбом обрабатывается вне обновления, а PTB сохраняет user_data
+        # только отмеченных пользователей: без отметки черновик не переживет перезапуск
+        album.context.application.mark_data_for_update_persistence(user_ids=album.user_tg_id)
+
+async def prepare_album_draft(album: Album):
+    """Проверяет альбом на повтор, сохраняет черновик и отправляет предпросмотр"""
+    context = album.context
+    footer_text = f"\n\n@Pod1699 | Сообщение отправлено пользователем [ID: {album.user_id}]"
+    
+    # Подпись берем из первого сообщения с подписью, иначе добавляем только footer
+    caption = album.caption + footer_text if album.caption else footer_text.strip()
+    
+    # Альбом отклоняется, если в канале уже был любой из его файлов
+    keys = [media_key(unique_id) for unique_id in album.seen]
+    if await reject_duplicate(context, album.chat_id, keys):
+        audit.record(album.user_id, {'type': 'media_group', 'media': album.media}, 'duplicate')
         return
     
-    group_data = media_groups[media_group_id]
-    
-    # Проверяем, что у нас есть хотя бы 2 медиа для группы
-    if len(group_data['media']) < 2:
+    # Элементы альбома: (тип, file_id, ID сообщения в чате автора)
+    if len(album.media) < 2:
         # Если только одно медиа, обрабатываем как одиночное
-        if group_data['media']:
-            first_media = group_data['media'][0]
-            if isinstance(first_media, InputMediaPhoto):
-                context.user_data['message_to_send'] = {
-                    'type': 'single_photo',
-                    'file_id': first_media.media,
-                    'text': group_data['caption']
-                }
-                # Отправляем предпросмотр одиночного фото
-                await context.bot.send_photo(
-                    chat_id=group_data['chat_id'],
-                    photo=first_media.media,
-                    caption=group_data['caption']
-                )
-            elif isinstance(first_media, InputMediaVideo):
-                context.user_data['message_to_send'] = {
-                    'type': 'single_video',
-                    'file_id': first_media.media,
-                    'text': group_data['caption']
-                }
-                # Отправляем предпросмотр одиночного видео
-                await context.bot.send_video(
-                    chat_id=group_data['chat_id'],
-                    video=first_media.media,
-                    caption=group_data['caption']
-                )
-            elif isinstance(first_media, InputMediaDocument):
-                context.user_data['message_to_send'] = {
-                    'type': 'single_document',
-                    'file_id': first_media.media,
-                    'text': group_data['caption']
-                }
-                # Отправляем предпросмотр одиночного документа
-                await context.bot.send_document(
-                    chat_id=group_data['chat_id'],
-                    document=first_media.media,
-                    caption=group_data['caption']
-                )
-        del media_groups[media_group_id]
-        return
-    
-    # Подготавливаем данные для отправки группы медиа
+        if album.media:
+            kind, _, message_id = album.media[0]
+            context.user_data['message_to_send'] = {
+                'type': 'single_' + kind,
+                'chat_id': album.chat_id,
+                'message_id': message_id,
+                'text': caption,
+                'dedup': keys
+            }
+            await send_preview(context, album.chat_id, context.user_data['message_to_send'])
+        return
+    
+    # Для публикации достаточно типов и file_id элементов
     context.user_data['message_to_send'] = {
         'type': 'media_group',
-        'media': group_data['media'],
-        'text': group_data['caption']
+        'media': [(kind, file_id) for kind, file_id, _ in album.media],
+        'text': caption,
+        'dedup': keys
     }
     
-    # Отправляем предпросмотр пользователю
+    # Отправляем предпросмотр и подтверждение пользователю
     try:
-        # Создаем копию медиа с подписью для предпросмотра
-        preview_media = group_data['media'].copy()
-        if group_data['caption'] and preview_media:
-            first_media = preview_media[0]
-            if isinstance(first_media, InputMediaPhoto):
-                preview_media[0] = InputMediaPhoto(
-                    media=first_media.media,
-                    caption=group_data['caption']
-                )
-            elif isinstance(first_media, InputMediaVideo):
-                preview_media[0] = InputMediaVideo(
-                    media=first_media.media,
-                    caption=group_data['caption']
-                )
-            elif isinstance(first_media, InputMediaDocument):
-                preview_media[0] = InputMediaDocument(
-                    media=first_media.media,
-                    caption=group_data['caption']
-                )
-        
-        preview_messages = await context.bot.send_media_group(
-            chat_id=group_data['chat_id'],
-            media=preview_media
-        )
-        
-        # Отправляем сообщение с подтверждением
-        await send_confirmation_from_context(context, group_data['chat_id'])
-        
+        await send_preview(context, album.chat_id, context.user_data['message_to_send'])
     except Exception as e:
         await context.bot.send_message(
-            chat_id=group_data['chat_id'],
+            chat_id=album.chat_id,
             text=f"Ошибка при создании предпросмотра: {str(e)}"
         )
-    
-    # Удаляем группу из временного хранилища
-    del media_groups[media_group_id]
 
 async def send_confirmation_from_context(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
-    """Отправляет подтверждение из контекста"""
-    keyboard = [
-        [
-            InlineKeyboardButton("Отправить", callback_data="confirm_send"),
-            InlineKeyboardButton("Отмена", callback_data="cancel_confirm")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
+    """Отправляет подтверждение отдельным сообщением"""
     confirmation_message = await context.bot.send_message(
         chat_id=chat_id,
         text="Подтвердите отправку сообщения",
-        reply_markup=reply_markup
+        reply_markup=confirmation_markup()
     )
-    
-    # Сохраняем ID сообщения с подтверждением (без таймера)
-    context.user_data['confirmation_message_id'] = confirmation_message.message_id
-    context.user_data['confirmation_chat_id'] = confirmation_message.chat_id
+    remember_confirmation(context, chat_id, confirmation_message.message_id)
 
 async def handle_media_group(update: Update, context: ContextTypes.DEFAULT_TYPE, media_group_id: str):
     """Обработка группы медиа"""
-    user_id = context.user_data.get('bot_user_id')
-    footer_text = f"\n\n@Pod1699 | Сообщение отправлено пользователем [ID: {user_id}]"
-    
-    # Инициализируем группу, если ее еще нет
-    if media_group_id not in media_groups:
-        media_groups[media_group_id] = {
-            'media': [],
-            'caption': '',
-            'user_id': user_id,
-            'chat_id': update.message.chat_id,
-            'last_update': asyncio.get_event_loop().time(),
-            'task': None
-        }
-    
-    # Обновляем время последнего обновления
-    media_groups[media_group_id]['last_update'] = asyncio.get_event_loop().time()
-    
-    # Добавляем медиа в группу
-    if update.message.photo:
-        photo = update.message.photo[-1]
-        # Проверяем, нет ли уже этого медиа в группе
-        media_exists = any(
-            isinstance(media, InputMediaPhoto) and media.media == photo.file_id 
-            for media in media_groups[media_group_id]['media']
-        )
-        if not media_exists:
-            media_groups[media_group_id]['media'].append(
-                InputMediaPhoto(media=photo.file_id)
-            )
-    elif update.message.video:
-        # Проверяем, нет ли уже этого медиа в группе
-        media_exists = any(
-            isinstance(media, InputMediaVideo) and media.media == update.message.video.file_id 
-            for media in media_groups[media_group_id]['media']
-        )
-        if not media_exists:
-            media_groups[media_group_id]['media'].append(
-                InputMediaVideo(media=update.message.video.file_id)
-            )
-    elif update.message.document:
-        # Проверяем, нет ли уже этого медиа в группе
-        media_exists = any(
-            isinstance(media, InputMediaDocument) and media.media == update.message.document.file_id 
-            for media in media_groups[media_group_id]['media']
-        )
-        if not media_exists:
-            media_groups[media_group_id]['media'].append(
-                InputMediaDocument(media=update.message.document.file_id)
-            )
-    
-    # Сохраняем подпись (берем из первого сообщения с подписью)
-    if update.message.caption and not media_groups[media_group_id]['caption']:
-        media_groups[media_group_id]['caption'] = update.message.caption + footer_text
-    
-    # Если подписи нет, но есть медиа, добавляем только footer
-    if not media_groups[media_group_id]['caption'] and media_groups[media_group_id]['media']:
-        media_groups[media_group_id]['caption'] = footer_text.strip()
+    user_id = await get_bot_user_id(update)
+    message = update.message
     
-    # Отменяем предыдущую задачу обработки, если она есть
-    if media_groups[media_group_id]['task']:
-        media_groups[media_group_id]['task'].cancel()
+    # Добавляем медиа в группу, повторы отсекаются по file_unique_id
+    if message.photo:
+        kind, attachment = 'photo', message.photo[-1]
+    elif message.video:
+        kind, attachment = 'video', message.video
+    elif message.document:
+        kind, attachment = 'document', message.document
+    else:
+        return
     
-    # Создаем новую задачу для обработки группы через 1.5 секунды
-    media_groups[media_group_id]['task'] = asyncio.create_task(
-        delayed_process_media_group(media_group_id, context, 1.5)
+    albums.add(
+        media_group_id,
+        chat_id=message.chat_id,
+        user_id=user_id,
+        user_tg_id=update.effective_user.id,
+        context=context,
+        unique_id=attachment.file_unique_id,
+        media=(kind, attachment.file_id, message.message_id),
+        caption=message.caption
     )
 
-async def delayed_process_media_group(media_group_id: str, context: ContextTypes.DEFAULT_TYPE, delay: float):
-    """Отложенная обработка группы медиа"""
-    await asyncio.sleep(delay)
-    await process_media_group(media_group_id, context)
-
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик сообщений от пользователя"""
     if not context.user_data.get('waiting_for_message'):
@@ -616,173 +734,273 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Обрабатываем одиночные сообщения
     if message.text:
-        # Текстовое сообщение
-        user_id = context.user_data.get('bot_user_id')
+        # Текстовое сообщение; повтор ищется по тексту без подписи бота
+        key = text_key(message.text)
+        keys = [key] if key is not None else []
+        user_id = await get_bot_user_id(update)
+        if await reject_duplicate(context, message.chat_id, keys):
+            audit.record(user_id, {'type': 'text'}, 'duplicate')
+            return
         footer_text = f"\n\n@Pod1699 | Сообщение отправлено пользователем [ID: {user_id}]"
         
         final_text = message.text + footer_text
         context.user_data['message_to_send'] = {
             'type': 'text',
-            'text': final_text
+            'text': final_text,
+            'dedup': keys
         }
         
         # Отправляем предпросмотр пользователю
-        await message.reply_text(final_text)
-        
-    elif message.photo:
+        await send_preview(context, message.chat_id, context.user_data['message_to_send'])
+        return
+    
+    if message.photo:
         # Одиночное фото
-        photo = message.photo[-1]
-        context.user_data['message_to_send'] = {
-            'type': 'single_photo',
-            'file_id': photo.file_id
-        }
-        await handle_single_media(update, context, context.user_data['message_to_send'])
-        
+        media_type, attachment = 'single_photo', message.photo[-1]
     elif message.video:
         # Одиночное видео
-        context.user_data['message_to_send'] = {
-            'type': 'single_video',
-            'file_id': message.video.file_id
-        }
-        await handle_single_media(update, context, context.user_data['message_to_send'])
-        
+        media_type, attachment = 'single_video', message.video
     elif message.document:
         # Файл (документ)
-        context.user_data['message_to_send'] = {
-            'type': 'single_document',
-            'file_id': message.document.file_id
-        }
-        await handle_single_media(update, context, context.user_data['message_to_send'])
-        
+        media_type, attachment = 'single_document', message.document
     elif message.voice:
         # Голосовое сообщение
-        context.user_data['message_to_send'] = {
-            'type': 'voice',
-            'file_id': message.voice.file_id
-        }
-        await handle_single_media(update, context, context.user_data['message_to_send'])
-        
+        media_type, attachment = 'voice', message.voice
     elif message.video_note:
         # Видеосообщение (кружок)
-        context.user_data['message_to_send'] = {
-            'type': 'video_note',
-            'file_id': message.video_note.file_id
-        }
-        await handle_single_media(update, context, context.user_data['message_to_send'])
+        media_type, attachment = 'video_note', message.video_note
+    else:
+        return
     
-    # Для ВСЕХ типов сообщений отправляем подтверждение после предпросмотра
-    if not message.media_group_id:
-        # Ждем немного чтобы предпросмотр успел отправиться
-        await asyncio.sleep(0.5)
-        await send_confirmation(update, context)
+    # Повтор ищется по самому файлу, подпись не учитывается
+    keys = [media_key(attachment.file_unique_id)]
+    if await reject_duplicate(context, message.chat_id, keys):
+        audit.record(await get_bot_user_id(update), {'type': media_type}, 'duplicate')
+        return
+    
+    # Медиа не сохраняем: при публикации исходное сообщение копируется из чата
+    context.user_data['message_to_send'] = {
+        'type': media_type,
+        'chat_id': message.chat_id,
+        'message_id': message.message_id,
+        'dedup': keys
+    }
+    await handle_single_media(update, context, context.user_data['message_to_send'])
 
 # Команды для банов
+BAN_USAGE = (
+    "Использование: /ban [ID через запятую или диапазоны 10-20] [время в часах или x для вечного бана] [причина]\n"
+    "ID перечисляются без пробелов (5,7,10-20); причина не может начинаться с числа.\n"
+    "Или отправьте CSV-файл (ID, часы, причина) с подписью /ban [часы] [причина]"
+)
+UNBAN_USAGE = (
+    "Использование: /unban [ID через запятую или диапазоны 10-20]\n"
+    "ID перечисляются без пробелов (5,7,10-20).\n"
+    "Или отправьте CSV-файл с ID в первом столбце с подписью /unban"
+)
+
+def parse_hours(value: str) -> float:
+    """Срок бана в часах; x — вечный бан"""
+    value = value.strip().lower()
+    return float('inf') if value == 'x' else float(value)
+
+def looks_like_ids(value: str) -> bool:
+    """Похож ли аргумент на список ID (тогда его нельзя принять за часы или причину)"""
+    try:
+        parse_ids([value])
+    except ValueError:
+        return False
+    return True
+
+def format_id_list(ids: list, limit: int = 20) -> str:
+    """Первые limit ID через запятую"""
+    text = ", ".join(str(user_id) for user_id in ids[:limit])
+    return text + (f" и еще {len(ids) - limit}" if len(ids) > limit else "")
+
+def ban_time_text(hours: float) -> str:
+    return "Вечная" if hours == float('inf') else f"{hours} часов"
+
+async def apply_bans(entries: dict) -> tuple:
+    """Банит существующих пользователей из {user_id: (часы, причина)} одной транзакцией.
+
+    Возвращает (число заблокированных, ненайденные ID).
+    """
+    found = await state.existing_user_ids(list(entries))
+    await bans.add_many([(user_id, hours, reason) for user_id, (hours, reason) in entries.items() if user_id in found])
+    ban_actions.labels("ban").inc(len(found))
+    return len(found), sorted(set(entries) - found)
+
+async def apply_unbans(user_ids: list) -> tuple:
+    """Снимает баны одной транзакцией. Возвращает (снятые, ненайденные ID, незаблокированные ID)"""
+    found = await state.existing_user_ids(user_ids)
+    banned = [user_id for user_id in user_ids if user_id in found and bans.is_banned(user_id)[0]]
+    if banned:
+        await bans.remove_many(banned)
+        ban_actions.labels("unban").inc(len(banned))
+    not_banned = sorted(found - set(banned))
+    return banned, sorted(set(user_ids) - found), not_banned
+
+def bulk_ban_report(count: int, missing: list, hours: float = None, reason: str = None) -> str:
+    lines = [f"Заблокировано пользователей: {count}."]
+    if hours is not None:
+        lines.append(f"Время: {ban_time_text(hours)}")
+        lines.append(f"Причина: {reason if reason else 'Не указана'}")
+    if missing:
+        lines.append(f"Не найдены ({len(missing)}): {format_id_list(missing)}")
+    return "\n".join(lines)
+
+def bulk_unban_report(unbanned: list, missing: list, not_banned: list) -> str:
+    lines = [f"Разблокировано пользователей: {len(unbanned)}."]
+    if not_banned:
+        lines.append(f"Не были заблокированы ({len(not_banned)}): {format_id_list(not_banned)}")
+    if missing:
+        lines.append(f"Не найдены ({len(missing)}): {format_id_list(missing)}")
+    return "\n".join(lines)
+
 async def ban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда /ban для блокировки пользователя"""
-    user = update.effective_user
-    
-    # Проверяем, является ли пользователь администратором
-    if user.id != ADMIN_ID:
-        return  # Игнорируем команду от не-админа
-    
-    if not context.args:
-        await update.message.reply_text("Использование: /ban [ID пользователя] [время в часах или x для вечного бана] [причина]")
+    """Команда /ban для блокировки одного пользователя или списка"""
+    if len(context.args) < 2:
+        await update.message.reply_text(BAN_USAGE)
         return
     
-    if len(context.args) < 2:
-        await update.message.reply_text("Использование: /ban [ID пользователя] [время в часах или x для вечного бана] [причина]")
+    # "/ban 5 6 7 24" нельзя понять однозначно: это может быть и ID 5 на 6 часов
+    # с причиной "7 24", и ID 5, 6, 7 на 24 часа. Такие команды отклоняем
+    if len(context.args) > 2 and looks_like_ids(context.args[2]):
+        await update.message.reply_text("Ошибка: перечислите ID через запятую без пробелов.\n" + BAN_USAGE)
         return
     
     try:
-        user_id = int(context.args[0])
-        time_arg = context.args[1].lower()
-        
-        if time_arg == 'x':
-            hours = float('inf')  # Вечный бан
-        else:
-            hours = float(time_arg)
-        
-        # Получаем причину (все оставшиеся аргументы)
-        reason = ' '.join(context.args[2:]) if len(context.args) > 2 else None
-        
-        # Проверяем существование пользователя
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute("SELECT id FROM users WHERE id = ?", (user_id,))
-        user_exists = cursor.fetchone()
-        conn.close()
-        
-        if not user_exists:
-            await update.message.reply_text(f"Пользователь с ID {user_id} не найден.")
-            return
-        
-        # Добавляем бан
-        add_ban(user_id, hours, reason)
-        
-        if hours == float('inf'):
-            time_text = "Вечная"
-        else:
-            time_text = f"{hours} часов"
-        
-        reason_text = reason if reason else "Не указана"
-        
+        user_ids = parse_ids(context.args[:1], BULK_BAN_LIMIT)
+        hours = parse_hours(context.args[1])
+    except ValueError:
+        user_ids = None
+    if user_ids is None:
         await update.message.reply_text(
-            f"Пользователь [ID: {user_id}] заблокирован.\n"
-            f"Время: {time_text}\n"
-            f"Причина: {reason_text}"
+            "Ошибка: ID пользователей — числа или диапазоны (не больше "
+            f"{BULK_BAN_LIMIT}), а время — число или 'x' для вечного бана."
+        )
+        return
+    
+    # Получаем причину (все оставшиеся аргументы)
+    reason = ' '.join(context.args[2:]) if len(context.args) > 2 else None
+    
+    count, missing = await apply_bans({user_id: (hours, reason) for user_id in user_ids})
+    
+    if len(user_ids) > 1:
+        await update.message.reply_text(bulk_ban_report(count, missing, hours, reason))
+    elif missing:
+        await update.message.reply_text(f"Пользователь с ID {user_ids[0]} не найден.")
+    else:
+        await update.message.reply_text(
+            f"Пользователь [ID: {user_ids[0]}] заблокирован.\n"
+            f"Время: {ban_time_text(hours)}\n"
+            f"Причина: {reason if reason else 'Не указана'}"
         )
-        
-    except ValueError:
-        await update.message.reply_text("Ошибка: ID пользователя должен быть числом, а время - числом или 'x' для вечного бана.")
 
 async def unban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда /unban для разблокировки пользователя"""
-    user = update.effective_user
+    """Команда /unban для разблокировки одного пользователя или списка"""
+    if not context.args:
+        await update.message.reply_text(UNBAN_USAGE)
+        return
+    if len(context.args) > 1:
+        # Тот же синтаксис, что у /ban: список ID — один аргумент
+        await update.message.reply_text("Ошибка: перечислите ID через запятую без пробелов.\n" + UNBAN_USAGE)
+        return
     
-    # Проверяем, является ли пользователь администратором
-    if user.id != ADMIN_ID:
-        return  # Игнорируем команду от не-админа
+    try:
+        user_ids = parse_ids(context.args, BULK_BAN_LIMIT)
+    except ValueError:
+        user_ids = None
+    if user_ids is None:
+        await update.message.reply_text(
+            f"Ошибка: ID пользователей — числа или диапазоны (не больше {BULK_BAN_LIMIT})."
+        )
+        return
+    
+    unbanned, missing, not_banned = await apply_unbans(user_ids)
+    
+    if len(user_ids) > 1:
+        await update.message.reply_text(bulk_unban_report(unbanned, missing, not_banned))
+    elif missing:
+        await update.message.reply_text(f"Пользователь с ID {user_ids[0]} не найден.")
+    elif not_banned:
+        await update.message.reply_text(f"Пользователь [ID: {user_ids[0]}] не заблокирован.")
+    else:
+        await update.message.reply_text(f"Пользователь [ID: {user_ids[0]}] разблокирован.")
+
+def parse_ban_csv(text: str, default_hours: float = None, default_reason: str = None) -> tuple:
+    """Строки CSV "ID[,часы[,причина]]" -> ({user_id: (часы, причина)}, номера ошибочных строк).
+
+    Пустые часы и причина берутся из подписи к файлу; строка-заголовок пропускается.
+    """
+    entries = {}
+    errors = []
+    for line_number, row in enumerate(csv.reader(io.StringIO(text)), 1):
+        if not row or not row[0].strip():
+            continue
+        try:
+            user_id = int(row[0])
+            hours = parse_hours(row[1]) if len(row) > 1 and row[1].strip() else default_hours
+        except ValueError:
+            if line_number > 1:
+                errors.append(line_number)
+            continue
+        if hours is None:
+            errors.append(line_number)
+            continue
+        reason = row[2].strip() if len(row) > 2 and row[2].strip() else default_reason
+        entries[user_id] = (hours, reason)
+        if len(entries) > BULK_BAN_LIMIT:
+            raise ValueError(line_number)
+    return entries, errors
+
+async def ban_import(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """CSV-файл с подписью /ban или /unban: массовая блокировка или разблокировка"""
+    message = update.message
+    args = message.caption.split()
+    command = args[0][1:].split('@')[0].lower()
     
-    if not context.args or len(context.args) != 1:
-        await update.message.reply_text("Использование: /unban [ID пользователя]")
+    if message.document.file_size and message.document.file_size > BAN_IMPORT_MAX_SIZE:
+        await message.reply_text(f"Файл больше {BAN_IMPORT_MAX_SIZE // 1024} КБ.")
+        return
+    file = await message.document.get_file()
+    try:
+        text = (await file.download_as_bytearray()).decode('utf-8-sig')
+    except UnicodeDecodeError:
+        await message.reply_text("Файл должен быть в кодировке UTF-8.")
         return
     
     try:
-        user_id = int(context.args[0])
-        
-        # Проверяем существование пользователя
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute("SELECT id FROM users WHERE id = ?", (user_id,))
-        user_exists = cursor.fetchone()
-        conn.close()
-        
-        if not user_exists:
-            await update.message.reply_text(f"Пользователь с ID {user_id} не найден.")
-            return
-        
-        # Проверяем, забанен ли пользователь
-        banned, _, _ = is_user_banned(user_id)
-        if not banned:
-            await update.message.reply_text(f"Пользователь [ID: {user_id}] не заблокирован.")
-            return
-        
-        # Снимаем бан
-        remove_ban(user_id)
-        await update.message.reply_text(f"Пользователь [ID: {user_id}] разблокирован.")
-        
+        default_hours = parse_hours(args[1]) if command == 'ban' and len(args) > 1 else None
+        entries, errors = parse_ban_csv(
+            text, default_hours if command == 'ban' else 0, ' '.join(args[2:]) or None
+        )
     except ValueError:
-        await update.message.reply_text("Ошибка: ID пользователя должен быть числом.")
+        await message.reply_text(f"Ошибка: в файле больше {BULK_BAN_LIMIT} ID или неверный срок в подписи.\n{BAN_USAGE}")
+        return
+    
+    if not entries:
+        await message.reply_text("В файле нет ID пользователей.\n" + (BAN_USAGE if command == 'ban' else UNBAN_USAGE))
+        return
+    
+    if command == 'ban':
+        count, missing = await apply_bans(entries)
+        report = bulk_ban_report(count, missing)
+    else:
+        report = bulk_unban_report(*await apply_unbans(sorted(entries)))
+    if errors:
+        report += f"\nПропущены строки ({len(errors)}): {format_id_list(errors)}"
+    await message.reply_text(report)
 
 async def baninfo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /baninfo для проверки статуса блокировки"""
     user = update.effective_user
     
     # Получаем ID пользователя в боте
-    user_id = get_or_create_user(user.id, user.username)
+    user_id = await get_bot_user_id(update)
     
     # Проверяем бан
-    banned, ban_until, reason = is_user_banned(user_id)
+    banned, ban_until, reason = bans.is_banned(user_id)
     
     if not banned:
         await update.message.reply_text("Вы не заблокированы.")
@@ -808,29 +1026,21 @@ async def baninfo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Причина: {reason_text}"
     )
 
-async def banlist_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда /banlist для просмотра списка заблокированных"""
-    user = update.effective_user
-    
-    # Проверяем, является ли пользователь администратором
-    if user.id != ADMIN_ID:
-        return  # Игнорируем команду от не-админа
+async def build_banlist_page(after_id: int = None, before_id: int = None):
+    """Формирует страницу списка блокировок. Возвращает (текст, клавиатура) или (None, None)"""
+    ban_list, has_more = await state.get_ban_page(after_id, before_id, BANLIST_PAGE_SIZE)
     
-    bans = get_ban_list()
-    
-    if not bans:
-        await update.message.reply_text("Нет активных блокировок.")
-        return
+    if not ban_list:
+        return None, None
     
     ban_list_text = ""
-    for i, ban in enumerate(bans):
-        user_id, ban_until, reason, tg_id, username = ban
+    for i, ban in enumerate(ban_list):
+        user_id, ban_until, reason = ban
         
         if ban_until is None:
             time_text = "Бессрочно"
         else:
-            ban_until_dt = datetime.fromisoformat(ban_until)
-            time_left = ban_until_dt - datetime.now()
+            time_left = datetime.fromtimestamp(ban_until) - datetime.now()
             hours_left = int(time_left.total_seconds() / 3600)
             time_text = f"{hours_left} часов"
         
@@ -838,58 +1048,537 @@ async def banlist_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         ban_list_text += f"{user_id}\n{time_text}\n{reason_text}"
         
-        if i < len(bans) - 1:
+        if i < len(ban_list) - 1:
             ban_list_text += "\n\n"
     
-    await update.message.reply_text(ban_list_text)
+    # При движении назад has_more говорит о предыдущих страницах, вперед — о следующих
+    if before_id is not None:
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = after_id is not None, has_more
+    
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton("⟵", callback_data=f"banlist:prev:{ban_list[0][0]}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("⟶", callback_data=f"banlist:next:{ban_list[-1][0]}"))
+    reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+    
+    return ban_list_text, reply_markup
+
+async def banlist_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /banlist для просмотра списка заблокированных"""
+    ban_list_text, reply_markup = await build_banlist_page()
+    
+    if not ban_list_text:
+        await update.message.reply_text("Нет активных блокировок.")
+        return
+    
+    await update.message.reply_text(ban_list_text, reply_markup=reply_markup)
+
+async def banlist_page_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Переключение страниц списка блокировок"""
+    query = update.callback_query
+    
+    _, direction, user_id = query.data.split(":")
+    if direction == "next":
+        ban_list_text, reply_markup = await build_banlist_page(after_id=int(user_id))
+    else:
+        ban_list_text, reply_markup = await build_banlist_page(before_id=int(user_id))
+    
+    await query.answer()
+    if not ban_list_text:
+        # Все блокировки на этой странице успели истечь или были сняты
+        ban_list_text, reply_markup = await build_banlist_page()
+    if not ban_list_text:
+        await query.edit_message_text("Нет активных блокировок.")
+        return
+    await query.edit_message_text(ban_list_text, reply_markup=reply_markup)
 
 async def take_db(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /takedb для администратора"""
-    user = update.effective_user
+    if SHARED_STATE:
+        await update.message.reply_text("Выгрузка недоступна: пользователи хранятся в общем хранилище.")
+        return
+    
+    usage = (
+        "Использование: /takedb [csv|jsonl] [gz] [since=ГГГГ-ММ-ДД] [username]\n"
+        "gz — сжать файл, since — только зарегистрированные с этой даты, "
+        "username — только пользователи с username"
+    )
+    fmt = 'csv'
+    compress = False
+    since = None
+    has_username = False
+    for arg in context.args:
+        arg_lower = arg.lower()
+        if arg_lower in ('csv', 'jsonl'):
+            fmt = arg_lower
+        elif arg_lower == 'gz':
+            compress = True
+        elif arg_lower == 'username':
+            has_username = True
+        elif arg_lower.startswith('since='):
+            try:
+                since = int(datetime.fromisoformat(arg[len('since='):]).timestamp())
+            except ValueError:
+                await update.message.reply_text(usage)
+                return
+        else:
+            await update.message.reply_text(usage)
+            return
     
-    # Проверяем, является ли пользователь администратором
-    if user.id != ADMIN_ID:
-        return  # Игнорируем команду от не-админа
+    # Строки пишутся потоком во временный файл, который уходит на диск,
+    # если перерастает EXPORT_SPOOL_SIZE
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+    try:
+        binary = gzip.GzipFile(fileobj=spool, mode='wb') if compress else spool
+        out = io.TextIOWrapper(binary, encoding='utf-8', newline='')
+        count = await db.export_users(out, fmt, since, has_username)
+        out.flush()
+        out.detach()
+        if compress:
+            binary.close()
+        
+        if not count:
+            await update.message.reply_text("База данных пуста.")
+            return
+        
+        # Библиотека все равно читает файл целиком перед загрузкой
+        spool.seek(0)
+        filename = f"users.{fmt}" + (".gz" if compress else "")
+        await update.message.reply_document(
+            document=spool.read(),
+            filename=filename,
+            caption=f"База данных пользователей: {count}"
+        )
+    finally:
+        spool.close()
+
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /broadcast для рассылки сообщения всем пользователям"""
+    message = update.message
     
-    users = get_all_users()
+    if SHARED_STATE:
+        await message.reply_text("Рассылка недоступна: пользователи хранятся в общем хранилище.")
+        return
     
-    if not users:
-        await update.message.reply_text("База данных пуста.")
+    if len(context.args) == 1 and context.args[0].lower() == 'stop':
+        if broadcaster.cancel():
+            await message.reply_text("Рассылка останавливается.")
+        else:
+            await message.reply_text("Нет активной рассылки.")
         return
     
-    # Формируем текст с данными пользователей
-    db_text = "База данных пользователей:\n\n"
-    for user_data in users:
-        db_text += f"{user_data[0]} {user_data[1]} {user_data[2]}\n"
+    if broadcaster.running:
+        await message.reply_text("Рассылка уже идет. Остановить: /broadcast stop")
+        return
     
-    await update.message.reply_text(db_text)
+    if message.reply_to_message:
+        # Рассылаем копию сообщения, на которое ответил администратор
+        await broadcaster.start(
+            context.bot,
+            message.chat_id,
+            source_chat_id=message.chat_id,
+            source_message_id=message.reply_to_message.message_id
+        )
+    elif context.args:
+        text = message.text.split(None, 1)[1]
+        await broadcaster.start(context.bot, message.chat_id, text=text)
+    else:
+        await message.reply_text(
+            "Использование: /broadcast [текст] или ответ командой /broadcast на сообщение для рассылки.\n"
+            "Остановить рассылку: /broadcast stop"
+        )
 
-def main():
-    """Основная функция"""
-    # Проверяем наличие токена
-    if not BOT_TOKEN:
-        print("Ошибка: BOT_TOKEN не установлен!")
+# Названия типов сообщений в списке модерации
+TYPE_NAMES = {
+    'text': "текст",
+    'single_photo': "фото",
+    'single_video': "видео",
+    'single_document': "файл",
+    'voice': "голосовое",
+    'video_note': "видеосообщение",
+    'media_group': "альбом"
+}
+
+def strip_footer(text: str) -> str:
+    """Текст сообщения без подписи, которую добавляет бот"""
+    return text.split("@Pod1699 | Сообщение отправлено пользователем", 1)[0].rstrip()
+
+def parse_ids(args: list, limit: int = 100000):
+    """Разбирает список ID и диапазонов ("5 7-9,12"). Для "all" возвращает None"""
+    if len(args) == 1 and args[0].lower() == 'all':
+        return None
+    ids = set()
+    for part in ",".join(args).split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            first, last = (int(value) for value in part.split("-", 1))
+            if first > last or last - first >= limit:
+                raise ValueError(part)
+            ids.update(range(first, last + 1))
+        else:
+            ids.add(int(part))
+        if len(ids) > limit:
+            raise ValueError(part)
+    if not ids:
+        raise ValueError("пустой список")
+    return sorted(ids)
+
+async def build_queue_page(after_id: int = 0):
+    """Формирует страницу очереди модерации. Возвращает (текст, клавиатура)"""
+    pending, approved = await moderation.counts()
+    items, has_more = await moderation.page(after_id, QUEUE_PAGE_SIZE)
+    header = f"На модерации: {pending}, ждут публикации: {approved}"
+    if not items:
+        return header, None
+    
+    lines = [header]
+    for item_id, user_id, message_data, created_at in items:
+        text = strip_footer(message_data.get('text', ''))
+        if len(text) > 80:
+            text = text[:80] + "…"
+        created = datetime.fromtimestamp(created_at).strftime('%d.%m %H:%M')
+        lines.append(f"\n№{item_id} · {TYPE_NAMES.get(message_data['type'], message_data['type'])} · "
+                     f"[ID: {user_id}] · {created}\n{text or '(без текста)'}")
+    
+    first_id, last_id = items[0][0], items[-1][0]
+    keyboard = [[
+        InlineKeyboardButton("Одобрить страницу", callback_data=f"queue:approve:{first_id}:{last_id}"),
+        InlineKeyboardButton("Отклонить страницу", callback_data=f"queue:reject:{first_id}:{last_id}")
+    ]]
+    navigation = []
+    if after_id:
+        navigation.append(InlineKeyboardButton("⟵ В начало", callback_data="queue:next:0"))
+    if has_more:
+        navigation.append(InlineKeyboardButton("⟶", callback_data=f"queue:next:{last_id}"))
+    if navigation:
+        keyboard.append(navigation)
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+async def queue_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /queue для просмотра очереди модерации"""
+    if not MODERATION:
+        await update.message.reply_text("Модерация выключена (MODERATION=1 в настройках).")
         return
     
-    # Инициализируем базу данных
-    init_db()
+    text, reply_markup = await build_queue_page()
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+async def queue_page_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Страницы очереди модерации и решения по странице целиком"""
+    query = update.callback_query
     
-    # Создаем приложение
-    application = Application.builder().token(BOT_TOKEN).build()
+    if not MODERATION:
+        await query.answer()
+        return
+    
+    _, action, *values = query.data.split(":")
+    if action == "next":
+        await query.answer()
+        text, reply_markup = await build_queue_page(int(values[0]))
+    else:
+        # На странице подряд идущие ожидающие сообщения, поэтому достаточно диапазона ID
+        ids = list(range(int(values[0]), int(values[1]) + 1))
+        if action == "approve":
+            count = await moderation.approve(ids)
+            await query.answer(f"Одобрено: {count}")
+        else:
+            count = await moderation.reject(ids)
+            await query.answer(f"Отклонено: {count}")
+        text, reply_markup = await build_queue_page()
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+async def decide_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команды /approve и /reject для решений по очереди модерации"""
+    command = command_name(update)
+    usage = f"Использование: /{command} [номера через запятую или диапазоны 10-20 | all]"
+    if not MODERATION:
+        await update.message.reply_text("Модерация выключена (MODERATION=1 в настройках).")
+        return
+    if not context.args:
+        await update.message.reply_text(usage)
+        return
+    try:
+        ids = parse_ids(context.args)
+    except ValueError:
+        await update.message.reply_text(usage)
+        return
+    
+    if command == "approve":
+        count = await moderation.approve(ids)
+        await update.message.reply_text(f"Одобрено сообщений: {count}. Они выйдут в канал по расписанию.")
+    else:
+        count = await moderation.reject(ids)
+        await update.message.reply_text(f"Отклонено сообщений: {count}.")
+
+def pending_confirmations(application: Application) -> int:
+    """Сообщения, ожидающие подтверждения, среди пользователей, писавших боту после запуска"""
+    return sum(1 for data in application.user_data.values() if 'message_to_send' in data)
+
+def register_gauges(application: Application):
+    """Датчики текущего состояния бота; значения вычисляются при чтении метрик"""
+    metrics.gauge(
+        "bot_pending_confirmations", "Сообщения, ожидающие подтверждения",
+        lambda: pending_confirmations(application)
+    )
+    metrics.gauge("bot_flood_tracked_users", "Пользователи в окне ограничения частоты", lambda: len(flood))
+    metrics.gauge("bot_dedup_keys", "Ключи опубликованного содержимого в памяти", lambda: len(dedup))
+    metrics.gauge("bot_album_buffer", "Альбомы в сборке", lambda: albums.pending)
+    metrics.gauge("bot_publish_queue", "Публикации в очереди", lambda: publisher.pending)
+    metrics.gauge(
+        "bot_publish_circuit_open", "Приостановлены ли публикации в канал",
+        lambda: int(publisher.breaker.state != CircuitBreaker.CLOSED)
+    )
+    metrics.gauge("bot_submission_log_buffer", "Записи журнала отправок, ожидающие сохранения", lambda: audit.pending)
+    metrics.gauge("bot_update_queue", "Обновления в очереди приложения", lambda: application.update_queue.qsize())
+    metrics.gauge("bot_update_backlog", "Обновления, ожидающие обработки", lambda: application.update_processor.backlog)
+    metrics.gauge(
+        "bot_update_backlog_age_seconds", "Сколько ждет самое старое необработанное обновление",
+        lambda: application.update_processor.backlog_age
+    )
+    metrics.gauge("bot_broadcast_running", "Идет ли рассылка", lambda: int(broadcaster.running))
+    metrics.gauge("bot_uptime_seconds", "Время работы бота", lambda: int(time.time() - metrics.started))
+
+def format_timings(histogram, limit: int = 10) -> list:
+    """Строки p50/p95 для самых частых значений метки гистограммы"""
+    rows = sorted(histogram.items(), key=lambda item: item[1].count, reverse=True)[:limit]
+    return [
+        f"  {labels[0]}: {child.quantile(0.5) * 1000:.1f} / {child.quantile(0.95) * 1000:.1f} мс ({child.count})"
+        for labels, child in rows if child.count
+    ]
+
+SUBMISSION_STATUSES = [
+    ('published', 'опубликовано'),
+    ('failed', 'ошибок'),
+    ('confirmed', 'подтверждено'),
+    ('moderation', 'на модерацию'),
+    ('duplicate', 'повторов'),
+]
+
+def format_submission_totals(totals: dict, key: str) -> str:
+    """Счетчики журнала отправок по статусам для одного ключа сводки"""
+    return ", ".join(f"{title}: {totals.get((key, status), 0)}" for status, title in SUBMISSION_STATUSES)
+
+async def user_stats(user_id: int) -> str:
+    """Отправки пользователя за сегодня и за все время"""
+    today = time.strftime('%Y-%m-%d')
+    day_totals = await audit.totals('user_day', f"{user_id}:{today}")
+    all_totals = await audit.totals('user', str(user_id))
+    return "\n".join([
+        f"Пользователь [ID: {user_id}]",
+        f"Сегодня: {format_submission_totals(day_totals, f'{user_id}:{today}')}",
+        f"За все время: {format_submission_totals(all_totals, str(user_id))}",
+    ])
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /stats: сводка метрик бота; /stats ID — отправки пользователя"""
+    if context.args:
+        try:
+            user_id = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text("Использование: /stats [ID пользователя]")
+            return
+        await update.message.reply_text(await user_stats(user_id))
+        return
+    
+    today = time.strftime('%Y-%m-%d')
+    day_totals = await audit.totals('day', today)
+    published_by_type = ", ".join(
+        f"{kind}: {count}" for (kind, status), count in sorted((await audit.totals('type')).items())
+        if status == 'published'
+    ) or "нет"
+    uptime = int(time.time() - metrics.started)
+    by_type = ", ".join(f"{labels[0]}: {child.value}" for labels, child in submissions.items()) or "нет"
+    by_middleware = ", ".join(
+        f"{labels[0]}: {child.value}" for labels, child in rejected_updates.items() if child.value
+    ) or "нет"
+    lines = [
+        f"Работает: {uptime // 3600} ч {uptime % 3600 // 60} мин",
+        f"Обновлений: {updates_total.value}, ошибок в обработчиках: {handler_errors.value}",
+        f"Подтверждено сообщений: {submissions.value} ({by_type})",
+        f"Опубликовано: {published_ok.value}, ошибок публикации: {published_error.value}, "
+        f"в очереди: {publisher.pending}",
+        f"Итог неизвестен: {published_uncertain.value}, канал недоступен: {published_unavailable.value} раз, "
+        f"повторов: {publish_retries.value}, "
+        f"публикации {'приостановлены' if publisher.breaker.state != CircuitBreaker.CLOSED else 'идут'}",
+        f"Ожидают подтверждения: {pending_confirmations(context.application)}, "
+        f"альбомов в сборке: {albums.pending}",
+        f"Отклонено повторов: {duplicates_rejected.value}",
+        f"Отсеяно до обработчиков: {rejected_updates.value} ({by_middleware})",
+        f"Ожидают обработки: {context.application.update_processor.backlog}, "
+        f"сброшено при перегрузке: {shed_updates.value}",
+        f"Блокировок: {ban_actions.labels('ban').value}, разблокировок: {ban_actions.labels('unban').value}",
+        "",
+        f"Журнал за сегодня: {format_submission_totals(day_totals, today)}",
+        f"Опубликовано за все время по типам: {published_by_type}",
+        "",
+        "Обработчики (p50 / p95):",
+        *format_timings(handler_latency),
+        "",
+        "Запросы к базе (p50 / p95):",
+        *format_timings(db_query_time),
+    ]
+    await update.message.reply_text("\n".join(lines))
+
+async def post_init(application: Application):
+    """Подключение к базе данных и загрузка банов перед запуском бота"""
+    await db.connect()
+    if state is not db:
+        await state.connect()
+    await bans.load(application.job_queue, BAN_REFRESH_INTERVAL if SHARED_STATE else None)
+    await identity.warm()
+    await dedup.load()
+    publisher.start(application.bot)
+    await broadcaster.resume(application.bot)
+    if MODERATION:
+        await moderation.start(application.job_queue, application.bot)
+    
+    # В режиме polling метрики отдает отдельный HTTP-сервер
+    global metrics_server
+    if METRICS_PORT and BOT_MODE != 'webhook':
+        metrics_server = WebhookServer(application, WEBHOOK_LISTEN, METRICS_PORT)
+        metrics_server.add_route("GET", "/metrics", metrics.handle_http)
+        await metrics_server.start()
+
+async def post_stop(application: Application):
+    """Отправка оставшихся публикаций и сохранение прогресса рассылки после остановки приема обновлений"""
+    await broadcaster.stop()
+    await publisher.stop()
+    # Неотправленные публикации завершены: дожидаемся, пока авторы узнают итог
+    await asyncio.gather(*publish_reports, return_exceptions=True)
+    await moderation.stop()
+    await audit.flush()
+    if metrics_server is not None:
+        await metrics_server.stop()
+
+async def post_shutdown(application: Application):
+    """Закрытие соединения с базой данных после остановки бота"""
+    await db.close()
+    if state is not db:
+        await state.close()
+
+# Классы обновлений по убыванию важности: освободившееся место получает самый важный
+PRIORITY_ADMIN, PRIORITY_CALLBACK, PRIORITY_SUBMISSION = range(3)
+PRIORITY_NAMES = ['admin', 'callback', 'submission']
+
+# tg_id -> когда пользователю последний раз предлагали повторить позже
+shed_replies = OrderedDict()
+
+def update_priority(update: object) -> int:
+    """Класс обновления: администратор, нажатия кнопок, остальные сообщения"""
+    if not isinstance(update, Update):
+        return PRIORITY_CALLBACK
+    if is_admin(update):
+        return PRIORITY_ADMIN
+    if update.callback_query is not None:
+        return PRIORITY_CALLBACK
+    return PRIORITY_SUBMISSION
+
+async def reply_overloaded(update: object):
+    """Просит автора сброшенного сообщения повторить позже (нажатия кнопок не сбрасываются)"""
+    if not isinstance(update, Update) or update.effective_user is None:
+        return
+    if update.effective_chat is None or update.effective_chat.type != 'private':
+        return
+    # Одного ответа за интервал хватает, даже если сброшены все части альбома
+    now = time.monotonic()
+    while shed_replies and next(iter(shed_replies.values())) < now - SHED_REPLY_INTERVAL:
+        shed_replies.popitem(last=False)
+    if update.effective_user.id in shed_replies:
+        return
+    shed_replies[update.effective_user.id] = now
+    await update.get_bot().send_message(
+        chat_id=update.effective_chat.id,
+        text="Бот сейчас перегружен и не смог принять сообщение. Попробуйте отправить его позже."
+    )
+
+def build_application() -> Application:
+    """Создает приложение бота со всеми обработчиками"""
+    update_processor = UserOrderedUpdateProcessor(
+        CONCURRENT_UPDATES,
+        priority=update_priority,
+        max_backlog=UPDATE_BACKLOG_LIMIT,
+        max_backlog_age=UPDATE_BACKLOG_MAX_AGE,
+        shed_from=PRIORITY_SUBMISSION,
+        on_shed=reply_overloaded,
+        shed=shed_updates,
+        class_names=PRIORITY_NAMES
+    )
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .persistence(persistence)
+        .concurrent_updates(update_processor)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if BOT_API_URL:
+        builder = builder.base_url(BOT_API_URL).base_file_url(BOT_API_URL)
+    application = builder.build()
     
     # Добавляем обработчики
+    pipeline.register(application, group=-100)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("takedb", take_db))
     application.add_handler(CommandHandler("ban", ban_command))
     application.add_handler(CommandHandler("unban", unban_command))
     application.add_handler(CommandHandler("baninfo", baninfo_command))
     application.add_handler(CommandHandler("banlist", banlist_command))
+    application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(CommandHandler("queue", queue_command))
+    application.add_handler(CommandHandler(["approve", "reject"], decide_command))
+    application.add_handler(CallbackQueryHandler(banlist_page_handler, pattern=r"^banlist:"))
+    application.add_handler(CallbackQueryHandler(queue_page_handler, pattern=r"^queue:"))
     application.add_handler(CallbackQueryHandler(button_handler))
+    application.add_handler(CommandHandler("stats", stats_command))
+    # Подписи к файлам не разбираются как команды, поэтому импорт банов проверяет их сам
+    application.add_handler(MessageHandler(
+        filters.User(ADMIN_ID) & filters.Document.ALL & filters.CaptionRegex(r'^/(un)?ban(@\w+)?(\s|$)'),
+        ban_import
+    ))
     application.add_handler(MessageHandler(filters.ALL, handle_message))
     
+    register_gauges(application)
+    instrument_handlers(application, handler_latency, handler_errors)
+    return application
+
+def main():
+    """Основная функция"""
+    # Проверяем наличие токена
+    if not BOT_TOKEN:
+        print("Ошибка: BOT_TOKEN не установлен!")
+        return
+    
+    # Несколько экземпляров делят обновления только через webhook и общее состояние
+    router = None
+    if len(SHARD_PEERS) > 1:
+        if BOT_MODE != 'webhook' or not SHARED_STATE or not os.getenv('WEBHOOK_SECRET'):
+            print("Ошибка: SHARD_PEERS требует BOT_MODE=webhook, STATE_BACKEND=kv и общий WEBHOOK_SECRET!")
+            return
+        if MODERATION:
+            # Очередь модерации хранится в локальной базе каждого экземпляра
+            print("Ошибка: модерация работает только в одном экземпляре бота!")
+            return
+        router = ShardRouter(SHARD_INDEX, SHARD_PEERS, WEBHOOK_SECRET)
+    
+    application = build_application()
+    
     # Запускаем бота
-    print("Бот запущен...")
-    application.run_polling()
+    if BOT_MODE == 'webhook':
+        print("Бот запущен (webhook)...")
+        server = WebhookServer(application, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, router)
+        server.add_route("GET", "/metrics", metrics.handle_http)
+        # Webhook в Telegram регистрирует только первый экземпляр
+        url = WEBHOOK_URL if SHARD_INDEX == 0 else None
+        asyncio.run(serve_webhook(application, server, url, ALLOWED_UPDATES))
+    else:
+        print("Бот запущен...")
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == "__main__":
     main()
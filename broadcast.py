@@ -0,0 +1,237 @@
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+from database import Database
+from publisher import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastState:
+    """Состояние выполняемой рассылки"""
+
+    __slots__ = (
+        'id', 'text', 'source_chat_id', 'source_message_id', 'last_user_id', 'total',
+        'sent', 'failed', 'blocked', 'status_chat_id', 'status_message_id',
+        'blocked_tg_ids', 'done_ids', 'cancelled', 'started', 'processed_at_start'
+    )
+
+    def __init__(self, row: tuple):
+        (self.id, self.text, self.source_chat_id, self.source_message_id, self.last_user_id, self.total,
+         self.sent, self.failed, self.blocked, self.status_chat_id, self.status_message_id, done_ids) = row
+        # Получатели после last_user_id, обработанные до перезапуска: они уже
+        # учтены в счетчиках, и повторно им не отправляем
+        self.done_ids = set(json.loads(done_ids)) if done_ids else set()
+        # tg_id заблокировавших бота с последней контрольной точки
+        self.blocked_tg_ids = []
+        self.cancelled = False
+        self.started = time.monotonic()
+        self.processed_at_start = self.processed
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.failed + self.blocked
+
+
+class Broadcaster:
+    """Рассылка сообщения всем пользователям бота.
+
+    Получатели читаются из базы порциями, сообщения отправляются несколькими
+    обработчиками под общим ограничителем скорости бота. Прогресс регулярно
+    сохраняется в таблицу broadcasts, поэтому после перезапуска рассылка
+    продолжается с места остановки, а не начинается заново.
+    """
+
+    PAGE_SIZE = 200
+    # Как часто сохранять контрольную точку и обновлять сообщение о ходе рассылки (секунды)
+    CHECKPOINT_INTERVAL = 1.0
+    STATUS_INTERVAL = 3.0
+    MAX_RETRIES = 3
+
+    def __init__(self, db: Database, limiter: TokenBucket, concurrency: int = 10):
+        self.db = db
+        self.limiter = limiter
+        self.concurrency = concurrency
+        self._bot = None
+        self._state = None
+        self._task = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self, bot: Bot, status_chat_id: int, text: str = None,
+                    source_chat_id: int = None, source_message_id: int = None) -> int:
+        """Запускает новую рассылку текста или копии сообщения. Возвращает ее ID"""
+        broadcast_id = await self.db.create_broadcast(text, source_chat_id, source_message_id)
+        status_message = await bot.send_message(chat_id=status_chat_id, text=f"Рассылка #{broadcast_id} запущена.")
+        await self.db.set_broadcast_status_message(broadcast_id, status_chat_id, status_message.message_id)
+        await self.resume(bot)
+        return broadcast_id
+
+    async def resume(self, bot: Bot):
+        """Продолжает незавершенную рассылку, если она есть"""
+        self._bot = bot
+        if self.running:
+            return
+        rows = await self.db.get_running_broadcasts()
+        if not rows:
+            return
+        self._state = BroadcastState(rows[0])
+        self._task = asyncio.create_task(self._run(self._state), name=f"broadcast:{self._state.id}")
+
+    def cancel(self) -> bool:
+        """Останавливает текущую рассылку по команде администратора"""
+        if not self.running:
+            return False
+        self._state.cancelled = True
+        self._task.cancel()
+        return True
+
+    async def stop(self):
+        """Прерывает рассылку при остановке бота, сохранив прогресс для продолжения"""
+        if self.running:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self, state: BroadcastState):
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        # Получатели в порядке выдачи: [id, доставлено ли]; по ним вычисляется
+        # граница, до которой все сообщения гарантированно обработаны
+        inflight = deque()
+
+        async def produce():
+            after_id = state.last_user_id
+            while True:
+                rows = await self.db.get_broadcast_recipients(after_id, self.PAGE_SIZE)
+                if not rows:
+                    break
+                for user_id, tg_id in rows:
+                    if user_id in state.done_ids:
+                        # Остается в очереди уже обработанным, чтобы граница прошла через него
+                        inflight.append([user_id, True])
+                        continue
+                    entry = [user_id, False]
+                    inflight.append(entry)
+                    await queue.put((entry, tg_id))
+                after_id = rows[-1][0]
+            for _ in range(self.concurrency):
+                await queue.put(None)
+
+        async def work():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                entry, tg_id = item
+                await self._deliver(state, tg_id)
+                entry[1] = True
+
+        async def report():
+            last_status = 0
+            while True:
+                await asyncio.sleep(self.CHECKPOINT_INTERVAL)
+                await self._checkpoint(state, inflight)
+                if time.monotonic() - last_status >= self.STATUS_INTERVAL:
+                    last_status = time.monotonic()
+                    await self._show_status(state, self._status_text(state))
+
+        reporter = asyncio.create_task(report())
+        try:
+            await asyncio.gather(produce(), *(work() for _ in range(self.concurrency)))
+        except asyncio.CancelledError:
+            reporter.cancel()
+            await self._checkpoint(state, inflight)
+            if state.cancelled:
+                await self.db.finish_broadcast(state.id, 'cancelled')
+                await self._show_status(state, f"Рассылка #{state.id} остановлена.\n" + self._status_text(state))
+            raise
+        except Exception:
+            reporter.cancel()
+            logger.exception("Рассылка #%d прервана ошибкой", state.id)
+            await self._checkpoint(state, inflight)
+            raise
+        reporter.cancel()
+        await self._checkpoint(state, inflight)
+        await self.db.finish_broadcast(state.id, 'done')
+        await self._show_status(state, f"Рассылка #{state.id} завершена.\n" + self._status_text(state))
+
+    async def _deliver(self, state: BroadcastState, tg_id: int):
+        for _ in range(self.MAX_RETRIES):
+            await self.limiter.acquire()
+            try:
+                if state.source_message_id:
+                    await self._bot.copy_message(
+                        chat_id=tg_id,
+                        from_chat_id=state.source_chat_id,
+                        message_id=state.source_message_id
+                    )
+                else:
+                    await self._bot.send_message(chat_id=tg_id, text=state.text)
+                state.sent += 1
+                return
+            except RetryAfter as e:
+                self.limiter.drain()
+                await asyncio.sleep(e.retry_after)
+            except Forbidden:
+                # Пользователь заблокировал бота или удалил аккаунт
+                state.blocked += 1
+                state.blocked_tg_ids.append(tg_id)
+                return
+            except TelegramError as e:
+                logger.warning("Рассылка #%d: не удалось отправить %s: %s", state.id, tg_id, e)
+                state.failed += 1
+                return
+        state.failed += 1
+
+    async def _checkpoint(self, state: BroadcastState, inflight: deque):
+        while inflight and inflight[0][1]:
+            state.last_user_id = inflight.popleft()[0]
+        # Счетчики включают и доставки после границы: их получателей сохраняем,
+        # чтобы после перезапуска не отправить им сообщение и не учесть его второй раз
+        done_ids = [user_id for user_id, done in inflight if done]
+        blocked_tg_ids, state.blocked_tg_ids = state.blocked_tg_ids, []
+        await self.db.save_broadcast_checkpoint(
+            state.id, state.last_user_id, state.sent, state.failed, state.blocked, blocked_tg_ids, done_ids
+        )
+
+    @staticmethod
+    def _status_text(state: BroadcastState) -> str:
+        elapsed = time.monotonic() - state.started
+        rate = (state.processed - state.processed_at_start) / elapsed if elapsed > 0 else 0
+        remaining = max(state.total - state.processed, 0)
+        if rate > 0:
+            eta_seconds = int(remaining / rate)
+            eta_text = f"{eta_seconds // 60} мин {eta_seconds % 60} с"
+        else:
+            eta_text = "неизвестно"
+        return (
+            f"Обработано: {state.processed} из {state.total}\n"
+            f"Доставлено: {state.sent}\n"
+            f"Ошибок: {state.failed}\n"
+            f"Заблокировали бота: {state.blocked}\n"
+            f"Скорость: {rate:.1f} сообщ./с\n"
+            f"Осталось: ~{eta_text}"
+        )
+
+    async def _show_status(self, state: BroadcastState, text: str):
+        if not state.status_message_id:
+            return
+        await self.limiter.acquire()
+        try:
+            await self._bot.edit_message_text(
+                chat_id=state.status_chat_id,
+                message_id=state.status_message_id,
+                text=text
+            )
+        except BadRequest:
+            # Текст не изменился или сообщение удалено
+            pass
+        except TelegramError as e:
+            logger.warning("Не удалось обновить статус рассылки #%d: %s", state.id, e)
@@ -0,0 +1,544 @@
+import asyncio
+import csv
+import json
+import sqlite3
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from migrations import migrate
+from state import StateBackend
+
+# SQL-запросы вынесены в константы: sqlite3 кэширует подготовленные
+# выражения по тексту запроса, поэтому одинаковые строки компилируются один раз
+SQL_SELECT_USER_ID = "SELECT id FROM users WHERE tg_id = ?"
+# Пустое обновление при конфликте нужно, чтобы RETURNING вернул ID строки,
+# созданной параллельным запросом
+SQL_UPSERT_USER = '''
+    INSERT INTO users (tg_id, username, created_at) VALUES (?, ?, ?)
+    ON CONFLICT (tg_id) DO UPDATE SET tg_id = excluded.tg_id
+    RETURNING id
+'''
+SQL_SELECT_RECENT_USER_IDS = "SELECT tg_id, id FROM users ORDER BY id DESC LIMIT ?"
+# Проверка пачки ID одним запросом: список передается JSON-параметром
+SQL_EXISTING_USER_IDS = "SELECT id FROM users WHERE id IN (SELECT value FROM json_each(?))"
+SQL_EXPORT_USERS = "SELECT id, tg_id, username, created_at FROM users"
+SQL_UPSERT_BAN = "INSERT OR REPLACE INTO bans (user_id, ban_until, reason) VALUES (?, ?, ?)"
+SQL_DELETE_BAN = "DELETE FROM bans WHERE user_id = ?"
+SQL_SELECT_BANS = "SELECT user_id, ban_until, reason FROM bans"
+# Страницы списка банов: keyset-пагинация по первичному ключу, истекшие отсекаются в SQL
+SQL_BAN_PAGE_FORWARD = '''
+    SELECT user_id, ban_until, reason FROM bans
+    WHERE (ban_until IS NULL OR ban_until > ?) AND user_id > ?
+    ORDER BY user_id LIMIT ?
+'''
+SQL_BAN_PAGE_BACKWARD = '''
+    SELECT user_id, ban_until, reason FROM bans
+    WHERE (ban_until IS NULL OR ban_until > ?) AND user_id < ?
+    ORDER BY user_id DESC LIMIT ?
+'''
+SQL_UNBLOCK_USER = "UPDATE users SET blocked = 0 WHERE tg_id = ? AND blocked != 0"
+SQL_MARK_USER_BLOCKED = "UPDATE users SET blocked = 1 WHERE tg_id = ?"
+SQL_INSERT_BROADCAST = '''
+    INSERT INTO broadcasts (text, source_chat_id, source_message_id, total, created_at)
+    VALUES (?, ?, ?, (SELECT COUNT(*) FROM users WHERE blocked = 0), ?)
+'''
+SQL_SELECT_RUNNING_BROADCASTS = '''
+    SELECT id, text, source_chat_id, source_message_id, last_user_id, total, sent, failed, blocked,
+           status_chat_id, status_message_id, done_ids
+    FROM broadcasts WHERE status = 'running' ORDER BY id
+'''
+SQL_SET_BROADCAST_STATUS_MESSAGE = "UPDATE broadcasts SET status_chat_id = ?, status_message_id = ? WHERE id = ?"
+SQL_UPDATE_BROADCAST_PROGRESS = '''
+    UPDATE broadcasts SET last_user_id = ?, sent = ?, failed = ?, blocked = ?, done_ids = ? WHERE id = ?
+'''
+SQL_FINISH_BROADCAST = "UPDATE broadcasts SET status = ? WHERE id = ?"
+SQL_BROADCAST_RECIPIENTS = "SELECT id, tg_id FROM users WHERE id > ? AND blocked = 0 ORDER BY id LIMIT ?"
+SQL_SELECT_USER_STATE = "SELECT data FROM user_state WHERE tg_id = ?"
+SQL_UPSERT_USER_STATE = "INSERT OR REPLACE INTO user_state (tg_id, data) VALUES (?, ?)"
+SQL_DELETE_USER_STATE = "DELETE FROM user_state WHERE tg_id = ?"
+SQL_INSERT_QUEUE_ITEM = '''
+    INSERT INTO moderation_queue
+        (tg_id, user_id, data, status_chat_id, status_message_id, status_is_caption, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+SQL_QUEUE_PAGE = '''
+    SELECT id, user_id, data, created_at FROM moderation_queue
+    WHERE status = 'pending' AND id > ? ORDER BY id LIMIT ?
+'''
+SQL_QUEUE_COUNTS = "SELECT status, COUNT(*) FROM moderation_queue WHERE status IN ('pending', 'approved') GROUP BY status"
+# Массовые решения: список ID передается одним JSON-параметром, а не тысячами плейсхолдеров
+SQL_DECIDE_QUEUE_ITEMS = '''
+    UPDATE moderation_queue SET status = ?, decided_at = ?
+    WHERE status = 'pending' AND id IN (SELECT value FROM json_each(?))
+    RETURNING id, status_chat_id, status_message_id, status_is_caption
+'''
+SQL_DECIDE_ALL_QUEUE_ITEMS = '''
+    UPDATE moderation_queue SET status = ?, decided_at = ? WHERE status = 'pending'
+    RETURNING id, status_chat_id, status_message_id, status_is_caption
+'''
+SQL_TAKE_APPROVED = '''
+    UPDATE moderation_queue SET status = 'publishing'
+    WHERE id IN (SELECT id FROM moderation_queue WHERE status = 'approved' ORDER BY id LIMIT ?)
+    RETURNING id, data, status_chat_id, status_message_id, status_is_caption
+'''
+SQL_FINISH_QUEUE_ITEM = "UPDATE moderation_queue SET status = ?, published_at = ? WHERE id = ?"
+SQL_RESET_PUBLISHING = "UPDATE moderation_queue SET status = 'approved' WHERE status = 'publishing'"
+SQL_UPSERT_DEDUP_KEY = "INSERT OR REPLACE INTO dedup (key, seen_at) VALUES (?, ?)"
+SQL_PRUNE_DEDUP_KEYS = "DELETE FROM dedup WHERE seen_at <= ?"
+SQL_LOAD_DEDUP_KEYS = "SELECT key, seen_at FROM dedup WHERE seen_at > ? ORDER BY seen_at DESC LIMIT ?"
+SQL_DEDUP_KEYS_SEEN = '''
+    SELECT 1 FROM dedup WHERE key IN (SELECT value FROM json_each(?)) AND seen_at > ? LIMIT 1
+'''
+SQL_INSERT_SUBMISSION = "INSERT INTO submissions (created_at, user_id, type, items, status) VALUES (?, ?, ?, ?, ?)"
+SQL_ADD_SUBMISSION_TOTAL = '''
+    INSERT INTO submission_totals (scope, key, status, count) VALUES (?, ?, ?, ?)
+    ON CONFLICT (scope, key, status) DO UPDATE SET count = count + excluded.count
+'''
+SQL_SUBMISSION_TOTALS = "SELECT key, status, count FROM submission_totals WHERE scope = ? AND key = ?"
+SQL_SUBMISSION_SCOPE_TOTALS = "SELECT key, status, count FROM submission_totals WHERE scope = ?"
+SQL_SELECT_PUBLICATION_STATUS = "SELECT status FROM publications WHERE key = ?"
+SQL_UPSERT_PUBLICATION = '''
+    INSERT INTO publications (key, status, updated_at) VALUES (?, ?, ?)
+    ON CONFLICT (key) DO UPDATE SET status = excluded.status, updated_at = excluded.updated_at
+'''
+
+# Размер порции строк при выгрузке базы
+EXPORT_BATCH_SIZE = 500
+
+
+class Database(StateBackend):
+    """Доступ к базе данных через одно долгоживущее соединение.
+
+    Все запросы выполняются в отдельном потоке-исполнителе, поэтому
+    медленная запись на диск не блокирует цикл событий бота. Заодно это
+    реализация StateBackend для одного экземпляра бота.
+    """
+
+    def __init__(self, path: str, query_time=None):
+        self.path = path
+        self._conn = None
+        # Один поток: соединение SQLite используется строго последовательно
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+        # Необязательная гистограмма времени запросов с меткой по имени метода
+        self.query_time = query_time
+
+    async def _run(self, func, *args):
+        """Выполняет функцию в потоке базы данных"""
+        loop = asyncio.get_running_loop()
+        if self.query_time is None:
+            return await loop.run_in_executor(self._executor, func, *args)
+        result, error, elapsed = await loop.run_in_executor(self._executor, self._timed, func, *args)
+        # Гистограмма меняется только в цикле событий, где ее читает /metrics
+        self.query_time.labels(func.__name__.lstrip('_')).observe(elapsed)
+        if error is not None:
+            raise error
+        return result
+
+    @staticmethod
+    def _timed(func, *args) -> tuple:
+        """Выполняет функцию и возвращает (результат, исключение, длительность)"""
+        started = time.perf_counter()
+        try:
+            return func(*args), None, time.perf_counter() - started
+        except Exception as e:
+            return None, e, time.perf_counter() - started
+
+    async def connect(self):
+        """Открывает соединение и применяет миграции схемы"""
+        await self._run(self._connect)
+
+    async def close(self):
+        """Закрывает соединение и останавливает поток базы данных"""
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # В режиме WAL этого достаточно для целостности и заметно меньше fsync
+        conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn = conn
+        migrate(conn)
+
+    # Пользователи
+
+    def _get_or_create_user(self, tg_id: int, username: str = None) -> int:
+        # Сначала только чтение: конфликтующая вставка расходует значение AUTOINCREMENT
+        result = self._conn.execute(SQL_SELECT_USER_ID, (tg_id,)).fetchone()
+        if result:
+            return result[0]
+
+        username_display = username if username else "None"
+        with self._conn:
+            return self._conn.execute(
+                SQL_UPSERT_USER, (tg_id, username_display, int(time.time()))
+            ).fetchone()[0]
+
+    async def get_or_create_user(self, tg_id: int, username: str = None) -> int:
+        """Получить или создать пользователя в базе данных"""
+        return await self._run(self._get_or_create_user, tg_id, username)
+
+    def _get_user_id(self, tg_id: int):
+        result = self._conn.execute(SQL_SELECT_USER_ID, (tg_id,)).fetchone()
+        return result[0] if result else None
+
+    async def get_user_id(self, tg_id: int):
+        """ID существующего пользователя или None, без создания"""
+        return await self._run(self._get_user_id, tg_id)
+
+    def _unblock_user(self, tg_id: int):
+        with self._conn:
+            self._conn.execute(SQL_UNBLOCK_USER, (tg_id,))
+
+    async def unblock_user(self, tg_id: int):
+        """Снимает отметку о блокировке бота пользователем"""
+        await self._run(self._unblock_user, tg_id)
+
+    def _get_recent_user_ids(self, limit: int):
+        return self._conn.execute(SQL_SELECT_RECENT_USER_IDS, (limit,)).fetchall()
+
+    async def get_recent_user_ids(self, limit: int):
+        """Последние зарегистрированные пользователи: (tg_id, id)"""
+        return await self._run(self._get_recent_user_ids, limit)
+
+    def _existing_user_ids(self, user_ids: list) -> set:
+        return {row[0] for row in self._conn.execute(SQL_EXISTING_USER_IDS, (json.dumps(user_ids),))}
+
+    async def existing_user_ids(self, user_ids: list) -> set:
+        """Те из внутренних ID, которые есть в базе"""
+        return await self._run(self._existing_user_ids, user_ids)
+
+    def _export_users(self, out, fmt: str, since: int = None, has_username: bool = False) -> int:
+        conditions = []
+        params = []
+        if since is not None:
+            conditions.append("created_at >= ?")
+            params.append(since)
+        if has_username:
+            conditions.append("username IS NOT NULL AND username != 'None'")
+        query = SQL_EXPORT_USERS
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY id"
+
+        columns = ('id', 'tg_id', 'username', 'created_at')
+        writer = csv.writer(out) if fmt == 'csv' else None
+        if writer:
+            writer.writerow(columns)
+
+        # Строки читаются порциями, в памяти не держится вся таблица
+        cursor = self._conn.execute(query, params)
+        count = 0
+        while True:
+            rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                row = row[:3] + (
+                    datetime.fromtimestamp(row[3]).isoformat(sep=' ') if row[3] else None,
+                )
+                if writer:
+                    writer.writerow(row)
+                else:
+                    out.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n")
+            count += len(rows)
+        return count
+
+    async def export_users(self, out, fmt: str = 'csv', since: int = None, has_username: bool = False) -> int:
+        """Записывает пользователей в текстовый файл out (csv или jsonl). Возвращает число строк"""
+        return await self._run(self._export_users, out, fmt, since, has_username)
+
+    # Баны
+
+    def _load_bans(self):
+        return self._conn.execute(SQL_SELECT_BANS).fetchall()
+
+    async def load_bans(self):
+        """Получает все баны: (user_id, ban_until в секундах Unix или None, reason)"""
+        return await self._run(self._load_bans)
+
+    def _get_ban_page(self, after_id: int = None, before_id: int = None, limit: int = 20):
+        now = int(time.time())
+        # Берем на одну строку больше, чтобы узнать, есть ли следующая страница
+        if before_id is not None:
+            rows = self._conn.execute(SQL_BAN_PAGE_BACKWARD, (now, before_id, limit + 1)).fetchall()
+            has_more = len(rows) > limit
+            return list(reversed(rows[:limit])), has_more
+        rows = self._conn.execute(SQL_BAN_PAGE_FORWARD, (now, after_id or 0, limit + 1)).fetchall()
+        return rows[:limit], len(rows) > limit
+
+    async def get_ban_page(self, after_id: int = None, before_id: int = None, limit: int = 20):
+        """Страница активных банов после after_id или перед before_id.
+
+        Возвращает (строки (user_id, ban_until, reason), есть_ли_еще_в_этом_направлении).
+        """
+        return await self._run(self._get_ban_page, after_id, before_id, limit)
+
+    def _add_bans(self, bans: list):
+        with self._conn:
+            self._conn.executemany(
+                SQL_UPSERT_BAN,
+                [
+                    (user_id, int(ban_until.timestamp()) if ban_until else None, reason)
+                    for user_id, ban_until, reason in bans
+                ]
+            )
+
+    async def add_bans(self, bans: list):
+        """Добавляет баны одной транзакцией: [(user_id, ban_until или None для вечного бана, reason)]"""
+        await self._run(self._add_bans, bans)
+
+    def _remove_bans(self, user_ids: list):
+        with self._conn:
+            self._conn.executemany(SQL_DELETE_BAN, [(user_id,) for user_id in user_ids])
+
+    async def remove_bans(self, user_ids: list):
+        """Снимает баны сразу с нескольких пользователей одной транзакцией"""
+        await self._run(self._remove_bans, user_ids)
+
+    # Состояние пользователей (user_data)
+
+    def _load_user_state(self, tg_id: int):
+        result = self._conn.execute(SQL_SELECT_USER_STATE, (tg_id,)).fetchone()
+        return result[0] if result else None
+
+    async def load_user_state(self, tg_id: int):
+        """Сохраненное состояние пользователя или None"""
+        return await self._run(self._load_user_state, tg_id)
+
+    def _save_user_states(self, states: list):
+        with self._conn:
+            self._conn.executemany(
+                SQL_UPSERT_USER_STATE,
+                [(tg_id, data) for tg_id, data in states if data is not None]
+            )
+            self._conn.executemany(
+                SQL_DELETE_USER_STATE,
+                [(tg_id,) for tg_id, data in states if data is None]
+            )
+
+    async def save_user_states(self, states: list):
+        """Сохраняет состояния пользователей одной транзакцией: [(tg_id, data или None для удаления)]"""
+        await self._run(self._save_user_states, states)
+
+    # Рассылки
+
+    def _create_broadcast(self, text: str = None, source_chat_id: int = None, source_message_id: int = None) -> int:
+        with self._conn:
+            cursor = self._conn.execute(
+                SQL_INSERT_BROADCAST, (text, source_chat_id, source_message_id, int(time.time()))
+            )
+        return cursor.lastrowid
+
+    async def create_broadcast(self, text: str = None, source_chat_id: int = None, source_message_id: int = None) -> int:
+        """Создает рассылку текста или копии сообщения. Возвращает ее ID"""
+        return await self._run(self._create_broadcast, text, source_chat_id, source_message_id)
+
+    def _get_running_broadcasts(self):
+        return self._conn.execute(SQL_SELECT_RUNNING_BROADCASTS).fetchall()
+
+    async def get_running_broadcasts(self):
+        """Незавершенные рассылки для продолжения после перезапуска"""
+        return await self._run(self._get_running_broadcasts)
+
+    def _set_broadcast_status_message(self, broadcast_id: int, chat_id: int, message_id: int):
+        with self._conn:
+            self._conn.execute(SQL_SET_BROADCAST_STATUS_MESSAGE, (chat_id, message_id, broadcast_id))
+
+    async def set_broadcast_status_message(self, broadcast_id: int, chat_id: int, message_id: int):
+        """Запоминает сообщение, в котором показывается ход рассылки"""
+        await self._run(self._set_broadcast_status_message, broadcast_id, chat_id, message_id)
+
+    def _save_broadcast_checkpoint(self, broadcast_id: int, last_user_id: int, sent: int, failed: int,
+                                   blocked: int, blocked_tg_ids: list, done_ids: list):
+        with self._conn:
+            self._conn.executemany(SQL_MARK_USER_BLOCKED, [(tg_id,) for tg_id in blocked_tg_ids])
+            self._conn.execute(
+                SQL_UPDATE_BROADCAST_PROGRESS,
+                (last_user_id, sent, failed, blocked, json.dumps(done_ids), broadcast_id)
+            )
+
+    async def save_broadcast_checkpoint(self, broadcast_id: int, last_user_id: int, sent: int, failed: int,
+                                        blocked: int, blocked_tg_ids: list, done_ids: list):
+        """Сохраняет прогресс рассылки и отмечает заблокировавших бота одной транзакцией.
+
+        done_ids — получатели после last_user_id, уже учтенные в счетчиках.
+        """
+        await self._run(
+            self._save_broadcast_checkpoint, broadcast_id, last_user_id, sent, failed, blocked, blocked_tg_ids, done_ids
+        )
+
+    def _finish_broadcast(self, broadcast_id: int, status: str):
+        with self._conn:
+            self._conn.execute(SQL_FINISH_BROADCAST, (status, broadcast_id))
+
+    async def finish_broadcast(self, broadcast_id: int, status: str = 'done'):
+        """Завершает рассылку со статусом done или cancelled"""
+        await self._run(self._finish_broadcast, broadcast_id, status)
+
+    def _get_broadcast_recipients(self, after_id: int, limit: int):
+        return self._conn.execute(SQL_BROADCAST_RECIPIENTS, (after_id, limit)).fetchall()
+
+    async def get_broadcast_recipients(self, after_id: int, limit: int = 200):
+        """Следующая порция получателей рассылки: [(id, tg_id)]"""
+        return await self._run(self._get_broadcast_recipients, after_id, limit)
+
+    # Очередь модерации
+
+    def _add_queue_item(self, tg_id: int, user_id: int, data: str, status_chat_id: int,
+                        status_message_id: int, status_is_caption: bool) -> int:
+        with self._conn:
+            return self._conn.execute(
+                SQL_INSERT_QUEUE_ITEM,
+                (tg_id, user_id, data, status_chat_id, status_message_id, int(status_is_caption), int(time.time()))
+            ).lastrowid
+
+    async def add_queue_item(self, tg_id: int, user_id: int, data: str, status_chat_id: int,
+                             status_message_id: int, status_is_caption: bool = False) -> int:
+        """Ставит сообщение в очередь модерации, возвращает его номер"""
+        return await self._run(
+            self._add_queue_item, tg_id, user_id, data, status_chat_id, status_message_id, status_is_caption
+        )
+
+    def _get_queue_page(self, after_id: int, limit: int):
+        rows = self._conn.execute(SQL_QUEUE_PAGE, (after_id, limit + 1)).fetchall()
+        return rows[:limit], len(rows) > limit
+
+    async def get_queue_page(self, after_id: int = 0, limit: int = 20):
+        """Страница ожидающих модерации: ([(id, user_id, data, created_at)], есть_ли_еще)"""
+        return await self._run(self._get_queue_page, after_id, limit)
+
+    def _get_queue_counts(self) -> dict:
+        return dict(self._conn.execute(SQL_QUEUE_COUNTS).fetchall())
+
+    async def get_queue_counts(self) -> dict:
+        """Число сообщений в очереди по статусам pending и approved"""
+        return await self._run(self._get_queue_counts)
+
+    def _decide_queue_items(self, status: str, ids: list = None):
+        with self._conn:
+            if ids is None:
+                return self._conn.execute(SQL_DECIDE_ALL_QUEUE_ITEMS, (status, int(time.time()))).fetchall()
+            return self._conn.execute(
+                SQL_DECIDE_QUEUE_ITEMS, (status, int(time.time()), json.dumps(ids))
+            ).fetchall()
+
+    async def decide_queue_items(self, status: str, ids: list = None):
+        """Одобряет или отклоняет ожидающие сообщения одним запросом (ids=None — все).
+
+        Возвращает измененные строки: [(id, status_chat_id, status_message_id, status_is_caption)].
+        """
+        return await self._run(self._decide_queue_items, status, ids)
+
+    def _take_approved(self, limit: int):
+        with self._conn:
+            rows = self._conn.execute(SQL_TAKE_APPROVED, (limit,)).fetchall()
+        # Порядок строк RETURNING не определен
+        return sorted(rows)
+
+    async def take_approved(self, limit: int):
+        """Забирает для публикации до limit одобренных сообщений в порядке поступления"""
+        return await self._run(self._take_approved, limit)
+
+    def _finish_queue_items(self, results: list):
+        now = int(time.time())
+        with self._conn:
+            self._conn.executemany(SQL_FINISH_QUEUE_ITEM, [(status, now, item_id) for item_id, status in results])
+
+    async def finish_queue_items(self, results: list):
+        """Сохраняет итоги публикации: [(id, published или failed)]"""
+        await self._run(self._finish_queue_items, results)
+
+    def _reset_publishing(self):
+        with self._conn:
+            self._conn.execute(SQL_RESET_PUBLISHING)
+
+    async def reset_publishing(self):
+        """Возвращает в очередь сообщения, публикация которых прервалась остановкой бота"""
+        await self._run(self._reset_publishing)
+
+    # Ключи для отсева повторов
+
+    def _add_dedup_keys(self, keys: list, seen_at: int, prune_before: int = None):
+        with self._conn:
+            self._conn.executemany(SQL_UPSERT_DEDUP_KEY, [(key, seen_at) for key in keys])
+            if prune_before is not None:
+                self._conn.execute(SQL_PRUNE_DEDUP_KEYS, (prune_before,))
+
+    async def add_dedup_keys(self, keys: list, seen_at: int, prune_before: int = None):
+        """Сохраняет ключи опубликованного содержимого, заодно удаляя ключи не новее prune_before"""
+        await self._run(self._add_dedup_keys, keys, seen_at, prune_before)
+
+    def _prune_dedup_keys(self, before: int):
+        with self._conn:
+            self._conn.execute(SQL_PRUNE_DEDUP_KEYS, (before,))
+
+    async def prune_dedup_keys(self, before: int):
+        """Удаляет ключи, сохраненные не позже before"""
+        await self._run(self._prune_dedup_keys, before)
+
+    def _load_dedup_keys(self, since: int, limit: int):
+        return self._conn.execute(SQL_LOAD_DEDUP_KEYS, (since, limit)).fetchall()
+
+    async def load_dedup_keys(self, since: int, limit: int):
+        """Последние ключи новее since: [(key, seen_at)] от новых к старым"""
+        return await self._run(self._load_dedup_keys, since, limit)
+
+    def _dedup_keys_seen(self, keys: list, since: int) -> bool:
+        return self._conn.execute(SQL_DEDUP_KEYS_SEEN, (json.dumps(keys), since)).fetchone() is not None
+
+    async def dedup_keys_seen(self, keys: list, since: int) -> bool:
+        """Есть ли среди keys сохраненные позже since"""
+        return await self._run(self._dedup_keys_seen, keys, since)
+
+    # Журнал отправок
+
+    def _add_submissions(self, rows: list):
+        # Счетчики пачки сначала суммируются, чтобы обновить каждую строку сводки один раз
+        totals = Counter()
+        for created_at, user_id, kind, _, status in rows:
+            day = time.strftime('%Y-%m-%d', time.localtime(created_at))
+            totals['day', day, status] += 1
+            totals['type', kind, status] += 1
+            if user_id is not None:
+                totals['user', str(user_id), status] += 1
+                totals['user_day', f"{user_id}:{day}", status] += 1
+        with self._conn:
+            self._conn.executemany(SQL_INSERT_SUBMISSION, rows)
+            self._conn.executemany(SQL_ADD_SUBMISSION_TOTAL, [(*key, count) for key, count in totals.items()])
+
+    async def add_submissions(self, rows: list):
+        """Добавляет в журнал [(created_at, user_id, type, items, status)] и обновляет сводки"""
+        await self._run(self._add_submissions, rows)
+
+    def _get_submission_totals(self, scope: str, key: str = None) -> dict:
+        if key is None:
+            cursor = self._conn.execute(SQL_SUBMISSION_SCOPE_TOTALS, (scope,))
+        else:
+            cursor = self._conn.execute(SQL_SUBMISSION_TOTALS, (scope, key))
+        return {(row[0], row[1]): row[2] for row in cursor}
+
+    async def get_submission_totals(self, scope: str, key: str = None) -> dict:
+        """Счетчики журнала отправок: {(ключ, статус): количество}"""
+        return await self._run(self._get_submission_totals, scope, key)
+
+    # Публикации по ключам идемпотентности
+
+    def _get_publication_status(self, key: str):
+        row = self._conn.execute(SQL_SELECT_PUBLICATION_STATUS, (key,)).fetchone()
+        return row[0] if row else None
+
+    async def get_publication_status(self, key: str):
+        """Статус публикации (pending, published, failed) или None"""
+        return await self._run(self._get_publication_status, key)
+
+    def _set_publication_status(self, key: str, status: str):
+        with self._conn:
+            self._conn.execute(SQL_UPSERT_PUBLICATION, (key, status, int(time.time())))
+
+    async def set_publication_status(self, key: str, status: str):
+        await self._run(self._set_publication_status, key, status)
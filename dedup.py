@@ -0,0 +1,119 @@
+import hashlib
+import re
+import time
+from collections import OrderedDict
+
+from state import StateBackend
+
+# Короткие тексты («привет», «+») совпадают слишком часто, чтобы считать их повтором
+MIN_TEXT_LENGTH = 10
+
+
+def _key(kind: str, value: str) -> int:
+    """64-битный ключ (помещается в INTEGER SQLite)"""
+    digest = hashlib.blake2b(f"{kind}:{value}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def normalize_text(text: str) -> str:
+    """Текст без регистра, знаков препинания и лишних пробелов"""
+    return re.sub(r'[\W_]+', ' ', text.casefold()).strip()
+
+
+def text_key(text: str):
+    """Ключ текста или None, если текст слишком короткий"""
+    text = normalize_text(text)
+    return _key('t', text) if len(text) >= MIN_TEXT_LENGTH else None
+
+
+def media_key(file_unique_id: str) -> int:
+    """Ключ файла: file_unique_id одинаков у одного файла, кто бы его ни прислал"""
+    return _key('f', file_unique_id)
+
+
+class DedupIndex:
+    """Индекс недавно опубликованного содержимого для отсева повторов.
+
+    В памяти хранятся ключи за окно window секунд, не больше max_items, в
+    порядке публикации; полный набор ключей лежит в таблице dedup. Пока
+    в памяти помещается все окно, проверка обходится без базы; если
+    старые ключи пришлось вытеснить, промахи проверяются запросом.
+
+    При shared=True ключи добавляют и другие экземпляры бота, поэтому
+    промах памяти всегда проверяется в общем хранилище.
+    """
+
+    # Как часто удалять из таблицы ключи старше окна (секунды)
+    PRUNE_INTERVAL = 3600
+
+    def __init__(self, state: StateBackend, window: float, max_items: int = 100000, shared: bool = False):
+        self.state = state
+        self.window = window
+        self.max_items = max_items
+        self.shared = shared
+        # ключ -> момент публикации (секунды Unix)
+        self._keys = OrderedDict()
+        # Память содержит все ключи, опубликованные после этого момента
+        self._complete_since = 0
+        self._pruned_at = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    async def load(self):
+        """Загружает в память последние ключи из базы и удаляет устаревшие"""
+        if not self.enabled:
+            return
+        now = int(time.time())
+        await self.state.prune_dedup_keys(now - self.window)
+        self._pruned_at = now
+        rows = await self.state.load_dedup_keys(now - self.window, self.max_items)
+        # Строки идут от новых к старым
+        for key, seen_at in reversed(rows):
+            self._keys[key] = seen_at
+        if len(rows) >= self.max_items:
+            self._complete_since = rows[-1][1]
+
+    async def seen(self, keys: list) -> bool:
+        """Публиковалось ли что-то из keys за последнее окно"""
+        if not self.enabled or not keys:
+            return False
+        since = int(time.time()) - self.window
+        for key in keys:
+            seen_at = self._keys.get(key)
+            if seen_at is not None and seen_at > since:
+                return True
+        if self.shared or self._complete_since > since:
+            return await self.state.dedup_keys_seen(keys, since)
+        return False
+
+    async def add(self, keys: list):
+        """Запоминает опубликованное содержимое"""
+        if not self.enabled or not keys:
+            return
+        now = int(time.time())
+        for key in keys:
+            self._keys[key] = now
+            self._keys.move_to_end(key)
+        self._evict(now)
+        prune_before = None
+        if now - self._pruned_at >= self.PRUNE_INTERVAL:
+            self._pruned_at = now
+            prune_before = now - self.window
+        await self.state.add_dedup_keys(keys, now, prune_before)
+
+    def _evict(self, now: int):
+        since = now - self.window
+        keys = self._keys
+        while keys:
+            key, seen_at = next(iter(keys.items()))
+            if seen_at > since and len(keys) <= self.max_items:
+                break
+            del keys[key]
+            if seen_at > since:
+                # Вытеснен ключ из окна: теперь память знает не все окно
+                self._complete_since = max(self._complete_since, seen_at)
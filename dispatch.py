@@ -0,0 +1,201 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import OrderedDict
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+
+class PrioritySlots:
+    """Семафор, который при освобождении места пропускает вперед ожидающего с меньшим priority.
+
+    Внутри одного приоритета ожидающие проходят в порядке прихода.
+    """
+
+    def __init__(self, size: int):
+        self._free = size
+        # (приоритет, порядковый номер, Future)
+        self._waiters = []
+        self._order = itertools.count()
+
+    async def acquire(self, priority: int = 0):
+        if self._free > 0 and not self._waiters:
+            self._free -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Место уже выделено, но ждать его перестали: передаем дальше
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            future = heapq.heappop(self._waiters)[2]
+            if not future.done():
+                future.set_result(None)
+                return
+        self._free += 1
+
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений с сохранением порядка для каждого пользователя.
+
+    Обновления разных пользователей обрабатываются одновременно (не более
+    max_concurrent_updates сразу), а обновления одного пользователя — строго
+    по очереди, поэтому состояние в user_data не ломается. Блокировки
+    пользователей удаляются, как только у пользователя не остается обновлений.
+
+    max_pending ограничивает общее число обновлений в работе, включая
+    ожидающие своей очереди.
+
+    priority(update) -> int задает класс обновления: освободившееся место
+    получает ожидающее обновление с наименьшим классом. Когда очередь
+    ожидающих места (без ждущих предыдущих обновлений своего пользователя)
+    длиннее max_backlog или самое старое из них ждет дольше
+    max_backlog_age секунд, новые обновления классов от shed_from и ниже
+    не обрабатываются, а передаются в on_shed(update) (например, чтобы
+    попросить автора повторить позже). Части одного альбома получают то же
+    решение, что и первая, чтобы альбом не публиковался обрезанным.
+    """
+
+    # Сколько последних альбомов помнить для единого решения по их частям
+    MEDIA_GROUP_MEMORY = 1000
+
+    def __init__(self, max_concurrent_updates: int, max_pending: int = 1024, priority=None,
+                 max_backlog: int = None, max_backlog_age: float = None, shed_from: int = None,
+                 on_shed=None, shed: Counter = None, class_names: list = None):
+        super().__init__(max(max_pending, max_concurrent_updates, 2))
+        self.concurrency = max_concurrent_updates
+        self.priority = priority
+        self.max_backlog = max_backlog
+        self.max_backlog_age = max_backlog_age
+        self.shed_from = shed_from
+        self.on_shed = on_shed
+        # Счетчик сброшенных обновлений с меткой по имени класса
+        self.shed = shed
+        self.class_names = class_names
+        self._slots = None
+        # ключ пользователя -> [блокировка, число обновлений в работе]
+        self._locks = {}
+        # Обновления, ждущие слота: номер -> с какого момента ждут (в порядке постановки)
+        self._waiting = OrderedDict()
+        self._order = itertools.count()
+        # media_group_id -> сброшен ли альбом
+        self._groups = OrderedDict()
+        self._tasks = set()
+
+    @property
+    def active_users(self) -> int:
+        """Количество пользователей, у которых сейчас есть обновления в работе"""
+        return len(self._locks)
+
+    @property
+    def backlog(self) -> int:
+        """Количество обновлений, ожидающих своей очереди"""
+        return len(self._waiting)
+
+    @property
+    def backlog_age(self) -> float:
+        """Сколько секунд ждет самое старое ожидающее обновление"""
+        if not self._waiting:
+            return 0
+        return time.monotonic() - next(iter(self._waiting.values()))
+
+    async def initialize(self):
+        self._slots = PrioritySlots(self.concurrency)
+
+    async def shutdown(self):
+        pass
+
+    @staticmethod
+    def _key(update: object):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    def _overloaded(self) -> bool:
+        if self.max_backlog is not None and self.backlog >= self.max_backlog:
+            return True
+        return self.max_backlog_age is not None and self.backlog_age >= self.max_backlog_age
+
+    def _should_shed(self, update: object, priority: int) -> bool:
+        if self.shed_from is None or priority < self.shed_from:
+            return False
+        group_id = None
+        if isinstance(update, Update) and update.message is not None:
+            group_id = update.message.media_group_id
+        if group_id is not None and group_id in self._groups:
+            return self._groups[group_id]
+        shed = self._overloaded()
+        if group_id is not None:
+            self._groups[group_id] = shed
+            if len(self._groups) > self.MEDIA_GROUP_MEMORY:
+                self._groups.popitem(last=False)
+        return shed
+
+    def _shed(self, update: object, priority: int, coroutine):
+        # Корутина обработки так и не будет запущена
+        coroutine.close()
+        if self.shed is not None:
+            name = self.class_names[priority] if self.class_names else str(priority)
+            self.shed.labels(name).inc()
+        if self.on_shed is not None:
+            task = asyncio.create_task(self.on_shed(update))
+            self._tasks.add(task)
+            task.add_done_callback(self._done)
+
+    def _done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Не удалось ответить на сброшенное обновление: %s", task.exception())
+
+    async def do_process_update(self, update: object, coroutine):
+        priority = self.priority(update) if self.priority is not None else 0
+        if self._should_shed(update, priority):
+            self._shed(update, priority, coroutine)
+            return
+
+        key = self._key(update)
+        if key is None:
+            await self._run(priority, coroutine)
+            return
+
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run(priority, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def _run(self, priority: int, coroutine):
+        # Ожидающими считаются только обновления в очереди за слотом: очередь сообщений
+        # одного пользователя к своей блокировке — не перегрузка бота
+        number = next(self._order)
+        self._waiting[number] = time.monotonic()
+        try:
+            await self._slots.acquire(priority)
+        finally:
+            self._waiting.pop(number, None)
+        try:
+            await coroutine
+        finally:
+            self._slots.release()
@@ -0,0 +1,229 @@
+import asyncio
+import json
+import random
+import time
+from urllib.parse import parse_qsl
+
+# Ответы без тела для методов, результат которых боту не важен
+TRUE_METHODS = (
+    "answerCallbackQuery", "deleteMessage", "deleteWebhook", "setWebhook",
+    "setMyCommands", "close", "logOut",
+)
+
+
+class FakeBotAPI:
+    """Локальная имитация Telegram Bot API для нагрузочного тестирования.
+
+    Бот подключается к ней через BOT_API_URL. Обновления добавляются методом
+    push и отдаются боту через getUpdates, ответы бота записываются в calls.
+    latency задает задержку каждого ответа, error_rate — долю ответов
+    429 Too Many Requests с retry_after секунд.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0,
+                 error_rate: float = 0.0, retry_after: int = 1):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        # (время, метод, параметры) для каждого успешного вызова
+        self.calls = []
+        # Чаты, в которые бот не может писать (пользователь заблокировал бота)
+        self.forbidden = set()
+        self.throttled = 0
+        self._updates = asyncio.Queue()
+        self._update_id = 0
+        self._message_id = 0
+        # [(условие, future)] ожидающих определенного ответа бота
+        self._waiters = []
+        self._server = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/bot"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def next_message_id(self) -> int:
+        self._message_id += 1
+        return self._message_id
+
+    def push(self, kind: str, payload: dict):
+        """Добавляет обновление вида kind (message, callback_query) в очередь getUpdates"""
+        self._update_id += 1
+        self._updates.put_nowait({"update_id": self._update_id, kind: payload})
+
+    def expect(self, predicate) -> asyncio.Future:
+        """Future с первым вызовом бота, для которого predicate(method, params) истинно.
+
+        Ожидание регистрируется сразу, поэтому его создают до отправки
+        обновления, на которое бот должен ответить.
+        """
+        future = asyncio.get_running_loop().create_future()
+        waiter = (predicate, future)
+        self._waiters.append(waiter)
+        future.add_done_callback(lambda _: self._waiters.remove(waiter))
+        return future
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length") or 0)
+                body = await reader.readexactly(length) if length else b""
+
+                status, result = await self._dispatch(target.split("?", 1)[0], headers, body)
+                content = json.dumps(result).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} OK\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(content)}\r\n\r\n".encode("latin-1") + content
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # Незавершенный getUpdates при остановке цикла событий
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _params(headers: dict, body: bytes) -> dict:
+        content_type = headers.get("content-type", "")
+        if content_type.startswith("application/x-www-form-urlencoded"):
+            return dict(parse_qsl(body.decode(), keep_blank_values=True))
+        if content_type.startswith("application/json"):
+            return json.loads(body or b"{}")
+        if content_type.startswith("multipart/form-data"):
+            boundary = content_type.split("boundary=", 1)[1].strip('"').encode()
+            params = {}
+            for part in body.split(b"--" + boundary):
+                head, _, value = part.partition(b"\r\n\r\n")
+                if b'name="' not in head:
+                    continue
+                name = head.split(b'name="', 1)[1].split(b'"', 1)[0].decode()
+                value = value[:-2]
+                params[name] = value if b"filename=" in head else value.decode()
+            return params
+        return {}
+
+    async def _dispatch(self, path: str, headers: dict, body: bytes):
+        method = path.rsplit("/", 1)[-1]
+        params = self._params(headers, body)
+        if method != "getUpdates":
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if self.error_rate and method != "getMe" and random.random() < self.error_rate:
+                self.throttled += 1
+                return 429, {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }
+            if str(params.get("chat_id")) in self.forbidden:
+                return 403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+
+        handler = getattr(self, "_m_" + method, None)
+        if handler is not None:
+            result = await handler(params)
+        elif method in TRUE_METHODS:
+            result = True
+        else:
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found: method not found"}
+
+        if method != "getUpdates":
+            self.calls.append((time.monotonic(), method, params))
+            for predicate, future in list(self._waiters):
+                if not future.done() and predicate(method, params):
+                    future.set_result((method, params, result))
+        return 200, {"ok": True, "result": result}
+
+    def _message(self, params: dict, **fields) -> dict:
+        try:
+            chat_id = int(params.get("chat_id", 0))
+        except ValueError:
+            chat_id = 0
+        message = {
+            "message_id": self.next_message_id(),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "channel"},
+        }
+        message.update(fields)
+        return message
+
+    @staticmethod
+    def _file(file_id) -> dict:
+        file_id = file_id if isinstance(file_id, str) else "uploaded"
+        return {"file_id": file_id, "file_unique_id": "u" + file_id}
+
+    async def _m_getMe(self, params: dict):
+        return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+    async def _m_getUpdates(self, params: dict):
+        timeout = float(params.get("timeout") or 0)
+        try:
+            updates = [await asyncio.wait_for(self._updates.get(), timeout or 0.01)]
+        except asyncio.TimeoutError:
+            return []
+        limit = int(params.get("limit") or 100)
+        while not self._updates.empty() and len(updates) < limit:
+            updates.append(self._updates.get_nowait())
+        return updates
+
+    async def _m_getWebhookInfo(self, params: dict):
+        return {"url": "", "has_custom_certificate": False, "pending_update_count": self._updates.qsize()}
+
+    async def _m_sendMessage(self, params: dict):
+        return self._message(params, text=params.get("text", ""))
+
+    async def _m_editMessageText(self, params: dict):
+        return self._message(params, text=params.get("text", ""))
+
+    async def _m_copyMessage(self, params: dict):
+        return {"message_id": self.next_message_id()}
+
+    async def _m_sendPhoto(self, params: dict):
+        photo = dict(self._file(params.get("photo")), width=1, height=1)
+        return self._message(params, photo=[photo], caption=params.get("caption"))
+
+    async def _m_sendVideo(self, params: dict):
+        video = dict(self._file(params.get("video")), width=1, height=1, duration=1)
+        return self._message(params, video=video, caption=params.get("caption"))
+
+    async def _m_sendDocument(self, params: dict):
+        return self._message(params, document=self._file(params.get("document")), caption=params.get("caption"))
+
+    async def _m_sendVoice(self, params: dict):
+        return self._message(params, voice=dict(self._file(params.get("voice")), duration=1))
+
+    async def _m_sendVideoNote(self, params: dict):
+        return self._message(params, video_note=dict(self._file(params.get("video_note")), length=1, duration=1))
+
+    async def _m_sendMediaGroup(self, params: dict):
+        media = params.get("media", "[]")
+        media = json.loads(media) if isinstance(media, str) else media
+        return [
+            self._message(params, photo=[dict(self._file(item.get("media")), width=1, height=1)])
+            for item in media
+        ]
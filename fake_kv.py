@@ -0,0 +1,279 @@
+"""Локальная замена сетевого хранилища для проверки KVState без Redis.
+
+Запуск отдельным процессом: python fake_kv.py [порт]; затем боту задается
+STATE_BACKEND=kv и KV_URL=redis://127.0.0.1:порт. Данные хранятся только
+в памяти процесса.
+"""
+import asyncio
+import sys
+
+from kv import KVError
+
+
+def _score(value: bytes) -> float:
+    value = value.decode()
+    if value in ("-inf", "+inf", "inf"):
+        return float(value)
+    return float(value.lstrip("("))
+
+
+def _in_range(score: float, low: bytes, high: bytes) -> bool:
+    low_value, high_value = _score(low), _score(high)
+    above = score > low_value if low.startswith(b"(") else score >= low_value
+    below = score < high_value if high.startswith(b"(") else score <= high_value
+    return above and below
+
+
+def _format_score(score: float) -> bytes:
+    return str(int(score) if score == int(score) else score).encode()
+
+
+class LocalKV:
+    """Сервер с протоколом RESP и теми командами, которые использует KVState.
+
+    Строки, хэши и упорядоченные множества хранятся в словарях; диапазоны
+    упорядоченных множеств сортируются при каждом запросе, чего для
+    проверки и небольших нагрузок достаточно.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port
+        self.data = {}
+        # Число выполненных команд по именам
+        self.commands = {}
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        return f"redis://{self.host}:{self.port}/0"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # Команды открытой транзакции (MULTI) этого соединения
+        queued = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.startswith(b"*"):
+                    writer.write(b"-ERR protocol error\r\n")
+                    break
+                args = []
+                for _ in range(int(line[1:])):
+                    length = int((await reader.readline())[1:])
+                    args.append((await reader.readexactly(length + 2))[:-2])
+                name = args[0].upper()
+                try:
+                    if name == b"MULTI":
+                        # Команды транзакции копятся и выполняются в EXEC без переключения
+                        # на другие соединения, поэтому транзакция атомарна
+                        queued, reply = [], True
+                    elif name == b"EXEC":
+                        if queued is None:
+                            raise KVError("ERR EXEC without MULTI")
+                        reply = [self._run_queued(command) for command in queued]
+                        queued = None
+                    elif queued is not None:
+                        queued.append(args)
+                        reply = b"QUEUED"
+                    else:
+                        reply = self.execute(args)
+                except KVError as e:
+                    writer.write(f"-{e}\r\n".encode())
+                else:
+                    writer.write(self._encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    def _encode(self, reply) -> bytes:
+        if isinstance(reply, KVError):
+            return f"-{reply}\r\n".encode()
+        if reply is None:
+            return b"$-1\r\n"
+        if reply is True:
+            return b"+OK\r\n"
+        if isinstance(reply, int):
+            return b":%d\r\n" % reply
+        if isinstance(reply, list):
+            return b"*%d\r\n" % len(reply) + b"".join(self._encode(item) for item in reply)
+        return b"$%d\r\n%s\r\n" % (len(reply), reply)
+
+    def execute(self, args: list):
+        name = args[0].decode().upper()
+        self.commands[name] = self.commands.get(name, 0) + 1
+        handler = getattr(self, "_cmd_" + name.lower(), None)
+        if handler is None:
+            raise KVError(f"ERR unknown command '{name}'")
+        return handler(*args[1:])
+
+    def _run_queued(self, args: list):
+        try:
+            return self.execute(args)
+        except KVError as e:
+            # Как и в Redis, ошибка одной команды не отменяет остальные
+            return e
+
+    def _typed(self, key: bytes, kind: type):
+        value = self.data.get(key)
+        if value is not None and not isinstance(value, kind):
+            raise KVError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    # Служебные и строки
+
+    def _cmd_ping(self, *args):
+        return True
+
+    def _cmd_select(self, database):
+        return True
+
+    def _cmd_auth(self, *args):
+        return True
+
+    def _cmd_get(self, key):
+        return self._typed(key, bytes)
+
+    def _cmd_set(self, key, value):
+        self.data[key] = value
+        return True
+
+    def _cmd_del(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def _cmd_incr(self, key):
+        value = int(self._typed(key, bytes) or 0) + 1
+        self.data[key] = str(value).encode()
+        return value
+
+    # Хэши
+
+    def _hash(self, key):
+        value = self._typed(key, dict)
+        if value is None:
+            value = self.data[key] = {}
+        return value
+
+    def _cmd_hget(self, key, field):
+        return (self._typed(key, dict) or {}).get(field)
+
+    def _cmd_hset(self, key, *pairs):
+        value = self._hash(key)
+        added = 0
+        for index in range(0, len(pairs), 2):
+            added += pairs[index] not in value
+            value[pairs[index]] = pairs[index + 1]
+        return added
+
+    def _cmd_hsetnx(self, key, field, item):
+        value = self._hash(key)
+        if field in value:
+            return 0
+        value[field] = item
+        return 1
+
+    def _cmd_hdel(self, key, *fields):
+        value = self._typed(key, dict) or {}
+        return sum(value.pop(field, None) is not None for field in fields)
+
+    def _cmd_hkeys(self, key):
+        return list(self._typed(key, dict) or {})
+
+    def _cmd_hmget(self, key, *fields):
+        value = self._typed(key, dict) or {}
+        return [value.get(field) for field in fields]
+
+    def _cmd_hgetall(self, key):
+        return [item for pair in (self._typed(key, dict) or {}).items() for item in pair]
+
+    # Упорядоченные множества (хранятся как {член: счет})
+
+    def _sorted(self, key, reverse: bool = False) -> list:
+        value = self._typed(key, dict) or {}
+        return sorted(value.items(), key=lambda item: (item[1], item[0]), reverse=reverse)
+
+    @staticmethod
+    def _reply(items: list, options: tuple) -> list:
+        options = [option.upper() for option in options]
+        if b"LIMIT" in options:
+            index = options.index(b"LIMIT")
+            offset, count = int(options[index + 1]), int(options[index + 2])
+            items = items[offset:offset + count] if count >= 0 else items[offset:]
+        if b"WITHSCORES" in options:
+            return [item for member, score in items for item in (member, _format_score(score))]
+        return [member for member, _ in items]
+
+    def _cmd_zadd(self, key, *pairs):
+        only_new = bool(pairs) and pairs[0].upper() == b"NX"
+        if only_new:
+            pairs = pairs[1:]
+        value = self._hash(key)
+        added = 0
+        for index in range(0, len(pairs), 2):
+            if only_new and pairs[index + 1] in value:
+                continue
+            added += pairs[index + 1] not in value
+            value[pairs[index + 1]] = float(pairs[index])
+        return added
+
+    def _cmd_zrem(self, key, *members):
+        value = self._typed(key, dict) or {}
+        removed = [member for member in members if member in value]
+        for member in removed:
+            del value[member]
+        return len(removed)
+
+    def _cmd_zscore(self, key, member):
+        score = (self._typed(key, dict) or {}).get(member)
+        return None if score is None else _format_score(score)
+
+    def _cmd_zmscore(self, key, *members):
+        return [self._cmd_zscore(key, member) for member in members]
+
+    def _cmd_zrevrange(self, key, start, stop, *options):
+        items = self._sorted(key, reverse=True)
+        stop = int(stop)
+        items = items[int(start):stop + 1 if stop >= 0 else len(items) + stop + 1]
+        return self._reply(items, options)
+
+    def _cmd_zrangebyscore(self, key, low, high, *options):
+        items = [item for item in self._sorted(key) if _in_range(item[1], low, high)]
+        return self._reply(items, options)
+
+    def _cmd_zrevrangebyscore(self, key, high, low, *options):
+        items = [item for item in self._sorted(key, reverse=True) if _in_range(item[1], low, high)]
+        return self._reply(items, options)
+
+    def _cmd_zremrangebyscore(self, key, low, high):
+        value = self._typed(key, dict) or {}
+        removed = [member for member, score in value.items() if _in_range(score, low, high)]
+        for member in removed:
+            del value[member]
+        return len(removed)
+
+
+async def _serve(port: int):
+    server = LocalKV(port=port)
+    await server.start()
+    print(f"Хранилище слушает {server.url}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(_serve(int(sys.argv[1]) if len(sys.argv) > 1 else 6379))
+    except KeyboardInterrupt:
+        pass
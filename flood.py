@@ -0,0 +1,131 @@
+import time
+from array import array
+from collections import OrderedDict
+
+
+def parse_limits(spec: str) -> dict:
+    """Разбирает лимиты вида "message=20/60,button=5/5" в {действие: (событий, секунд)}.
+
+    Поднимает ValueError, если событий меньше одного или окно не положительное.
+    """
+    limits = {}
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        action, _, rate = part.partition("=")
+        count, _, seconds = rate.partition("/")
+        count, seconds = int(count), float(seconds)
+        # Пустой буфер или окно нулевой длины сломали бы проверку: ошибку видно сразу при запуске
+        if count < 1 or not seconds > 0:
+            raise ValueError(f"Неверный лимит {part!r}: нужно не меньше 1 события за положительное число секунд")
+        limits[action.strip()] = (count, seconds)
+    return limits
+
+
+class _Window:
+    """Скользящее окно: кольцевой буфер моментов последних count принятых событий"""
+
+    __slots__ = ('times', 'head', 'seconds')
+
+    def __init__(self, count: int, seconds: float):
+        self.times = array('d', [float('-inf')]) * count
+        self.head = 0
+        self.seconds = seconds
+
+    def full(self, now: float) -> bool:
+        # В head лежит самое старое событие: если оно еще в окне, окно заполнено
+        return self.times[self.head] > now - self.seconds
+
+    def add(self, now: float):
+        self.times[self.head] = now
+        self.head = (self.head + 1) % len(self.times)
+
+    def clear(self):
+        for index in range(len(self.times)):
+            self.times[index] = float('-inf')
+
+
+class _UserState:
+    __slots__ = ('windows', 'strikes', 'limited', 'last_seen', 'last_group')
+
+    def __init__(self, limits: dict, strikes: tuple):
+        self.windows = {action: _Window(count, seconds) for action, (count, seconds) in limits.items()}
+        self.strikes = _Window(*strikes)
+        # Пользователь уже получил отказ и с тех пор не прошел ни одного события
+        self.limited = False
+        self.last_seen = 0.0
+        self.last_group = None
+
+
+class FloodControl:
+    """Ограничение частоты действий каждого пользователя.
+
+    Для каждого действия (сообщения, нажатия кнопок, отправки в канал)
+    хранится кольцевой буфер моментов последних разрешенных событий;
+    событие отклоняется, если самое старое из них еще не вышло из окна.
+    Отказы молча отбрасываются; первый отказ каждой серии засчитывается
+    как нарушение (WARN), а следующая серия после strikes нарушений за
+    окно — повод для бана (BAN). Пользователи без активности дольше самого
+    длинного окна вытесняются из памяти.
+    """
+
+    # Результаты check
+    OK = 0
+    DROP = 1
+    # Отказ, засчитанный как нарушение; пользователю ничего не отправляется
+    WARN = 2
+    BAN = 3
+
+    def __init__(self, limits: dict, strikes: tuple = (3, 600), max_users: int = 100000):
+        self.limits = limits
+        self.strikes = strikes
+        self.max_users = max_users
+        self._ttl = max([seconds for _, seconds in limits.values()] + [strikes[1]])
+        self._users = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def check(self, tg_id: int, actions: tuple, media_group_id: str = None, now: float = None) -> int:
+        """Учитывает событие пользователя и решает, пропускать ли его.
+
+        Элементы одного альбома считаются одним сообщением.
+        """
+        now = time.monotonic() if now is None else now
+        state = self._users.get(tg_id)
+        if state is None:
+            state = self._users[tg_id] = _UserState(self.limits, self.strikes)
+        else:
+            self._users.move_to_end(tg_id)
+        state.last_seen = now
+        self._evict(now)
+
+        if media_group_id is not None:
+            if media_group_id == state.last_group:
+                return self.DROP if state.limited else self.OK
+            state.last_group = media_group_id
+
+        windows = [state.windows[action] for action in actions if action in state.windows]
+        if not any(window.full(now) for window in windows):
+            for window in windows:
+                window.add(now)
+            state.limited = False
+            return self.OK
+
+        if state.limited:
+            return self.DROP
+        state.limited = True
+        if state.strikes.full(now):
+            state.strikes.clear()
+            return self.BAN
+        state.strikes.add(now)
+        return self.WARN
+
+    def _evict(self, now: float):
+        users = self._users
+        while users:
+            tg_id, state = next(iter(users.items()))
+            if state.last_seen > now - self._ttl and len(users) <= self.max_users:
+                break
+            del users[tg_id]
@@ -0,0 +1,77 @@
+import time
+from collections import OrderedDict
+
+from state import StateBackend
+
+
+class IdentityCache:
+    """Ограниченный LRU-кэш соответствия tg_id -> внутренний ID пользователя.
+
+    Прогревается при запуске последними пользователями и дополняется по
+    запросу, поэтому на горячем пути ID определяется без обращения к базе.
+    Отсутствие пользователя помнится missing_ttl секунд (не больше
+    missing_size записей), чтобы поток сообщений от незарегистрированных
+    не уходил в базу каждый раз.
+    """
+
+    def __init__(self, state: StateBackend, maxsize: int = 10000, missing_size: int = 1000, missing_ttl: float = 30):
+        self.state = state
+        self.maxsize = maxsize
+        self.missing_size = missing_size
+        self.missing_ttl = missing_ttl
+        self._ids = OrderedDict()
+        # tg_id -> до какого момента считать, что пользователя нет (в порядке добавления)
+        self._missing = OrderedDict()
+
+    async def warm(self):
+        """Заполняет кэш последними зарегистрированными пользователями"""
+        # Запрос отсортирован по убыванию ID, поэтому вставляем в обратном
+        # порядке: самые новые пользователи окажутся в конце LRU
+        for tg_id, user_id in reversed(await self.state.get_recent_user_ids(self.maxsize)):
+            self._ids[tg_id] = user_id
+
+    def get(self, tg_id: int):
+        """Возвращает ID из кэша или None"""
+        user_id = self._ids.get(tg_id)
+        if user_id is not None:
+            self._ids.move_to_end(tg_id)
+        return user_id
+
+    def put(self, tg_id: int, user_id: int):
+        """Добавляет соответствие в кэш, вытесняя самое старое"""
+        self._missing.pop(tg_id, None)
+        self._ids[tg_id] = user_id
+        self._ids.move_to_end(tg_id)
+        if len(self._ids) > self.maxsize:
+            self._ids.popitem(last=False)
+
+    async def lookup(self, tg_id: int):
+        """ID существующего пользователя или None; пользователь не создается"""
+        user_id = self.get(tg_id)
+        if user_id is not None:
+            return user_id
+        now = time.monotonic()
+        expires = self._missing.get(tg_id)
+        if expires is not None:
+            if expires > now:
+                return None
+            del self._missing[tg_id]
+        user_id = await self.state.get_user_id(tg_id)
+        if user_id is not None:
+            self.put(tg_id, user_id)
+            return user_id
+        # Пользователь может зарегистрироваться позже (в том числе через другой
+        # экземпляр бота), поэтому отсутствие помнится недолго
+        self._missing[tg_id] = now + self.missing_ttl
+        if len(self._missing) > self.missing_size:
+            self._missing.popitem(last=False)
+        return None
+
+    async def resolve(self, tg_id: int, username: str = None) -> int:
+        """Получить или создать пользователя, обращаясь к базе только при промахе кэша"""
+        user_id = self.get(tg_id)
+        if user_id is None:
+            # put снимает и запись об отсутствии пользователя
+            user_id = await self.state.get_or_create_user(tg_id, username)
+            self.put(tg_id, user_id)
+        return user_id
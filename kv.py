@@ -0,0 +1,115 @@
+import asyncio
+from urllib.parse import urlparse
+
+
+class KVError(Exception):
+    """Ошибка, которую вернул сервер"""
+
+
+def _encode(args) -> bytes:
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, bytes):
+            value = arg
+        elif isinstance(arg, str):
+            value = arg.encode()
+        else:
+            value = str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(value), value))
+    return b"".join(parts)
+
+
+class KVClient:
+    """Минимальный клиент хранилища ключ-значение с протоколом RESP (Redis, Valkey, KeyDB).
+
+    Одно соединение на процесс: команды отправляются пачками (pipeline),
+    а ответы читаются в том же порядке, поэтому запросы разных корутин
+    выполняются по очереди. Разорванное соединение переоткрывается при
+    следующем запросе. Ответы возвращаются как есть: строки — bytes.
+    """
+
+    def __init__(self, url: str = "redis://127.0.0.1:6379/0", timeout: float = 5):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.database = int(parsed.path.strip("/") or 0)
+        self.timeout = timeout
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    async def connect(self):
+        """Открывает соединение, авторизуется и выбирает базу"""
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout
+        )
+        commands = []
+        if self.password:
+            commands.append(("AUTH", self.password))
+        if self.database:
+            commands.append(("SELECT", self.database))
+        if commands:
+            try:
+                await self._exchange(commands)
+            except Exception:
+                await self.close()
+                raise
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._reader = None
+
+    async def execute(self, *args):
+        """Выполняет одну команду и возвращает ответ"""
+        return (await self.pipeline([args]))[0]
+
+    async def pipeline(self, commands: list) -> list:
+        """Отправляет команды одним пакетом и возвращает ответы на них.
+
+        Если сервер отклонил хотя бы одну команду, после чтения всех
+        ответов поднимается KVError (остальные команды уже выполнены).
+        """
+        async with self._lock:
+            if self._writer is None:
+                await self.connect()
+            try:
+                return await asyncio.wait_for(self._exchange(commands), self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                # После сбоя неизвестно, сколько ответов осталось в соединении
+                await self.close()
+                raise
+
+    async def _exchange(self, commands: list) -> list:
+        self._writer.write(b"".join(_encode(command) for command in commands))
+        await self._writer.drain()
+        replies = [await self._read_reply() for _ in commands]
+        for reply in replies:
+            if isinstance(reply, KVError):
+                raise reply
+        return replies
+
+    async def _read_reply(self):
+        line = await self._reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Соединение с хранилищем закрыто")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload
+        if kind == b"-":
+            return KVError(payload.decode(errors="replace"))
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            return (await self._reader.readexactly(length + 2))[:-2]
+        if kind == b"*":
+            length = int(payload)
+            if length < 0:
+                return None
+            return [await self._read_reply() for _ in range(length)]
+        raise ConnectionError(f"Неизвестный ответ хранилища: {line[:20]!r}")
@@ -0,0 +1,44 @@
+from telegram import Update
+from telegram.ext import Application, ApplicationHandlerStop, ContextTypes, TypeHandler
+
+from metrics import Counter
+
+
+class Pipeline:
+    """Цепочка проверок обновления до обработчиков.
+
+    Middleware — корутинная функция (update, context) -> bool. Цепочка
+    выполняется одним TypeHandler в отрицательной группе, то есть раньше
+    любых обработчиков. Middleware вызываются в порядке добавления; первая,
+    вернувшая False, отклоняет обновление: остальные проверки и все
+    обработчики для него не вызываются. Сама цепочка в Bot API не обращается.
+    """
+
+    def __init__(self, rejected: Counter = None):
+        # Счетчик отклоненных обновлений с меткой по имени middleware
+        self.rejected = rejected
+        self._middlewares = []
+
+    def add(self, middleware):
+        """Добавляет middleware в конец цепочки; подходит и как декоратор"""
+        counter = self.rejected.labels(middleware.__name__) if self.rejected is not None else None
+        self._middlewares.append((middleware, counter))
+        return middleware
+
+    async def run_middleware(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        for middleware, counter in self._middlewares:
+            if not await middleware(update, context):
+                if counter is not None:
+                    counter.inc()
+                raise ApplicationHandlerStop
+
+    def register(self, application: Application, group: int = -100):
+        application.add_handler(TypeHandler(Update, self.run_middleware), group=group)
+
+
+def command_name(update: Update):
+    """Имя команды (/ban@bot -> "ban") или None, если сообщение — не команда"""
+    message = update.message
+    if message is None or not message.text or not message.text.startswith("/"):
+        return None
+    return message.text.split(maxsplit=1)[0][1:].split("@", 1)[0].lower()
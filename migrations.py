@@ -0,0 +1,195 @@
+import logging
+import sqlite3
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Размер порции строк при переносе данных: каждая порция — отдельная короткая
+# транзакция, поэтому бот может работать с базой во время миграции
+BATCH_SIZE = 500
+
+
+def _initial_schema(conn: sqlite3.Connection):
+    """Исходная схема бота"""
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tg_id INTEGER UNIQUE,
+                username TEXT,
+                created_at INTEGER
+            )
+        ''')
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(users)")]
+        if 'created_at' not in columns:
+            conn.execute("ALTER TABLE users ADD COLUMN created_at INTEGER")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS bans (
+                user_id INTEGER PRIMARY KEY,
+                ban_until TIMESTAMP,
+                reason TEXT,
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS user_state (
+                tg_id INTEGER PRIMARY KEY,
+                data BLOB
+            )
+        ''')
+
+
+def _ban_until_to_epoch(conn: sqlite3.Connection):
+    """bans.ban_until: ISO-строка -> секунды Unix, плюс индекс для фильтрации по сроку"""
+    while True:
+        rows = conn.execute(
+            "SELECT user_id, ban_until FROM bans WHERE typeof(ban_until) = 'text' LIMIT ?",
+            (BATCH_SIZE,)
+        ).fetchall()
+        if not rows:
+            break
+        with conn:
+            conn.executemany(
+                "UPDATE bans SET ban_until = ? WHERE user_id = ?",
+                [(int(datetime.fromisoformat(ban_until).timestamp()), user_id) for user_id, ban_until in rows]
+            )
+    with conn:
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_bans_ban_until ON bans (ban_until)")
+
+
+def _admin_indexes(conn: sqlite3.Connection):
+    """Индексы для фильтров /takedb"""
+    with conn:
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at)")
+
+
+def _broadcasts(conn: sqlite3.Connection):
+    """Рассылки: отметка заблокировавших бота и таблица контрольных точек"""
+    with conn:
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(users)")]
+        if 'blocked' not in columns:
+            conn.execute("ALTER TABLE users ADD COLUMN blocked INTEGER NOT NULL DEFAULT 0")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                text TEXT,
+                source_chat_id INTEGER,
+                source_message_id INTEGER,
+                status TEXT NOT NULL DEFAULT 'running',
+                last_user_id INTEGER NOT NULL DEFAULT 0,
+                total INTEGER NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                blocked INTEGER NOT NULL DEFAULT 0,
+                status_chat_id INTEGER,
+                status_message_id INTEGER,
+                created_at INTEGER
+            )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts (status)")
+
+
+def _broadcast_done_ids(conn: sqlite3.Connection):
+    """Рассылки: получатели за контрольной точкой, которым сообщение уже отправлено"""
+    with conn:
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(broadcasts)")]
+        if 'done_ids' not in columns:
+            conn.execute("ALTER TABLE broadcasts ADD COLUMN done_ids TEXT")
+
+
+def _moderation_queue(conn: sqlite3.Connection):
+    """Очередь модерации и отложенной публикации"""
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS moderation_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tg_id INTEGER NOT NULL,
+                user_id INTEGER,
+                data TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                status_chat_id INTEGER,
+                status_message_id INTEGER,
+                status_is_caption INTEGER NOT NULL DEFAULT 0,
+                created_at INTEGER,
+                decided_at INTEGER,
+                published_at INTEGER
+            )
+        ''')
+        # Все выборки очереди идут по статусу в порядке поступления
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_moderation_queue_status ON moderation_queue (status, id)")
+
+
+def _dedup(conn: sqlite3.Connection):
+    """Ключи недавно опубликованного содержимого для отсева повторов"""
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS dedup (
+                key INTEGER PRIMARY KEY,
+                seen_at INTEGER NOT NULL
+            )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_dedup_seen_at ON dedup (seen_at)")
+
+
+def _submissions(conn: sqlite3.Connection):
+    """Журнал отправок и счетчики по дням, типам и пользователям"""
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS submissions (
+                id INTEGER PRIMARY KEY,
+                created_at INTEGER NOT NULL,
+                user_id INTEGER,
+                type TEXT NOT NULL,
+                items INTEGER NOT NULL DEFAULT 1,
+                status TEXT NOT NULL
+            )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_submissions_user ON submissions (user_id, created_at)")
+        # Сводки обновляются вместе с журналом: scope — day, type, user или user_day
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS submission_totals (
+                scope TEXT NOT NULL,
+                key TEXT NOT NULL,
+                status TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (scope, key, status)
+            ) WITHOUT ROWID
+        ''')
+
+
+def _publications(conn: sqlite3.Connection):
+    """Статусы публикаций по ключам идемпотентности"""
+    with conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS publications (
+                key TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                updated_at INTEGER NOT NULL
+            ) WITHOUT ROWID
+        ''')
+
+
+# Порядок менять нельзя: номер миграции — ее позиция в списке, начиная с 1.
+# Новые миграции добавляются только в конец и должны быть повторяемыми,
+# так как бот может остановиться посреди миграции.
+MIGRATIONS = [
+    _initial_schema,
+    _ban_until_to_epoch,
+    _admin_indexes,
+    _broadcasts,
+    _broadcast_done_ids,
+    _moderation_queue,
+    _dedup,
+    _submissions,
+    _publications,
+]
+
+
+def migrate(conn: sqlite3.Connection):
+    """Применяет к базе все миграции новее PRAGMA user_version"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        logger.info("Миграция базы %d: %s", number, migration.__doc__)
+        migration(conn)
+        conn.execute(f"PRAGMA user_version = {number}")
@@ -0,0 +1,132 @@
+import asyncio
+import json
+import logging
+import time
+
+from telegram import Bot
+from telegram.error import TelegramError
+from telegram.ext import CallbackContext, JobQueue
+
+from database import Database
+from publisher import PublishCancelled, PublishUncertain, PublishUnavailable, TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class ModerationQueue:
+    """Очередь модерации с публикацией по расписанию.
+
+    Подтвержденные пользователями сообщения сохраняются в таблицу
+    moderation_queue. Администратор одобряет или отклоняет их пачками, а
+    планировщик раз в slot_interval секунд (слоты выровнены по часам)
+    передает в очередь публикаций не более slot_size одобренных сообщений.
+    """
+
+    JOB_NAME = "moderation_slots"
+
+    def __init__(self, db: Database, publish, limiter: TokenBucket, slot_interval: float = 600, slot_size: int = 1):
+        self.db = db
+        # publish(message_data, key) ставит сообщение в очередь публикаций и возвращает Future
+        self.publish = publish
+        self.limiter = limiter
+        self.slot_interval = slot_interval
+        self.slot_size = slot_size
+        self._bot = None
+        self._tasks = set()
+
+    async def start(self, job_queue: JobQueue, bot: Bot):
+        """Запускает планировщик слотов"""
+        self._bot = bot
+        # Публикации, прерванные остановкой бота, выпускаются заново
+        await self.db.reset_publishing()
+        first = self.slot_interval - time.time() % self.slot_interval
+        job_queue.run_repeating(self._release, interval=self.slot_interval, first=first, name=self.JOB_NAME)
+
+    async def stop(self):
+        """Дожидается отправки уведомлений авторам"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def submit(self, tg_id: int, user_id: int, message_data: dict, status_chat_id: int,
+                     status_message_id: int, status_is_caption: bool = False) -> int:
+        """Ставит подтвержденное сообщение в очередь, возвращает его номер.
+
+        status_* — сообщение автора, в котором потом показывается итог модерации.
+        """
+        return await self.db.add_queue_item(
+            tg_id, user_id, json.dumps(message_data, ensure_ascii=False),
+            status_chat_id, status_message_id, status_is_caption
+        )
+
+    async def page(self, after_id: int = 0, limit: int = 10):
+        """Страница ожидающих модерации: ([(id, user_id, message_data, created_at)], есть_ли_еще)"""
+        rows, has_more = await self.db.get_queue_page(after_id, limit)
+        return [(item_id, user_id, json.loads(data), created_at) for item_id, user_id, data, created_at in rows], has_more
+
+    async def counts(self) -> tuple:
+        """(ожидают модерации, одобрены и ждут слота)"""
+        counts = await self.db.get_queue_counts()
+        return counts.get('pending', 0), counts.get('approved', 0)
+
+    async def approve(self, ids: list = None) -> int:
+        """Одобряет ожидающие сообщения (ids=None — все), возвращает их количество"""
+        rows = await self.db.decide_queue_items('approved', ids)
+        return len(rows)
+
+    async def reject(self, ids: list = None) -> int:
+        """Отклоняет ожидающие сообщения (ids=None — все) и сообщает об этом авторам"""
+        rows = await self.db.decide_queue_items('rejected', ids)
+        self._notify([row[1:] for row in rows], "Сообщение отклонено модератором.")
+        return len(rows)
+
+    async def _release(self, context: CallbackContext):
+        rows = await self.db.take_approved(self.slot_size)
+        if not rows:
+            return
+        futures = []
+        for item_id, data, _, _, _ in rows:
+            futures.append(self.publish(json.loads(data), f"queue:{item_id}"))
+        outcomes = await asyncio.gather(*futures, return_exceptions=True)
+
+        results, published, failed, uncertain = [], [], [], []
+        for row, outcome in zip(rows, outcomes):
+            if isinstance(outcome, (PublishUnavailable, PublishCancelled)):
+                # Канал недоступен или бот останавливается: сообщение дождется следующего слота
+                results.append((row[0], 'approved'))
+            elif isinstance(outcome, PublishUncertain):
+                # Пост мог выйти: повторно его не публикуем
+                logger.warning("Неизвестно, вышло ли сообщение №%d из очереди: %s", row[0], outcome)
+                results.append((row[0], 'unknown'))
+                uncertain.append(row[2:])
+            elif isinstance(outcome, Exception):
+                logger.warning("Не удалось опубликовать сообщение №%d из очереди: %s", row[0], outcome)
+                results.append((row[0], 'failed'))
+                failed.append(row[2:])
+            else:
+                results.append((row[0], 'published'))
+                published.append(row[2:])
+        await self.db.finish_queue_items(results)
+        self._notify(published, "Сообщение успешно отправлено в канал!")
+        self._notify(failed, "Ошибка при отправке сообщения в канал.")
+        self._notify(uncertain, "Не удалось узнать, вышло ли сообщение в канал. Повторно оно не отправлялось.")
+
+    def _notify(self, targets: list, text: str):
+        """Показывает итог в сообщениях авторов: [(chat_id, message_id, это_подпись)]"""
+        targets = [target for target in targets if target[1]]
+        if not targets or self._bot is None:
+            return
+        task = asyncio.create_task(self._edit_statuses(targets, text))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _edit_statuses(self, targets: list, text: str):
+        for chat_id, message_id, is_caption in targets:
+            await self.limiter.acquire()
+            try:
+                if is_caption:
+                    await self._bot.edit_message_caption(chat_id=chat_id, message_id=message_id, caption=text)
+                else:
+                    await self._bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text)
+            except TelegramError as e:
+                # Автор удалил сообщение или заблокировал бота
+                logger.debug("Не удалось обновить статус сообщения %s/%s: %s", chat_id, message_id, e)
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import pickle
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from state import StateBackend
+
+logger = logging.getLogger(__name__)
+
+
+class StatePersistence(BasePersistence):
+    """Хранение user_data в общем состоянии бота (SQLite или хранилище ключ-значение).
+
+    Изменения копятся в памяти и записываются одной транзакцией раз в
+    update_interval секунд. Состояние пользователя загружается из базы не
+    при запуске, а при первом его обновлении (см. load_user).
+    """
+
+    # Окно, в течение которого изменения от одного прохода Application
+    # собираются в общую транзакцию
+    BATCH_WINDOW = 0.05
+
+    def __init__(self, state: StateBackend, update_interval: float = 5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.state = state
+        # user_id -> сериализованное состояние, ожидающее записи
+        self._dirty = {}
+        # user_id -> хэш последнего сохраненного состояния
+        self._saved = {}
+        self._flush_task = None
+
+    async def load_user(self, user_id: int, user_data: dict):
+        """Подгружает сохраненное состояние пользователя при первом обращении"""
+        if user_id in self._saved:
+            return
+        data = await self.state.load_user_state(user_id)
+        if user_id in self._saved:
+            # Состояние успели загрузить параллельно
+            return
+        self._saved[user_id] = hash(data)
+        if data:
+            for key, value in pickle.loads(data).items():
+                user_data.setdefault(key, value)
+
+    async def get_user_data(self) -> dict:
+        # Загрузка выполняется лениво в load_user
+        return {}
+
+    async def update_user_data(self, user_id: int, data: dict):
+        if user_id not in self._saved:
+            # Состояние не загружалось, перезаписывать сохраненное нельзя
+            return
+        blob = pickle.dumps(data) if data else None
+        if hash(blob) == self._saved[user_id]:
+            self._dirty.pop(user_id, None)
+            return
+        self._dirty[user_id] = blob
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def drop_user_data(self, user_id: int):
+        self._dirty[user_id] = None
+        await self.flush()
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        pass
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.BATCH_WINDOW)
+        self._flush_task = None
+        await self._write()
+
+    async def _write(self):
+        """Записывает накопленные изменения одной транзакцией"""
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        try:
+            await self.state.save_user_states(list(batch.items()))
+        except Exception:
+            logger.exception("Не удалось сохранить состояние %d пользователей", len(batch))
+            # Вернем неудавшиеся записи, если их не перекрыли более новые
+            for user_id, blob in batch.items():
+                self._dirty.setdefault(user_id, blob)
+            return
+        for user_id, blob in batch.items():
+            self._saved[user_id] = hash(blob)
+
+    async def flush(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self._write()
+
+    # Остальные данные бот не хранит
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key: tuple, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        pass
+
+    async def update_bot_data(self, data: dict):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
@@ -0,0 +1,402 @@
+import asyncio
+import logging
+import random
+import time
+
+import httpx
+from telegram import Bot
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+
+from database import Database
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Ограничитель скорости по алгоритму «ведро с токенами»"""
+
+    def __init__(self, rate: float, capacity: float):
+        # rate — токенов в секунду, capacity — максимальный размер всплеска
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, tokens: float = 1):
+        """Ждет, пока в ведре не наберется нужное количество токенов"""
+        tokens = min(tokens, self.capacity)
+        async with self._lock:
+            self._refill()
+            while self._tokens < tokens:
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= tokens
+
+    def drain(self, seconds: float = 0):
+        """Обнуляет запас токенов (после ответа RetryAfter от Telegram).
+
+        С seconds токены начнут снова набираться только через seconds секунд.
+        """
+        self._tokens = -seconds * self.rate
+        self._updated = time.monotonic()
+
+
+class PublishUnavailable(Exception):
+    """Публикации приостановлены: канал раз за разом не отвечает"""
+
+
+class PublishUncertain(Exception):
+    """Запрос ушел в Telegram, но ответа нет: неизвестно, вышел ли пост"""
+
+
+class PublishCancelled(Exception):
+    """Публикация не выполнена: бот останавливается"""
+
+
+# Ошибки httpx, при которых запрос заведомо не был отправлен
+_NOT_SENT = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+def request_not_sent(error: NetworkError) -> bool:
+    """Отказ до отправки запроса: повтор не может опубликовать пост второй раз"""
+    return isinstance(error.__cause__, _NOT_SENT)
+
+
+class CircuitBreaker:
+    """Автомат защиты от заведомо неудачных запросов.
+
+    После failure_threshold неудач подряд цепь размыкается: reset_timeout
+    секунд запросы не выполняются. Затем пропускается один пробный запрос;
+    успех замыкает цепь, неудача снова размыкает ее.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at < self.reset_timeout:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow(self) -> bool:
+        """Можно ли выполнить запрос сейчас"""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self):
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def end_probe(self):
+        """Снимает отметку пробного запроса, который завершился без итога (отмена, ошибка в коде)"""
+        self._probing = False
+
+    def record_failure(self):
+        self._failures += 1
+        if self._probing or self._failures >= self.failure_threshold:
+            if self._opened_at is None or self._probing:
+                logger.warning("Публикации в канал приостановлены на %s с после %d неудач", self.reset_timeout, self._failures)
+            self._opened_at = time.monotonic()
+            self._probing = False
+
+
+class _Retry(Exception):
+    """Попытку нужно повторить через delay секунд"""
+
+    def __init__(self, delay: float):
+        super().__init__(delay)
+        self.delay = delay
+
+
+class _Job:
+    """Публикация в очереди вместе с числом сделанных повторов"""
+
+    __slots__ = ('send', 'cost', 'key', 'done', 'future', 'started', 'sending',
+                 'retry_after_attempts', 'network_attempts')
+
+    def __init__(self, send, cost: int, key: str, done, future: asyncio.Future):
+        self.send = send
+        self.cost = cost
+        self.key = key
+        self.done = done
+        self.future = future
+        # Статус в журнале публикаций уже проверен и отмечен как pending
+        self.started = False
+        # Запрос к Telegram выполняется прямо сейчас
+        self.sending = False
+        self.retry_after_attempts = 0
+        self.network_attempts = 0
+
+
+class PublishQueue:
+    """Очередь публикаций в канал.
+
+    Сообщения отправляются одним обработчиком по порядку, с учетом лимитов
+    Telegram на канал и на бота в целом. Обработчик никогда не ждет повтора
+    сам: публикация, которую нужно повторить, возвращается в очередь через
+    нужное время, а остальные тем временем отправляются.
+
+    Публикация с ключом key выполняется не больше одного раза: повторная
+    постановка того же ключа возвращает уже идущую публикацию, а статусы
+    ключей хранятся в базе. Автоматически повторяются только ответ
+    RetryAfter (до max_retries раз, канал на это время приостанавливается)
+    и сетевые ошибки, при которых запрос не ушел в Telegram (до
+    network_retries раз с экспоненциальной задержкой со случайным
+    разбросом). Если запрос мог дойти, а ответа нет, пост мог выйти:
+    публикация завершается PublishUncertain со статусом unknown и больше
+    не отправляется. Неудачи подряд размыкают breaker, и пока он разомкнут,
+    публикации завершаются PublishUnavailable без обращения к Telegram.
+    """
+
+    def __init__(self, channel_limiter: TokenBucket, global_limiter: TokenBucket, max_retries: int = 5,
+                 network_retries: int = 4, backoff: float = 1, max_backoff: float = 30,
+                 breaker: CircuitBreaker = None, db: Database = None, retries: Counter = None):
+        self.channel_limiter = channel_limiter
+        self.global_limiter = global_limiter
+        self.max_retries = max_retries
+        self.network_retries = network_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker
+        self.db = db
+        # Счетчик повторов с меткой причины: retry_after, network
+        self.retries = retries
+        self._queue = asyncio.Queue()
+        self._worker = None
+        self._bot = None
+        # ключ -> Future идущей публикации
+        self._inflight = {}
+        # Публикации, ждущие повтора: _Job -> таймер возврата в очередь
+        self._delayed = {}
+        # Публикация, которую сейчас выполняет обработчик
+        self._current = None
+
+    @property
+    def pending(self) -> int:
+        """Количество публикаций, ожидающих отправки (включая ждущие повтора)"""
+        return self._queue.qsize() + len(self._delayed)
+
+    def start(self, bot: Bot):
+        """Запускает обработчик очереди"""
+        self._bot = bot
+        self._worker = asyncio.create_task(self._run(), name="publish_queue")
+
+    async def stop(self, timeout: float = 10):
+        """Дожидается отправки оставшихся публикаций и останавливает обработчик.
+
+        Публикации, не отправленные за timeout секунд, завершаются
+        PublishCancelled (их done получает эту ошибку), поэтому авторы
+        узнают, что сообщение не вышло.
+        """
+        if self._worker is None:
+            return
+        try:
+            await asyncio.wait_for(self._drain(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Не отправлено публикаций при остановке: %d", self.pending + (self._current is not None))
+        self._worker.cancel()
+        await asyncio.gather(self._worker, return_exceptions=True)
+        self._worker = None
+
+        jobs = list(self._delayed)
+        for handle in self._delayed.values():
+            handle.cancel()
+        self._delayed.clear()
+        while not self._queue.empty():
+            jobs.append(self._queue.get_nowait())
+            self._queue.task_done()
+        for job in jobs:
+            await self._finish(job, error=PublishCancelled("бот останавливается"))
+
+    async def _drain(self):
+        while True:
+            await self._queue.join()
+            if not self._delayed:
+                return
+            await asyncio.sleep(min(handle.when() for handle in self._delayed.values()) - asyncio.get_running_loop().time())
+
+    def in_progress(self, key: str) -> bool:
+        """Стоит ли публикация с ключом key в очереди или выполняется"""
+        return key in self._inflight
+
+    def submit(self, send, cost: int = 1, key: str = None, done=None) -> asyncio.Future:
+        """Ставит публикацию в очередь.
+
+        send — корутинная функция, принимающая Bot и выполняющая отправку;
+        cost — сколько сообщений она отправит в канал (для альбомов — число
+        элементов); key — ключ идемпотентности; done(error) — корутинная
+        функция, которую вызывают один раз с итогом отправки (None при
+        успехе). Возвращает Future, который завершится после публикации.
+        """
+        if key is not None and key in self._inflight:
+            return self._inflight[key]
+        future = asyncio.get_running_loop().create_future()
+        if key is not None:
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        self._queue.put_nowait(_Job(send, cost, key, done, future))
+        return future
+
+    async def _run(self):
+        while True:
+            job = await self._queue.get()
+            self._current = job
+            try:
+                await self._process(job)
+            except asyncio.CancelledError:
+                # Остановка посреди попытки: если запрос уже ушел, итог неизвестен
+                error = PublishUncertain("бот остановился во время отправки") if job.sending else \
+                    PublishCancelled("бот останавливается")
+                await self._finish(job, error=error)
+                raise
+            except Exception:
+                logger.exception("Ошибка в очереди публикаций")
+            finally:
+                self._current = None
+                self._queue.task_done()
+
+    def _retry_later(self, job: _Job, delay: float):
+        loop = asyncio.get_running_loop()
+        self._delayed[job] = loop.call_later(delay, self._requeue, job)
+
+    def _requeue(self, job: _Job):
+        del self._delayed[job]
+        self._queue.put_nowait(job)
+
+    def _journal(self, job: _Job) -> bool:
+        return job.key is not None and self.db is not None
+
+    async def _process(self, job: _Job):
+        if not job.started:
+            if self._journal(job):
+                status = await self.db.get_publication_status(job.key)
+                if status == 'published':
+                    # Пост уже вышел: повторное нажатие или перезапуск после публикации
+                    job.future.set_result(None)
+                    return
+                if status == 'unknown':
+                    # Пост мог выйти: второй раз его не отправляем
+                    job.future.set_exception(PublishUncertain("итог прошлой отправки неизвестен"))
+                    return
+                await self.db.set_publication_status(job.key, 'pending')
+            job.started = True
+        try:
+            result = await self._send(job)
+        except _Retry as retry:
+            self._retry_later(job, retry.delay)
+            return
+        except Exception as e:
+            await self._finish(job, error=e)
+            return
+        await self._finish(job, result=result)
+
+    async def _finish(self, job: _Job, result=None, error: Exception = None):
+        """Записывает итог публикации в журнал, сообщает его done и завершает Future"""
+        if job.future.done():
+            return
+        if self._journal(job) and job.started:
+            if error is None:
+                status = 'published'
+            else:
+                status = 'unknown' if isinstance(error, PublishUncertain) else 'failed'
+            try:
+                await self.db.set_publication_status(job.key, status)
+            except Exception:
+                logger.exception("Не удалось записать статус публикации %s", job.key)
+        await self._report(job.done, error)
+        if error is None:
+            job.future.set_result(result)
+        else:
+            job.future.set_exception(error)
+
+    @staticmethod
+    async def _report(done, error):
+        if done is None:
+            return
+        try:
+            await done(error)
+        except Exception:
+            logger.exception("Ошибка при обработке итога публикации")
+
+    def _count_retry(self, reason: str):
+        if self.retries is not None:
+            self.retries.labels(reason).inc()
+
+    async def _send(self, job: _Job):
+        try:
+            return await self._attempt(job)
+        finally:
+            # Иначе после исключения вне обработанных ниже цепь навсегда осталась бы полуоткрытой
+            if self.breaker is not None:
+                self.breaker.end_probe()
+
+    async def _attempt(self, job: _Job):
+        """Одна попытка отправки; _Retry — вернуть публикацию в очередь"""
+        job.sending = False
+        if self.breaker is not None and not self.breaker.allow():
+            raise PublishUnavailable("канал временно недоступен")
+        await self.channel_limiter.acquire(job.cost)
+        await self.global_limiter.acquire(job.cost)
+        job.sending = True
+        try:
+            result = await job.send(self._bot)
+        except RetryAfter as e:
+            # Telegram ответил, значит канал доступен
+            if self.breaker is not None:
+                self.breaker.record_success()
+            if job.retry_after_attempts == self.max_retries:
+                raise
+            job.retry_after_attempts += 1
+            self._count_retry("retry_after")
+            logger.warning("Telegram просит подождать %s с перед публикацией", e.retry_after)
+            # Остальные публикации в канал тоже ждут: лимит общий для канала
+            self.channel_limiter.drain(e.retry_after)
+            raise _Retry(e.retry_after)
+        except BadRequest:
+            # Запрос отклонен: повтор не поможет, а канал исправен
+            if self.breaker is not None:
+                self.breaker.record_success()
+            raise
+        except NetworkError as e:
+            if self.breaker is not None:
+                self.breaker.record_failure()
+            if not request_not_sent(e):
+                # Запрос мог дойти до Telegram, и пост мог выйти: повтор опубликовал бы его дважды
+                raise PublishUncertain(str(e)) from e
+            if job.network_attempts == self.network_retries:
+                raise
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** job.network_attempts))
+            job.network_attempts += 1
+            self._count_retry("network")
+            logger.warning("Сетевая ошибка при публикации (%s), повтор через %.1f с", e, delay)
+            raise _Retry(delay)
+        except TelegramError:
+            # Telegram ответил отказом (например, нет прав в канале): повтор не поможет
+            if self.breaker is not None:
+                self.breaker.record_success()
+            raise
+        if self.breaker is not None:
+            self.breaker.record_success()
+        return result
@@ -0,0 +1,256 @@
+import json
+import time
+
+from kv import KVClient
+
+
+class StateBackend:
+    """Общее состояние, которое должны видеть все экземпляры бота.
+
+    Сюда входят ID пользователей, баны, незавершенные отправки (user_data)
+    и ключи отсева повторов. Database хранит их в локальном файле SQLite,
+    KVState — в сетевом хранилище ключ-значение, общем для нескольких
+    реплик. Остальные данные (рассылки, очередь модерации, выгрузка
+    пользователей) остаются в Database.
+    """
+
+    async def connect(self):
+        raise NotImplementedError
+
+    async def close(self):
+        raise NotImplementedError
+
+    # Пользователи
+
+    async def get_or_create_user(self, tg_id: int, username: str = None) -> int:
+        """Получить или создать пользователя"""
+        raise NotImplementedError
+
+    async def get_user_id(self, tg_id: int):
+        """ID существующего пользователя или None, без создания"""
+        raise NotImplementedError
+
+    async def get_recent_user_ids(self, limit: int):
+        """Последние зарегистрированные пользователи: (tg_id, id)"""
+        raise NotImplementedError
+
+    async def existing_user_ids(self, user_ids: list) -> set:
+        """Те из внутренних ID, которые принадлежат пользователям"""
+        raise NotImplementedError
+
+    # Баны
+
+    async def load_bans(self):
+        """Все баны: (user_id, ban_until в секундах Unix или None, reason)"""
+        raise NotImplementedError
+
+    async def get_ban_page(self, after_id: int = None, before_id: int = None, limit: int = 20):
+        """Страница активных банов: (строки (user_id, ban_until, reason), есть_ли_еще)"""
+        raise NotImplementedError
+
+    async def add_bans(self, bans: list):
+        """Добавляет баны: [(user_id, ban_until или None для вечного бана, reason)]"""
+        raise NotImplementedError
+
+    async def remove_bans(self, user_ids: list):
+        raise NotImplementedError
+
+    # Состояние пользователей (user_data)
+
+    async def load_user_state(self, tg_id: int):
+        """Сохраненное состояние пользователя (bytes) или None"""
+        raise NotImplementedError
+
+    async def save_user_states(self, states: list):
+        """Сохраняет состояния: [(tg_id, data или None для удаления)]"""
+        raise NotImplementedError
+
+    # Ключи для отсева повторов
+
+    async def add_dedup_keys(self, keys: list, seen_at: int, prune_before: int = None):
+        raise NotImplementedError
+
+    async def prune_dedup_keys(self, before: int):
+        raise NotImplementedError
+
+    async def load_dedup_keys(self, since: int, limit: int):
+        """Последние ключи новее since: [(key, seen_at)] от новых к старым"""
+        raise NotImplementedError
+
+    async def dedup_keys_seen(self, keys: list, since: int) -> bool:
+        raise NotImplementedError
+
+
+class KVState(StateBackend):
+    """Общее состояние в хранилище ключ-значение (RESP: Redis, Valkey, KeyDB).
+
+    Раскладка ключей (prefix по умолчанию "bot:"):
+      users        hash  tg_id -> id
+      users:seq    счетчик последнего ID
+      users:ids    zset  tg_id со счетом id — порядок регистрации
+      bans         hash  user_id -> JSON [ban_until, reason]
+      bans:ids     zset  user_id со счетом user_id — для постраничного списка банов
+      state:<tg_id>      сериализованный user_data
+      dedup        zset  ключ со счетом времени публикации
+    """
+
+    def __init__(self, url: str, prefix: str = "bot:"):
+        self.client = KVClient(url)
+        self.prefix = prefix
+        self._users = prefix + "users"
+        self._user_seq = prefix + "users:seq"
+        self._user_ids = prefix + "users:ids"
+        self._bans = prefix + "bans"
+        self._ban_ids = prefix + "bans:ids"
+        self._dedup = prefix + "dedup"
+
+    async def connect(self):
+        await self.client.connect()
+        # Баны, записанные до появления bans:ids, добавляем в индекс
+        user_ids = await self.client.execute("HKEYS", self._bans)
+        if user_ids:
+            await self.client.execute(
+                "ZADD", self._ban_ids, "NX", *[item for user_id in user_ids for item in (user_id, user_id)]
+            )
+
+    async def close(self):
+        await self.client.close()
+
+    def _state_key(self, tg_id: int) -> str:
+        return f"{self.prefix}state:{tg_id}"
+
+    # Пользователи
+
+    async def get_or_create_user(self, tg_id: int, username: str = None) -> int:
+        user_id = await self.client.execute("HGET", self._users, tg_id)
+        if user_id is not None:
+            return int(user_id)
+        # Как и в SQLite, проигравший гонку запрос расходует значение счетчика
+        user_id = await self.client.execute("INCR", self._user_seq)
+        # Обе записи в одной транзакции: пользователь не может оказаться в users
+        # без места в users:ids. У проигравшего гонку HSETNX ничего не меняет,
+        # а ZADD NX не трогает счет, записанный победителем
+        replies = await self.client.pipeline([
+            ("MULTI",),
+            ("HSETNX", self._users, tg_id, user_id),
+            ("ZADD", self._user_ids, "NX", user_id, tg_id),
+            ("EXEC",),
+        ])
+        if replies[-1][0]:
+            return user_id
+        return int(await self.client.execute("HGET", self._users, tg_id))
+
+    async def get_user_id(self, tg_id: int):
+        user_id = await self.client.execute("HGET", self._users, tg_id)
+        return int(user_id) if user_id is not None else None
+
+    async def get_recent_user_ids(self, limit: int):
+        reply = await self.client.execute("ZREVRANGE", self._user_ids, 0, limit - 1, "WITHSCORES")
+        return [(int(reply[index]), int(float(reply[index + 1]))) for index in range(0, len(reply), 2)]
+
+    async def existing_user_ids(self, user_ids: list) -> set:
+        if not user_ids:
+            return set()
+        replies = await self.client.pipeline([
+            ("ZRANGEBYSCORE", self._user_ids, user_id, user_id, "LIMIT", 0, 1) for user_id in user_ids
+        ])
+        return {user_id for user_id, reply in zip(user_ids, replies) if reply}
+
+    # Баны
+
+    async def load_bans(self):
+        reply = await self.client.execute("HGETALL", self._bans)
+        rows = []
+        for index in range(0, len(reply), 2):
+            ban_until, reason = json.loads(reply[index + 1])
+            rows.append((int(reply[index]), ban_until, reason))
+        return rows
+
+    async def get_ban_page(self, after_id: int = None, before_id: int = None, limit: int = 20):
+        # ID читаются из bans:ids кусками по limit + 1, начиная от границы страницы;
+        # истекшие баны пропускаются, пока не наберется страница и одна строка сверх нее
+        now = int(time.time())
+        backward = before_id is not None
+        bound = before_id if backward else after_id or 0
+        rows = []
+        while len(rows) <= limit:
+            if backward:
+                command = ("ZREVRANGEBYSCORE", self._ban_ids, f"({bound}", "-inf", "LIMIT", 0, limit + 1)
+            else:
+                command = ("ZRANGEBYSCORE", self._ban_ids, f"({bound}", "+inf", "LIMIT", 0, limit + 1)
+            user_ids = await self.client.execute(*command)
+            if not user_ids:
+                break
+            values = await self.client.execute("HMGET", self._bans, *user_ids)
+            for user_id, value in zip(user_ids, values):
+                if value is None:
+                    continue
+                ban_until, reason = json.loads(value)
+                if ban_until is None or ban_until > now:
+                    rows.append((int(user_id), ban_until, reason))
+            if len(user_ids) <= limit:
+                break
+            bound = int(user_ids[-1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        return (list(reversed(rows)) if backward else rows), has_more
+
+    async def add_bans(self, bans: list):
+        if not bans:
+            return
+        pairs = []
+        for user_id, ban_until, reason in bans:
+            value = json.dumps([int(ban_until.timestamp()) if ban_until else None, reason], ensure_ascii=False)
+            pairs.extend((user_id, value))
+        await self.client.pipeline([
+            ("MULTI",),
+            ("HSET", self._bans, *pairs),
+            ("ZADD", self._ban_ids, *[item for user_id, _, _ in bans for item in (user_id, user_id)]),
+            ("EXEC",),
+        ])
+
+    async def remove_bans(self, user_ids: list):
+        if user_ids:
+            await self.client.pipeline([
+                ("MULTI",),
+                ("HDEL", self._bans, *user_ids),
+                ("ZREM", self._ban_ids, *user_ids),
+                ("EXEC",),
+            ])
+
+    # Состояние пользователей (user_data)
+
+    async def load_user_state(self, tg_id: int):
+        return await self.client.execute("GET", self._state_key(tg_id))
+
+    async def save_user_states(self, states: list):
+        commands = [
+            ("SET", self._state_key(tg_id), data) if data is not None else ("DEL", self._state_key(tg_id))
+            for tg_id, data in states
+        ]
+        if commands:
+            await self.client.pipeline(commands)
+
+    # Ключи для отсева повторов
+
+    async def add_dedup_keys(self, keys: list, seen_at: int, prune_before: int = None):
+        commands = []
+        if keys:
+            commands.append(("ZADD", self._dedup, *[item for key in keys for item in (seen_at, key)]))
+        if prune_before is not None:
+            commands.append(("ZREMRANGEBYSCORE", self._dedup, "-inf", prune_before))
+        if commands:
+            await self.client.pipeline(commands)
+
+    async def prune_dedup_keys(self, before: int):
+        await self.client.execute("ZREMRANGEBYSCORE", self._dedup, "-inf", before)
+
+    async def load_dedup_keys(self, since: int, limit: int):
+        reply = await self.client.execute(
+            "ZREVRANGEBYSCORE", self._dedup, "+inf", f"({since}", "WITHSCORES", "LIMIT", 0, limit
+        )
+        return [(int(reply[index]), int(float(reply[index + 1]))) for index in range(0, len(reply), 2)]
+
+    async def dedup_keys_seen(self, keys: list, since: int) -> bool:
+        scores = await self.client.execute("ZMSCORE", self._dedup, *keys)
+        return any(score is not None and float(score) > since for score in scores)
@@ -0,0 +1,88 @@
+import asyncio
+import collections
+
+from broadcast import Broadcaster
+from database import Database
+from publisher import TokenBucket
+
+USERS = 30
+
+
+class FakeBot:
+    """Записывает отправленные сообщения; получателю stuck не отвечает никогда"""
+
+    def __init__(self, stuck: int = None):
+        self.stuck = stuck
+        self.sent = collections.Counter()
+
+    async def send_message(self, chat_id: int, text: str):
+        if chat_id == self.stuck:
+            await asyncio.Event().wait()
+        await asyncio.sleep(0)
+        self.sent[chat_id] += 1
+
+
+async def _open_db() -> Database:
+    db = Database(':memory:')
+    await db.connect()
+    for tg_id in range(1001, 1001 + USERS):
+        await db.get_or_create_user(tg_id)
+    return db
+
+
+def _broadcaster(db: Database) -> Broadcaster:
+    broadcaster = Broadcaster(db, TokenBucket(10000, 10000), concurrency=3)
+    broadcaster.CHECKPOINT_INTERVAL = 0.01
+    return broadcaster
+
+
+def test_resume_from_saved_checkpoint():
+    async def scenario():
+        db = await _open_db()
+        broadcast_id = await db.create_broadcast("привет")
+        # До перезапуска обработаны получатели 1–10 и, за границей, 12 и 15
+        await db.save_broadcast_checkpoint(broadcast_id, 10, 12, 0, 0, [], [12, 15])
+
+        bot = FakeBot()
+        broadcaster = _broadcaster(db)
+        await broadcaster.resume(bot)
+        await broadcaster._task
+
+        expected = {1000 + user_id for user_id in range(11, USERS + 1)} - {1012, 1015}
+        assert set(bot.sent) == expected
+        assert max(bot.sent.values()) == 1
+        assert broadcaster._state.sent == USERS
+        assert await db.get_running_broadcasts() == []
+        await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_interrupted_broadcast_sends_each_message_once():
+    async def scenario():
+        db = await _open_db()
+        broadcast_id = await db.create_broadcast("привет")
+
+        # Один получатель не отвечает, остальные обработчики уходят дальше него
+        first = FakeBot(stuck=1005)
+        broadcaster = _broadcaster(db)
+        await broadcaster.resume(first)
+        while sum(first.sent.values()) < USERS - 1:
+            await asyncio.sleep(0.01)
+        await broadcaster.stop()
+
+        row = (await db.get_running_broadcasts())[0]
+        assert row[0] == broadcast_id
+        assert row[4] == 4
+
+        second = FakeBot()
+        broadcaster = _broadcaster(db)
+        await broadcaster.resume(second)
+        await broadcaster._task
+
+        assert set(second.sent) == {1005}
+        assert not set(first.sent) & set(second.sent)
+        assert broadcaster._state.sent == USERS
+        await db.close()
+
+    asyncio.run(scenario())
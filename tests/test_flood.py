@@ -0,0 +1,50 @@
+from flood import FloodControl, _Window
+
+
+def test_window_wraps_around():
+    window = _Window(3, 10)
+    for now in (0, 1, 2):
+        assert not window.full(now)
+        window.add(now)
+    assert window.head == 0
+    assert window.full(2.5)
+
+    # Самое старое событие (0) вышло из окна; новое занимает его ячейку
+    assert not window.full(10.5)
+    window.add(10.5)
+    assert window.head == 1
+    # Теперь самое старое — 1, и оно еще в окне
+    assert window.full(10.6)
+    assert not window.full(11.5)
+
+
+def test_window_keeps_order_after_several_laps():
+    window = _Window(2, 5)
+    now = 0.0
+    for _ in range(7):
+        assert not window.full(now)
+        window.add(now)
+        now += 3
+    # Последние события: 15 и 18; при 19 самое старое (15) еще в окне
+    assert window.full(19)
+    assert not window.full(20.5)
+
+
+def test_window_clear():
+    window = _Window(2, 60)
+    window.add(1)
+    window.add(2)
+    assert window.full(3)
+    window.clear()
+    assert not window.full(3)
+
+
+def test_flood_control_allows_again_after_wrap():
+    flood = FloodControl({'message': (2, 10)}, strikes=(3, 600))
+    assert flood.check(1, ('message',), now=0) == FloodControl.OK
+    assert flood.check(1, ('message',), now=1) == FloodControl.OK
+    assert flood.check(1, ('message',), now=2) == FloodControl.WARN
+    assert flood.check(1, ('message',), now=3) == FloodControl.DROP
+    assert flood.check(1, ('message',), now=10.5) == FloodControl.OK
+    assert flood.check(1, ('message',), now=11.5) == FloodControl.OK
+    assert flood.check(1, ('message',), now=12) == FloodControl.WARN
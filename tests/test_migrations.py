@@ -0,0 +1,77 @@
+import asyncio
+import sqlite3
+from datetime import datetime, timedelta
+
+from database import Database
+from migrations import MIGRATIONS
+
+
+def _legacy_database(path: str, ban_until: datetime):
+    """База в исходном формате: без user_version, ban_until — ISO-строка"""
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tg_id INTEGER UNIQUE,
+            username TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS bans (
+            user_id INTEGER PRIMARY KEY,
+            ban_until TIMESTAMP,
+            reason TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    conn.executemany("INSERT INTO users (tg_id, username) VALUES (?, ?)", [(101, 'first'), (102, None)])
+    conn.executemany(
+        "INSERT INTO bans (user_id, ban_until, reason) VALUES (?, ?, ?)",
+        [(1, ban_until.isoformat(), "Спам"), (2, None, "Навсегда")]
+    )
+    conn.commit()
+    conn.close()
+
+
+def test_legacy_bans_migrate_to_latest_version(tmp_path):
+    path = str(tmp_path / "users.db")
+    ban_until = (datetime.now() + timedelta(hours=5)).replace(microsecond=123456)
+    _legacy_database(path, ban_until)
+
+    async def scenario():
+        db = Database(path)
+        await db.connect()
+        bans = sorted(await db.load_bans())
+        rows, has_more = await db.get_ban_page()
+        user_id = await db.get_or_create_user(101)
+        await db.close()
+        return bans, rows, has_more, user_id
+
+    bans, rows, has_more, user_id = asyncio.run(scenario())
+    assert bans == [(1, int(ban_until.timestamp()), "Спам"), (2, None, "Навсегда")]
+    assert [row[0] for row in rows] == [1, 2] and not has_more
+    assert user_id == 1
+
+    conn = sqlite3.connect(path)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(MIGRATIONS) == 9
+    assert conn.execute("SELECT typeof(ban_until) FROM bans WHERE user_id = 1").fetchone()[0] == 'integer'
+    indexes = {row[1] for row in conn.execute("PRAGMA index_list(bans)")}
+    assert 'idx_bans_ban_until' in indexes
+    conn.close()
+
+
+def test_migrations_are_not_repeated(tmp_path):
+    path = str(tmp_path / "users.db")
+    _legacy_database(path, datetime.now() + timedelta(hours=1))
+
+    async def reopen():
+        db = Database(path)
+        await db.connect()
+        await db.close()
+
+    asyncio.run(reopen())
+    asyncio.run(reopen())
+    conn = sqlite3.connect(path)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(MIGRATIONS)
+    assert conn.execute("SELECT COUNT(*) FROM bans").fetchone()[0] == 2
+    conn.close()
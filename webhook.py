@@ -0,0 +1,299 @@
+import asyncio
+import hmac
+import json
+import logging
+import signal
+import sys
+import urllib.request
+
+import httpx
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    503: "Service Unavailable",
+}
+
+
+class ShardRouter:
+    """Распределение обновлений между несколькими экземплярами бота.
+
+    Telegram отправляет все обновления на один адрес, а экземпляров (шардов)
+    может быть несколько. Каждое обновление принадлежит шарду
+    ID пользователя % числа шардов; чужие обновления пересылаются владельцу
+    на его webhook. Так все сообщения и нажатия одного пользователя (элементы
+    альбома, подтверждения) обрабатывает один процесс, и ничего не
+    обрабатывается дважды.
+    """
+
+    # Пересланное обновление не пересылается повторно, даже если настройки шардов разошлись
+    FORWARDED_HEADER = "x-bot-shard-forwarded"
+
+    def __init__(self, index: int, peers: list, secret_token: str = None, timeout: float = 10):
+        self.index = index
+        # Адреса webhook всех шардов по порядку, включая этот
+        self.peers = peers
+        self.secret_token = secret_token
+        self.timeout = timeout
+        self.forwarded = 0
+        self._client = None
+
+    @property
+    def count(self) -> int:
+        return len(self.peers)
+
+    @staticmethod
+    def update_key(data: dict):
+        """ID пользователя (или чата) из обновления в виде JSON"""
+        for value in data.values():
+            if not isinstance(value, dict):
+                continue
+            user = value.get("from") or value.get("user")
+            if user:
+                return user["id"]
+            chat = value.get("chat") or (value.get("message") or {}).get("chat")
+            if chat:
+                return chat["id"]
+        return None
+
+    def owner(self, data: dict) -> int:
+        """Номер шарда, который обрабатывает обновление"""
+        key = self.update_key(data)
+        return self.index if key is None else key % self.count
+
+    async def start(self):
+        self._client = httpx.AsyncClient(timeout=self.timeout)
+
+    async def stop(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def forward(self, index: int, body: bytes) -> bool:
+        """Пересылает обновление шарду index; False — шард недоступен"""
+        headers = {"Content-Type": "application/json", self.FORWARDED_HEADER: str(self.index)}
+        if self.secret_token:
+            headers[SECRET_HEADER] = self.secret_token
+        try:
+            response = await self._client.post(self.peers[index], content=body, headers=headers)
+        except httpx.HTTPError as e:
+            logger.warning("Не удалось переслать обновление шарду %d: %s", index, e)
+            return False
+        if response.status_code != 200:
+            logger.warning("Шард %d ответил %d на пересланное обновление", index, response.status_code)
+            return False
+        self.forwarded += 1
+        return True
+
+
+class WebhookServer:
+    """Встроенный HTTP-сервер для приема обновлений от Telegram.
+
+    POST на path с правильным секретным заголовком кладет обновление в очередь
+    приложения, GET /health сообщает о состоянии бота. Дополнительные
+    маршруты регистрируются через add_route. Без path сервер не принимает
+    обновления и служит только для служебных маршрутов (например, в режиме polling).
+    С router обновления других шардов пересылаются их владельцам.
+    """
+
+    # Обновления Telegram не бывают больше нескольких килобайт
+    MAX_BODY = 1024 * 1024
+    # Сколько секунд ждать очередной строки или тела запроса, прежде чем закрыть соединение
+    READ_TIMEOUT = 30
+
+    def __init__(self, application: Application, listen: str, port: int, path: str = None,
+                 secret_token: str = None, router: ShardRouter = None):
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.router = router
+        self._server = None
+        # (метод, путь) -> корутинная функция (headers, body) -> (статус, тип, тело)
+        self._routes = {("GET", "/health"): self._handle_health}
+        if path:
+            self._routes[("POST", path)] = self._handle_update
+
+    def add_route(self, method: str, path: str, handler):
+        """Регистрирует дополнительный обработчик HTTP-запросов"""
+        self._routes[(method, path)] = handler
+
+    async def start(self):
+        if self.router is not None:
+            await self.router.start()
+        self._server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+        logger.info("HTTP-сервер слушает %s:%s", self.listen, self.port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self.router is not None:
+            await self.router.stop()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # Telegram держит соединения открытыми, поэтому поддерживаем keep-alive
+        try:
+            while True:
+                request_line = await self._read(reader.readline())
+                if not request_line:
+                    break
+                try:
+                    method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                except ValueError:
+                    await self._respond(writer, 400)
+                    break
+
+                headers = {}
+                while True:
+                    line = await self._read(reader.readline())
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                # Только неотрицательное целое: иначе непонятно, где кончается тело
+                length = headers.get("content-length") or "0"
+                if not (length.isascii() and length.isdigit()):
+                    await self._respond(writer, 400)
+                    break
+                length = int(length)
+                if length > self.MAX_BODY:
+                    await self._respond(writer, 413)
+                    break
+                body = await self._read(reader.readexactly(length)) if length else b""
+
+                path = target.split("?", 1)[0]
+                handler = self._routes.get((method, path))
+                if handler is None:
+                    known_path = any(route_path == path for _, route_path in self._routes)
+                    await self._respond(writer, 405 if known_path else 404)
+                else:
+                    try:
+                        status, content_type, content = await handler(headers, body)
+                    except Exception:
+                        logger.exception("Ошибка при обработке запроса %s %s", method, path)
+                        status, content_type, content = 503, "text/plain", b""
+                    await self._respond(writer, status, content_type, content)
+
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read(self, operation):
+        # Медленный или замолчавший клиент не должен держать соединение бесконечно
+        return await asyncio.wait_for(operation, self.READ_TIMEOUT)
+
+    async def _respond(self, writer: asyncio.StreamWriter, status: int,
+                       content_type: str = "text/plain", content: bytes = b""):
+        writer.write(
+            f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(content)}\r\n\r\n".encode("latin-1") + content
+        )
+        await writer.drain()
+
+    async def _handle_update(self, headers: dict, body: bytes):
+        if self.secret_token and not hmac.compare_digest(
+            headers.get(SECRET_HEADER, "").encode(), self.secret_token.encode()
+        ):
+            return 403, "text/plain", b""
+        try:
+            data = json.loads(body)
+            if self.router is not None and ShardRouter.FORWARDED_HEADER not in headers:
+                owner = self.router.owner(data)
+                if owner != self.router.index:
+                    # Если владелец недоступен, Telegram повторит доставку позже
+                    return (200 if await self.router.forward(owner, body) else 503), "text/plain", b""
+            update = Update.de_json(data, self.application.bot)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return 400, "text/plain", b""
+        await self.application.update_queue.put(update)
+        return 200, "text/plain", b""
+
+    async def _handle_health(self, headers: dict, body: bytes):
+        status = {
+            "status": "ok" if self.application.running else "stopped",
+            "update_queue": self.application.update_queue.qsize(),
+        }
+        backlog = getattr(self.application.update_processor, "backlog", None)
+        if backlog is not None:
+            status["backlog"] = backlog
+        if self.router is not None:
+            status["shard"] = self.router.index
+            status["forwarded"] = self.router.forwarded
+        code = 200 if self.application.running else 503
+        return code, "application/json", json.dumps(status).encode()
+
+
+async def serve_webhook(application: Application, server: WebhookServer, url: str = None,
+                        allowed_updates: list = None):
+    """Запускает приложение в режиме webhook до получения SIGINT/SIGTERM.
+
+    Если url не указан, webhook в Telegram не регистрируется — так сервер
+    можно проверять локально, отправляя ему записанные обновления.
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        if url:
+            await application.bot.set_webhook(
+                url=url,
+                secret_token=server.secret_token,
+                allowed_updates=allowed_updates
+            )
+        await application.start()
+        await server.start()
+        try:
+            await stop_event.wait()
+        finally:
+            await server.stop()
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    finally:
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def replay(path: str, url: str, secret_token: str = None):
+    """Отправляет записанные обновления (по одному JSON на строку) на webhook"""
+    headers = {"Content-Type": "application/json"}
+    if secret_token:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = secret_token
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            request = urllib.request.Request(url, data=line.strip().encode(), headers=headers)
+            with urllib.request.urlopen(request) as response:
+                print(response.status, line.strip()[:80])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Использование: python webhook.py [файл с обновлениями] [URL webhook] [секретный токен]")
+        sys.exit(1)
+    replay(sys.argv[1], sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)